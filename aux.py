@@ -8,6 +8,12 @@ import logging
 import warnings
 from datetime import datetime, timedelta
 import xlrd
+import hashlib
+import cPickle as pickle
+from prefetch import local_path
+
+# Bump when parse_xls_log or the format of its output changes, so cached logs are parsed again.
+XLS_LOG_VERSION = 1
 
 
 def create_aux_file(data_dict, key_dict, other_keys, dataset_id, path):
@@ -42,8 +48,33 @@ def create_aux_file(data_dict, key_dict, other_keys, dataset_id, path):
                     write.writerow(row)
 
 
-def copy_otherfiles(in_dir, out_dir, filenames, scan_info):
-    """Does the work of matching otherfiles and copying them to the appropriate directory"""
+def read_aux_rows(path, fields):
+    """
+    Reads only the requested rows of an aux file. Reading stops as soon as every requested row has been found.
+
+    Parameters:
+        path - String. Path to an aux file (created by create_aux_file).
+        fields - Set of row names (e.g., {'Latitude', 'Longitude'})
+
+    Returns:
+        rows - Dictionary of row values indexed by row name. Rows that weren't found are not included.
+    """
+    rows = {}
+    with open(path) as f:
+        for row in csv.reader(f, delimiter=','):
+            if row and row[0] in fields:
+                rows[row[0]] = row[1:]
+                if len(rows) == len(fields):
+                    break
+
+    return rows
+
+
+def copy_otherfiles(in_dir, out_dir, filenames, scan_info, source_dir=None):
+    """
+    Does the work of matching otherfiles and copying them to the appropriate directory. Files missing from in_dir are
+    copied from source_dir (see process_otherfiles).
+    """
     img_filenames = []  # Maintain a record of image filenames for the vegfrac file
     pic_dir = os.path.join(out_dir, 'Pictures')
     for project, date, rep, scan_number, _ in zip(*scan_info):
@@ -60,14 +91,14 @@ def copy_otherfiles(in_dir, out_dir, filenames, scan_info):
                         os.makedirs(pic_dir)
 
                     # Copy the file
-                    shutil.copy2(os.path.join(in_dir, filename),
+                    shutil.copy2(local_path(in_dir, source_dir, filename),
                                    pic_dir)
 
                     # Maintain a record of image filenames for the vegfrac file
                     img_filenames.append(filename)
                 else:
                     # Copy to base dir
-                    shutil.copy2(os.path.join(in_dir, filename),
+                    shutil.copy2(local_path(in_dir, source_dir, filename),
                                     out_dir)
 
     return img_filenames
@@ -96,7 +127,7 @@ def parse_scans_info(scans_info):
     return parsed_info
 
 
-def process_otherfiles(in_dir, cal_meta, loc_meta):
+def process_otherfiles(in_dir, cal_meta, loc_meta, xls_cache_dir=None, source_dir=None):
     """
     Copy appropriate pictures and raw data (.Upwelling, etc.) over to new reorganized directory.
 
@@ -110,17 +141,23 @@ def process_otherfiles(in_dir, cal_meta, loc_meta):
         out_dir - String. Path to directory reorganized data is being place into
         cal_meta - Dict. From process_upwelling.
         loc_meta - Dict. From process_upwelling.
+        xls_cache_dir=None - String. Cache directory for parsed .xls logs (see read_xls_log).
+        source_dir=None - String. If in_dir is a partial local copy of a data directory (see prefetch.py), the original
+            directory. Its files are the ones processed, read from in_dir where copied.
     """
-    # Get a list of all filenames in in_dir
-    filenames = os.walk(in_dir).next()[2]
+    if source_dir is None:
+        source_dir = in_dir
+
+    # Get a list of all filenames in the data directory
+    filenames = os.walk(source_dir).next()[2]
 
     # Check if a vegfraction file exists. If so, read the data.
     vegfrac_fn = [f for f in filenames if f.lower() == 'vegfraction.txt']
     #vegfrac_fn = [f for f in filenames if 'veg' in f.lower() and 'fraction' in f.lower() and f.endswith('.txt')]
     if len(vegfrac_fn) == 1:
-        vegfrac_data = read_vegfraction(os.path.join(in_dir, vegfrac_fn[0]))
+        vegfrac_data = read_vegfraction(local_path(in_dir, source_dir, vegfrac_fn[0]))
     elif len(vegfrac_fn) > 1:
-        raise RuntimeError('More than one VegFraction file found in {0}!'.format(in_dir))
+        raise RuntimeError('More than one VegFraction file found in {0}!'.format(source_dir))
     else:
         vegfrac_data = False
 
@@ -130,15 +167,15 @@ def process_otherfiles(in_dir, cal_meta, loc_meta):
         if logfile[0].endswith('.xls'):
             # Special handling for .xls logfiles because they only occur in two years worth of data and are
             #   badly inconsistent
-            logdata = read_xls_log(os.path.join(in_dir, logfile[0]))
+            logdata = read_xls_log(local_path(in_dir, source_dir, logfile[0]), xls_cache_dir)
             process_xls_logfile(logdata, cal_meta, loc_meta)
             logdata = None
         else:
-            logdata = read_log(os.path.join(in_dir, logfile[0]))
+            logdata = read_log(local_path(in_dir, source_dir, logfile[0]))
     elif len(logfile) > 1:
-        raise RuntimeError('MULTIPLE LOGFILES FOUND IN {0}'.format(in_dir))
+        raise RuntimeError('MULTIPLE LOGFILES FOUND IN {0}'.format(source_dir))
     elif len(logfile) == 0:
-        warnstr = 'NO LOGFILE FOUND IN {0}'.format(in_dir)
+        warnstr = 'NO LOGFILE FOUND IN {0}'.format(source_dir)
         warnings.warn(warnstr)
         logging.warning(warnstr)
         logdata = False
@@ -148,7 +185,7 @@ def process_otherfiles(in_dir, cal_meta, loc_meta):
     # Do the calibration stuff first
     cal_dir = cal_meta['out_dir']
     scans_info = parse_scans_info(cal_meta['scans_info'])
-    image_filenames = copy_otherfiles(in_dir, cal_dir, filenames, scans_info)
+    image_filenames = copy_otherfiles(in_dir, cal_dir, filenames, scans_info, source_dir)
     # Process vegfrac for cal data
     if vegfrac_data:
         process_vegfraction(vegfrac_data, image_filenames, cal_dir)
@@ -160,7 +197,7 @@ def process_otherfiles(in_dir, cal_meta, loc_meta):
         meta_dict = loc_meta[loc]
         loc_dir = meta_dict['out_dir']
         scans_info = parse_scans_info(meta_dict['scans_info'])
-        image_filenames = copy_otherfiles(in_dir, loc_dir, filenames, scans_info)
+        image_filenames = copy_otherfiles(in_dir, loc_dir, filenames, scans_info, source_dir)
         if vegfrac_data:
             process_vegfraction(vegfrac_data, image_filenames, loc_dir)
         if logdata:
@@ -173,53 +210,72 @@ def read_vegfraction(path):
 
     Throws RuntimeError if data format is unexpected.
 
-    Relies on readData from utility.py
+    The file is read one line at a time and its rows are indexed by image filename, so each output directory can pick
+    out the rows of its images directly (see process_vegfraction).
 
     Parameters:
         path - string. Full path to vegfraction file.
 
     Returns:
         header - List of strings.
-        data - List of strings. Vegfraction data.
+        index - Dictionary. Image filename -> list of (position in file, row) for each row of that image.
         footer - List of one string. Footer (should be processing date and time). None if no footer detected.
     """
-    vf_data = readData(path)
-    header = vf_data[0]
-    if header[0].lower() != 'name':
-        print('Unexpected Vegfraction header from {0}!:\n{1}\n'.format(path, header))
-
     # Define some picture suffixes
     pic_sufs = ('.jpg', '.png', '.tif', '.bmp')
-    footer = vf_data[-1]
+
+    index = dict()
+    with open(path, 'r') as vf_file:
+        header = vf_file.readline().strip('\t\r\n').split('\t')
+        if header[0].lower() != 'name':
+            print('Unexpected Vegfraction header from {0}!:\n{1}\n'.format(path, header))
+
+        # Every row but the last is data. The last may be a footer, so index each row once the next one is read.
+        pos = 0
+        row = None
+        for line in vf_file:
+            if row is not None:
+                if pos == 0:
+                    check_vegfraction_row(path, header, row, pic_sufs)
+                index.setdefault(row[0], []).append((pos, row))
+                pos += 1
+            row = line.strip('\t\r\n').split('\t')
+
+    if row is None:
+        raise RuntimeError('Vegfraction data {0} not formatted as expected! No data found!'.format(path))
+
+    footer = row
     if not footer[0].lower().startswith('processing') and not footer[0].lower().endswith(pic_sufs):
         print('Unexpected Vegfraction footer from {0}!:\n{1}\n'.format(path, footer))
 
     if footer[0].lower().endswith(pic_sufs):
+        # The last row is data.
+        if pos == 0:
+            check_vegfraction_row(path, header, row, pic_sufs)
+        index.setdefault(row[0], []).append((pos, row))
         footer = None
-        data = vf_data[1:]
-    else:
-        data = vf_data[1:-1]
 
+    return header, index, footer
+
+
+def check_vegfraction_row(path, header, row, pic_sufs):
+    """Raises RuntimeError if the first row of vegfraction data is not formatted as expected."""
     # Make sure the data is formatted as expected. Raise error otherwise
-    if not data[0][0].lower().endswith(pic_sufs):
-        import pdb
-        pdb.set_trace()
+    if not row[0].lower().endswith(pic_sufs):
         raise RuntimeError('Vegfraction data {0} not formatted as expected! '
                            'First element is not image filename!'.format(path))
 
-    if len(data[0]) != len(header):
+    if len(row) != len(header):
         raise RuntimeError('Vegfration data {0} is not formatted as expected! '
                            'Number of header elements does not match number of data elements!'.format(path))
 
-    return header, data, footer
-
 
 def process_vegfraction(vegfrac_data, img_filenames, out_dir):
     """
     Process vegfraction file
 
     Parameters:
-        vegfrac_data - output from read_vegfration as a tuple (header, data, footer)
+        vegfrac_data - output from read_vegfration as a tuple (header, index, footer)
         img_filenames - List of image filenames (return from copy_otherfiles()0
         out_dir - Directory to place new vegfrac file.
 
@@ -227,15 +283,20 @@ def process_vegfraction(vegfrac_data, img_filenames, out_dir):
         Nothing!
     """
     # Split up the vegfrac_data
-    header, data, footer = vegfrac_data
+    header, index, footer = vegfrac_data
+
+    # Look up the rows of the images, keeping the order of the vegfraction file.
+    rows = []
+    for img_filename in set(img_filenames):
+        rows.extend(index.get(img_filename, []))
+    rows.sort()
 
     # Open a new vegfrac file in the output directory
     with open(os.path.join(out_dir, 'VegFraction.csv'), 'w') as vegfrac_file:
         writer = csv.writer(vegfrac_file)
         writer.writerow(header)
-        for row in data:
-            if row[0] in img_filenames:
-                writer.writerow(row)
+        for _, row in rows:
+            writer.writerow(row)
 
         if footer is not None:
             writer.writerow(footer)
@@ -263,13 +324,47 @@ def read_log(path):
     return header, data
 
 
-def read_xls_log(path):
+def read_xls_log(path, cache_dir=None):
     """
     Reads a log file in .xls format. Years 2002-2003 have logs formatted this way.
 
+    Parameters:
+        path - String. Path to the .xls log.
+        cache_dir=None - String. Directory to cache parsed logs in. Logs are cached by the md5 of their contents and
+            XLS_LOG_VERSION, so re-runs skip parsing the workbook.
+
     Returns:
         header, data
     """
+    if cache_dir is not None:
+        with open(path, 'rb') as f:
+            cache_path = os.path.join(cache_dir, '{0}_v{1}.pkl'.format(hashlib.md5(f.read()).hexdigest(),
+                                                                       XLS_LOG_VERSION))
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+
+    logdata = parse_xls_log(path)
+
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Write then rename, so a concurrent or interrupted run never reads a partial cache file.
+        with open(cache_path + '.tmp', 'wb') as f:
+            pickle.dump(logdata, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(cache_path + '.tmp', cache_path)
+
+    return logdata
+
+
+def parse_xls_log(path):
+    """
+    Parses a log file in .xls format (see read_xls_log).
+
+    Returns:
+        header - List of header rows.
+        data - Dictionary indexed by location of [location row, {plot name: [rows]}].
+    """
     # Open the excel workbook and extract the first sheet (which contains the data)
     book = xlrd.open_workbook(path)
     sheet = book.sheet_by_index(0)
@@ -285,22 +380,22 @@ def read_xls_log(path):
 
     # Iterate over the rows
     for row_idx in range(sheet.nrows):
-        row = sheet.row(row_idx)
-        row = [element.value for element in row]
+        row = sheet.row_values(row_idx)
 
         if all(element == '' for element in row):
             continue
 
-        if str(row[0]) == 'Plot' or str(row[0]).startswith('Data collection log'):
+        first = str(row[0])
+        if first == 'Plot' or first.startswith('Data collection log'):
             header.append(row)
 
-        if str(row[0]).startswith('CSP'):
+        if first.startswith('CSP'):
             # Indicates start of a location.
             data[row[0]] = [row, {}]
             cur_loc = row[0]
             continue
 
-        if str(row[0]).startswith('Plot') and len(str(row[0])) > 4:
+        if first.startswith('Plot') and len(first) > 4:
             # Determine what plot number it is and make naming consistent.
             plot_nums = filter_floats(row[0])
             if len(plot_nums) != 0:
@@ -319,6 +414,11 @@ def read_xls_log(path):
     return header, data
 
 
+def is_cal_log_row(row):
+    """Returns True if any element of a log row mentions 'cal'."""
+    return any('cal' in str(element).lower() for element in row)
+
+
 def process_xls_logfile(logdata, cal_meta, loc_meta):
     """
     Process the CDAP xls logfile
@@ -339,7 +439,7 @@ def process_xls_logfile(logdata, cal_meta, loc_meta):
         # Extract location-specific metadata and what scannumbers are associated with it
         meta_dict = loc_meta[loc]
         _, _, _, scan_numbers, _ = parse_scans_info(meta_dict['scans_info'])
-        scan_numbers = filter_floats(scan_numbers)
+        scan_numbers = set(filter_floats(scan_numbers))
 
         # Obtain the output dir
         loc_dir = meta_dict['out_dir']
@@ -380,12 +480,13 @@ def process_xls_logfile(logdata, cal_meta, loc_meta):
                             raise RuntimeError('ENCOUNTERED UNEXPECTED XLS LOG FORMATTING IN {0}'
                                                .format(meta_dict['Legacy Path']))
 
+                is_cal = is_cal_log_row(row)
                 if row[scan_num_idx] in scan_numbers:
-                    if any('cal' in str(element).lower() for element in row):
+                    if is_cal:
                         warnings.warn('Possible cal scan log in non-cal scan numbers')
                     loc_log.append(row)
 
-                elif any('cal' in str(element).lower() for element in row):
+                elif is_cal:
                     # Call it a cal scan
                     cal_logs.append(row)
 
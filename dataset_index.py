@@ -0,0 +1,218 @@
+"""Index of restructured datasets by date and location"""
+
+import os
+import re
+import json
+import logging
+import multiprocessing
+import metadata as meta
+
+# Scan data files, e.g. Upwelling_data.csv or Raw_Upwelling_data.csv. A directory with one is a dataset.
+SCAN_FILE_PATTERN = re.compile(r'_data\.csv$')
+
+
+class DatasetIndex(object):
+    """
+    In-memory index of the restructured datasets in an output directory: (date, location) -> [(dataset ID, path)].
+
+    Paths are relative to the output directory, e.g. '20070809/CSP01' or '20070809/CSP01/CSP01_20070809_100100' for a
+    second collection with the same date and location (see plan_dataset_dir). Cal datasets use the location
+    'cal_data'. Dates may contain path separators (e.g., 8/9/2007), so each entry records its date and location
+    rather than having them parsed from the path.
+
+    The index is saved as JSON in the output directory, so later runs don't have to read every Metadata.csv again.
+    Datasets published since the last save are appended to a journal next to it (see add_published), which load
+    replays.
+    """
+    filename = 'dataset_index.json'
+    journal_filename = 'dataset_index.journal'
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.datasets = dict()
+
+    @classmethod
+    def load(cls, out_dir):
+        """Loads the saved index of an output directory, or builds it from the existing outputs if there is none."""
+        index = cls(out_dir)
+        index_path = os.path.join(out_dir, cls.filename)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                for entry in json.load(f):
+                    index.add(entry['dataset_id'], entry['path'], entry['date'], entry['location'])
+
+            journal_path = os.path.join(out_dir, cls.journal_filename)
+            if os.path.exists(journal_path):
+                with open(journal_path, 'r') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # A line cut short by an interrupted run.
+                            continue
+                        index.add(entry['dataset_id'], entry['path'], entry.get('date'), entry.get('location'))
+        else:
+            index.build()
+        return index
+
+    def build(self):
+        """
+        Indexes every dataset in the output directory: each date/location or date/location/sub-directory directory
+        with scan data files, the same datasets add_published indexes (some have no Metadata.csv). The date and
+        location are taken from Metadata.csv where there is one (cal datasets have no Location), else from the path.
+        """
+        self.datasets = dict()
+        for root, dirs, files in os.walk(self.out_dir):
+            path = os.path.relpath(root, self.out_dir)
+            if len(path.split(os.sep)) < 2 or not any(SCAN_FILE_PATTERN.search(f) for f in files):
+                continue
+
+            date, location = None, None
+            if 'Metadata.csv' in files:
+                metadata = meta.read_metadata(os.path.join(root, 'Metadata.csv'))
+                dataset_id = metadata.get('Dataset ID')
+                date = metadata.get('Date')
+                location = metadata.get('Location')
+            else:
+                # Scan files start with a Dataset ID row.
+                scan_file = sorted(f for f in files if SCAN_FILE_PATTERN.search(f))[0]
+                with open(os.path.join(root, scan_file), 'r') as f:
+                    dataset_id = f.readline().strip('\r\n').split(',')[-1]
+            self.add(dataset_id, path, date, location)
+
+    def save(self):
+        """Saves the index to the output directory."""
+        entries = []
+        for (date, location), datasets in sorted(self.datasets.items()):
+            for dataset_id, path in datasets:
+                entries.append({'date': date, 'location': location, 'dataset_id': dataset_id, 'path': path})
+
+        # Write then rename, so an interrupted save doesn't leave a truncated index.
+        index_path = os.path.join(self.out_dir, self.filename)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(entries, f, indent=1)
+        os.rename(index_path + '.tmp', index_path)
+
+        # The journal's entries are in the index now.
+        journal_path = os.path.join(self.out_dir, self.journal_filename)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
+    def add(self, dataset_id, path, date=None, location=None):
+        """
+        Adds a dataset to the index.
+
+        Parameters:
+            dataset_id - String. The dataset's ID.
+            path - String. The dataset's directory, relative to the output directory (date/location[/sub-directory]).
+            date=None, location=None - Strings. The dataset's date and location. Whichever isn't given is found from
+                the path (see path_date_location).
+        """
+        if date is None:
+            date, location = path_date_location(path, dataset_id, location)
+        elif location is None:
+            location = _path_parts(path)[len(_path_parts(date))]
+        datasets = self.datasets.setdefault((date, location), [])
+        if (dataset_id, path) not in datasets:
+            datasets.append((dataset_id, path))
+
+    def add_published(self, meta_dict):
+        """
+        Adds a published dataset (cal_meta or a loc_meta entry, with its 'out_dir' in the output directory), and
+        appends it to the journal so it is recorded without rewriting the whole index.
+        """
+        path = os.path.relpath(meta_dict['out_dir'], self.out_dir)
+        date, location = meta_dict['Date'], meta_dict.get('Location', 'cal_data')
+        self.add(meta_dict['Dataset ID'], path, date, location)
+        with open(os.path.join(self.out_dir, self.journal_filename), 'a') as f:
+            entry = {'date': date, 'location': location, 'dataset_id': meta_dict['Dataset ID'], 'path': path}
+            f.write(json.dumps(entry) + '\n')
+
+    def find(self, date, location):
+        """Returns the [(dataset ID, path)] of the datasets with a date and location."""
+        return self.datasets.get((date, location), [])
+
+    def dataset_dirs(self, filename=None, cal=True):
+        """
+        Lists the directories of the indexed datasets, sorted.
+
+        Parameters:
+            filename=None - String. Only list the datasets with this file.
+            cal=True - Boolean. Include the cal datasets.
+
+        Returns:
+            dataset_dirs - List of paths to the dataset directories.
+        """
+        dataset_dirs = []
+        for (_, location), datasets in self.datasets.items():
+            if location == 'cal_data' and not cal:
+                continue
+            for _, path in datasets:
+                dataset_dir = os.path.join(self.out_dir, path)
+                if filename is None or os.path.exists(os.path.join(dataset_dir, filename)):
+                    dataset_dirs.append(dataset_dir)
+        return sorted(dataset_dirs)
+
+
+def _map_dataset(args):
+    """Calls a per-dataset function in a worker process (see map_datasets). Errors are logged."""
+    function, description, dataset_args = args
+    try:
+        return True, function(*dataset_args)
+    except Exception, e:
+        logging.error('{0} of {1} failed: {2}'.format(description, dataset_args[0], e))
+        return False, None
+
+
+def map_datasets(function, args, description, processes=None, ordered=False):
+    """
+    Calls a function for each of a list of datasets (e.g., from DatasetIndex.dataset_dirs), in worker processes. A
+    dataset the function raises an exception for is logged and left out of the results.
+
+    Parameters:
+        function - Module-level function (so it can be sent to the workers), called with each tuple of args.
+        args - List of argument tuples, one per dataset. The first argument is the dataset's directory.
+        description - String. What the function does, for the error messages (e.g., 'Reflectance').
+        processes=None - Int. Number of worker processes. Defaults to the number of CPUs.
+        ordered=False - Boolean. Return the results in the order of args rather than as the datasets finish.
+
+    Returns:
+        results - List of the function's results for the datasets that didn't fail.
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        tasks = [(function, description, dataset_args) for dataset_args in args]
+        return [result for ok, result in imap(_map_dataset, tasks) if ok]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _path_parts(path):
+    """Splits a path into its components."""
+    return [part for part in re.split(r'[\\/]', path) if part]
+
+
+def path_date_location(path, dataset_id, location=None):
+    """
+    Finds a dataset's date and location from its directory (date/location[/sub-directory], see plan_dataset_dir), for
+    datasets without the Metadata.csv to read them from. The date may span several components (e.g., 8/9/2007), and
+    so may a sub-directory, which is recognized by being named after the dataset ID.
+
+    Parameters:
+        path - String. The dataset's directory, relative to the output directory.
+        dataset_id - String. The dataset's ID.
+        location=None - String. The dataset's location, if known.
+
+    Returns:
+        date, location - Strings.
+    """
+    path = '/'.join(_path_parts(path))
+    sub_dir = path.find('/' + dataset_id.replace(':', ''))
+    if sub_dir > 0 and len(_path_parts(path[:sub_dir])) >= 2:
+        path = path[:sub_dir]
+    parts = _path_parts(path)
+    if location is None:
+        location = parts[-1]
+    return '/'.join(parts[:-1]), location
@@ -0,0 +1,121 @@
+"""Column views over parsed CDAP data"""
+
+from utility import data2array
+
+
+class DataView(object):
+    """
+    A selection of scans (columns) over CDAP data that is parsed once and shared between views.
+
+    Selecting or splitting a view only creates a new list of column idxs; header values and scan rows are copied when
+    they are requested (e.g., by data2dict() when the output files are written). Values written with set_value() go to
+    the shared data, so every view containing that scan sees them.
+
+    Column idxs follow the CDAP data list convention used by split_by_idxs: the first scan is 1.
+    """
+
+    def __init__(self, headerdata, labels, spectra, hkeys, idxs=None):
+        """
+        Parameters:
+            headerdata, labels, spectra, hkeys - Output of data2array().
+            idxs=None - Column idxs of the scans in the view. Defaults to every scan.
+        """
+        self.headerdata = headerdata
+        self.labels = labels
+        self.spectra = spectra
+        self.hkeys = hkeys
+        if idxs is None:
+            num_scans = max([spectra.shape[1]] + [len(values) for values in headerdata.values()])
+            idxs = range(1, num_scans + 1)
+        self.idxs = list(idxs)
+
+    @classmethod
+    def from_data(cls, data, fix_dc_scans=True):
+        """Parses a CDAP data list (e.g., from read_multipart) and returns a view of every scan."""
+        headerdata, labels, spectra, hkeys = data2array(data, fix_dc_scans)
+        return cls(headerdata, labels, spectra, hkeys)
+
+    def __len__(self):
+        return len(self.idxs)
+
+    def _view(self, idxs):
+        return DataView(self.headerdata, self.labels, self.spectra, self.hkeys, idxs)
+
+    def select(self, positions):
+        """
+        Returns a view of a subset of this view's scans.
+
+        Parameters:
+            positions - Positions of the scans within this view. The first scan of the view is 1, so idxs found from
+                the view's rows (e.g., with find_cal_reps) can be used directly.
+        """
+        return self._view([self.idxs[pos - 1] for pos in sorted(set(positions))])
+
+    def split(self, positions):
+        """
+        Splits the view in two, like split_cal_scans.
+
+        Parameters:
+            positions - Positions of the scans within this view (see select).
+
+        Returns:
+            selected, rest - Views of the scans at positions and of the remaining scans.
+        """
+        positions = set(positions)
+        selected = []
+        rest = []
+        for pos, idx in enumerate(self.idxs, 1):
+            if pos in positions:
+                selected.append(idx)
+            else:
+                rest.append(idx)
+
+        return self._view(selected), self._view(rest)
+
+    def row(self, key):
+        """Returns the values of a header row for the view's scans. Missing values are ''."""
+        values = self.headerdata[key]
+        # Some rows may be empty
+        if not values:
+            return []
+        return [values[idx - 1] if idx <= len(values) else '' for idx in self.idxs]
+
+    def value(self, key, pos):
+        """Returns the header value of the scan at a position of the view."""
+        values = self.headerdata[key]
+        idx = self.idxs[pos - 1]
+        return values[idx - 1] if idx <= len(values) else ''
+
+    def set_value(self, key, pos, value):
+        """Sets the header value of the scan at a position of the view, padding short rows with ''."""
+        values = self.headerdata[key]
+        idx = self.idxs[pos - 1]
+        if idx > len(values):
+            values.extend([''] * (idx - len(values)))
+        values[idx - 1] = value
+
+    def set_row(self, key, values):
+        """Sets a header row for the view's scans."""
+        for pos, value in enumerate(values, 1):
+            self.set_value(key, pos, value)
+
+    def scan_rows(self):
+        """Yields the view's scan rows (label followed by values), e.g., for create_scan_file()."""
+        cols = [idx - 1 for idx in self.idxs]
+        num_values = self.spectra.shape[1]
+        for label, values in zip(self.labels, self.spectra):
+            row = [label]
+            row.extend([values[col] if col < num_values else '' for col in cols])
+            yield row
+
+    def data2dict(self):
+        """
+        Materializes the view in the format returned by data2dict().
+
+        Returns:
+            headerdata - Dictionary of the view's header rows indexed by fieldname.
+            scandata - Generator of the view's scan rows (see scan_rows).
+            hkeys - List of header fieldnames, in file order.
+        """
+        headerdata = dict((key, self.row(key)) for key in self.hkeys)
+        return headerdata, self.scan_rows(), list(self.hkeys)
@@ -0,0 +1,118 @@
+"""
+Registry of instrument wavelength grids.
+
+There are only a few distinct wavelength vectors in the archive (about one per instrument). Each is identified by a
+hash of its values (grid_id), stored once, and referenced by ID from the datasets' metadata ('Upwelling Wavelength Grid'
+and 'Downwelling Wavelength Grid') and the database (wavelength_grids table). Grid-dependent caches, like resampling
+matrices, are keyed by the same ID.
+"""
+
+import os
+import tempfile
+import numpy as np
+from utility import filter_floats, wavelength_hash
+
+
+def grid_id(wavelengths):
+    """Returns the ID of a wavelength grid."""
+    return wavelength_hash(wavelengths)[:16]
+
+
+class GridRegistry(object):
+    """
+    Wavelength grids by ID, kept in memory and optionally stored in a directory (one <grid_id>.csv per grid, with one
+    wavelength per line). Grid files are only ever written once, so workers can share the directory.
+    """
+
+    def __init__(self, grid_dir=None):
+        """
+        Parameters:
+            grid_dir=None - String. Directory the grids are stored in. None only keeps them in memory.
+        """
+        self.grid_dir = grid_dir
+        self.grids = dict()
+        self._scan_keys = dict()  # Tuple of scan row labels -> grid info (see grid_info)
+
+    def _path(self, grid_id):
+        return os.path.join(self.grid_dir, grid_id + '.csv')
+
+    def register(self, wavelengths):
+        """
+        Adds a wavelength grid to the registry, if it isn't there yet.
+
+        Parameters:
+            wavelengths - Sequence of the grid's wavelengths (floats).
+
+        Returns:
+            grid_id - String. The grid's ID.
+        """
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        new_id = grid_id(wavelengths)
+        if new_id in self.grids:
+            return new_id
+
+        self.grids[new_id] = wavelengths
+        if self.grid_dir is not None and not os.path.exists(self._path(new_id)):
+            if not os.path.exists(self.grid_dir):
+                try:
+                    os.makedirs(self.grid_dir)
+                except OSError:
+                    # Another worker created it.
+                    if not os.path.isdir(self.grid_dir):
+                        raise
+            # Write then rename, so a grid file is never seen half-written.
+            handle, tmp_path = tempfile.mkstemp(suffix='.csv', dir=self.grid_dir)
+            with os.fdopen(handle, 'w') as f:
+                f.writelines(['{0!r}\n'.format(wavelength) for wavelength in wavelengths])
+            os.rename(tmp_path, self._path(new_id))
+
+        return new_id
+
+    def get(self, grid_id):
+        """Returns the wavelengths (numpy float array) of a grid, or None if the grid is unknown."""
+        if grid_id not in self.grids:
+            if self.grid_dir is None or not os.path.exists(self._path(grid_id)):
+                return None
+            with open(self._path(grid_id), 'r') as f:
+                self.grids[grid_id] = np.array([float(line) for line in f if line.strip()])
+        return self.grids[grid_id]
+
+    def grid_info(self, scan_keys):
+        """
+        Registers the wavelength grid of a CDAP file's scan row labels (DC rows are skipped). The result is memoized
+        per list of labels for the life of the registry (see registry), so files from the same instrument are only
+        parsed once by it.
+
+        Returns:
+            grid_id - String. The grid's ID.
+            min_wavelength, max_wavelength - Floats.
+            channels - Int. Number of wavelengths.
+        """
+        key = tuple(scan_keys)
+        if key not in self._scan_keys:
+            wavelengths = filter_floats(scan_keys)
+            self._scan_keys[key] = (self.register(wavelengths), min(wavelengths), max(wavelengths), len(wavelengths))
+        return self._scan_keys[key]
+
+
+# Registry used when no other is given (memory only).
+default_registry = GridRegistry()
+
+# Registries of this process, by grid directory (see registry).
+_registries = dict()
+
+
+def registry(grid_dir=None):
+    """
+    Returns this process's GridRegistry for a grid directory, creating it the first time. A process restructuring
+    several directories (e.g., calling process_directory directly) shares one registry and its memo across them; each
+    worker process of run_directory gets its own, for the one directory it processes.
+
+    Parameters:
+        grid_dir=None - String. Directory the grids are stored in. None gives default_registry.
+    """
+    if grid_dir is None:
+        return default_registry
+    if grid_dir not in _registries:
+        _registries[grid_dir] = GridRegistry(grid_dir)
+    return _registries[grid_dir]
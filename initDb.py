@@ -1,6 +1,8 @@
 from mySqlite import mySqlite
 import os
 import uuid
+import sqlite3
+from metadata_to_db import create_dataset_summary
 
 # Define the path to the database. Remove it if it already exists.
 db_path = '/tmp/MetaDataDb.db'
@@ -189,6 +191,8 @@ metadata_entries = [
     "INSERT INTO metadata (id, keyword_id, name, version, user_id, last_updated) VALUES (?, (SELECT id FROM keywords WHERE name = 'Downwelling Instrument FOV'),'Downwelling Instrument FOV','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());",
     "INSERT INTO metadata (id, keyword_id, name, version, user_id, last_updated) VALUES (?, (SELECT id FROM keywords WHERE name = 'Downwelling Instrument Maximum Wavelength'),'Downwelling Instrument Max Wavelength','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());",
     "INSERT INTO metadata (id, keyword_id, name, version, user_id, last_updated) VALUES (?, (SELECT id FROM keywords WHERE name = 'Downwelling Instrument Minimum Wavelength'),'Downwelling Instrument Min Wavelength','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());",
+    "INSERT INTO metadata (id, keyword_id, name, version, user_id, last_updated) VALUES (?, (SELECT id FROM keywords WHERE name = 'Other'),'Upwelling Wavelength Grid','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());",
+    "INSERT INTO metadata (id, keyword_id, name, version, user_id, last_updated) VALUES (?, (SELECT id FROM keywords WHERE name = 'Other'),'Downwelling Wavelength Grid','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());",
     "INSERT INTO metadata (id, keyword_id, name, version, user_id, last_updated) VALUES (?, (SELECT id FROM keywords WHERE name = 'Minimum Altitude'),'Min Altitude','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());",
     "INSERT INTO metadata (id, keyword_id, name, version, user_id, last_updated) VALUES (?, (SELECT id FROM keywords WHERE name = 'Maximum Altitude'),'Max Altitude','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());",
     "INSERT INTO metadata (id, keyword_id, name, version, user_id, last_updated) VALUES (?, (SELECT id FROM keywords WHERE name = 'Calibration Mode'),'Calibration Mode','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());",
@@ -227,6 +231,32 @@ db.query('''CREATE TABLE meta_values (
     value text,
     last_updated datetime);''')
 
+# dataset_summary table: typed copy of the most queried meta_values, one row per dataset (maintained by
+# insert_metadata, see metadata_to_db.py)
+create_dataset_summary(db)
+
+# Spatial indexes (R*Tree): dataset bounding boxes keyed by dataset_summary.id and optional per-scan points
+try:
+    db.query('CREATE VIRTUAL TABLE dataset_bounds USING rtree(id, min_lat, max_lat, min_lon, max_lon);')
+    db.query('CREATE VIRTUAL TABLE scan_point_bounds USING rtree(id, min_lat, max_lat, min_lon, max_lon);')
+    db.query('''CREATE TABLE scan_points (
+        id INTEGER PRIMARY KEY,
+        summary_id INTEGER REFERENCES dataset_summary(id),
+        scan_number text);''')
+    db.query('CREATE INDEX scan_points_summary_id ON scan_points (summary_id);')
+except sqlite3.OperationalError, e:
+    print('No spatial index, SQLite rtree module not available: {0}'.format(e))
+
+# wavelength_grids table: each distinct instrument wavelength vector once, referenced by ID from the datasets'
+# 'Upwelling Wavelength Grid' and 'Downwelling Wavelength Grid' values (see grids.py)
+db.query('''CREATE TABLE wavelength_grids (
+    id text NOT NULL PRIMARY KEY,
+    channels integer,
+    min_wavelength real,
+    max_wavelength real,
+    wavelengths text,
+    last_updated datetime);''')
+
 # logs table
 db.query('''CREATE TABLE logs (
     id char(16) NOT NULL PRIMARY KEY,
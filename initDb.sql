@@ -220,6 +220,12 @@ INSERT INTO metadata (keyword_id, name, version) VALUES
 INSERT INTO metadata (keyword_id, name, version) VALUES
     ((SELECT id FROM keywords WHERE name = 'Downwelling Instrument Minimum Wavelength'),'Downwelling Instrument Min Wavelength','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());
 
+INSERT INTO metadata (keyword_id, name, version) VALUES
+    ((SELECT id FROM keywords WHERE name = 'Other'),'Upwelling Wavelength Grid','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime()); --ID of the upwelling wavelength grid
+
+INSERT INTO metadata (keyword_id, name, version) VALUES
+    ((SELECT id FROM keywords WHERE name = 'Other'),'Downwelling Wavelength Grid','Restructured Data', '7367a141-eaf0-4aee-8f9a-ca059150acca', datetime()); --ID of the downwelling wavelength grid
+
 --INSERT INTO metadata (keyword_id, name, version) VALUES (13,4,'Averaged Scans','Restructured Data'); --The number of scans averaged per one output result
 
 INSERT INTO metadata (keyword_id, name, version) VALUES
@@ -291,6 +297,33 @@ CREATE TABLE meta_values (
     last_updated datetime);
 
 
+--dataset_summary: typed copy of the most queried meta_values, one row per dataset. Its DDL is generated from the
+--summary columns by metadata_to_db.create_dataset_summary, which the loader runs before inserting.
+
+
+--Spatial indexes (R*Tree). Bounding box of each dataset, keyed by dataset_summary.id.
+CREATE VIRTUAL TABLE dataset_bounds USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+
+--Optional per-scan points; scan_point_bounds is keyed by scan_points.id.
+CREATE TABLE scan_points (
+    id INTEGER PRIMARY KEY,
+    summary_id INTEGER REFERENCES dataset_summary(id),
+    scan_number text);
+
+CREATE INDEX scan_points_summary_id ON scan_points (summary_id);
+CREATE VIRTUAL TABLE scan_point_bounds USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+
+
+--Each distinct instrument wavelength vector once, referenced by ID from the datasets' wavelength grid meta values.
+CREATE TABLE wavelength_grids (
+    id text NOT NULL PRIMARY KEY,
+    channels integer,
+    min_wavelength real,
+    max_wavelength real,
+    wavelengths text,
+    last_updated datetime);
+
+
 CREATE TABLE logs (
     id char(16) NOT NULL PRIMARY KEY,
     user_id char(16),
@@ -0,0 +1,143 @@
+"""
+Table-driven parsing of CDAP instrument strings.
+
+The recognized instruments are listed in instruments.json. Each entry has a regular expression ('match', tried in
+file order) and the rules to get the instrument's name, serial number and FOV from a matching string:
+    name - Format string, filled with the expression's named groups (e.g., "{name}").
+    serial - {"token": prefix, "skip": n, "fallback": i}: the first space-separated token starting with prefix, less
+        its first n characters; the i-th token if there is none. null for instruments without serial numbers.
+    fov - {"before": word, "width": n}: the n characters before the space preceding word (e.g., "25 Degree" -> "25").
+        An empty string if word isn't found. null if the strings don't include a FOV.
+
+The table is compiled once per process and parsed strings are memoized (there are only a few distinct strings in the
+archive). Strings that match no entry are collected in unrecognized rather than raising, so a run can report them all
+at once (see process_years).
+"""
+
+import os
+import re
+import json
+import logging
+import warnings
+from collections import OrderedDict
+
+INSTRUMENTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instruments.json')
+
+# Number of parsed instrument strings memoized per process.
+MEMO_SIZE = 256
+
+# Compiled instruments.json entries (see load_instruments).
+_instruments = None
+
+# Instrument string -> (name, serial number, FOV), or None if unrecognized. Least recently used first.
+_memo = OrderedDict()
+
+# Unrecognized instrument strings seen by this process -> number of times seen.
+unrecognized = dict()
+
+
+def load_instruments(path=INSTRUMENTS_FILE):
+    """
+    Reads and compiles an instrument table.
+
+    Parameters:
+        path - String. Path to the JSON instrument table. Defaults to instruments.json.
+
+    Returns:
+        instruments - List of the table's entries (dictionaries), with 'match' compiled.
+    """
+    with open(path, 'r') as f:
+        instruments = json.load(f)
+
+    for instrument in instruments:
+        instrument['match'] = re.compile(instrument['match'])
+        # json gives unicode; metadata values are byte strings.
+        instrument['name'] = instrument['name'].encode('utf-8')
+        if instrument['serial'] is not None:
+            instrument['serial']['token'] = instrument['serial']['token'].encode('utf-8')
+        if instrument['fov'] is not None:
+            instrument['fov']['before'] = instrument['fov']['before'].encode('utf-8')
+
+    return instruments
+
+
+def _serial(instrument_str, rule):
+    """Applies a serial number rule (see module docstring)."""
+    if rule is None:
+        return ''
+
+    tokens = instrument_str.split(' ')
+    matches = [token for token in tokens if token.startswith(rule['token'])]
+    if matches:
+        return matches[0][rule['skip']:]
+    return tokens[rule['fallback']] if len(tokens) > rule['fallback'] else ''
+
+
+def _fov(instrument_str, rule):
+    """Applies a FOV rule (see module docstring)."""
+    if rule is None:
+        return ''
+
+    fov_loc = instrument_str.find(rule['before'])
+    if fov_loc < 0:
+        return ''
+    return instrument_str[max(fov_loc - rule['width'] - 1, 0):fov_loc - 1]
+
+
+def _parse(instrument_str):
+    """Parses an instrument string with the instrument table. Returns None if no entry matches."""
+    global _instruments
+    if _instruments is None:
+        _instruments = load_instruments()
+
+    for instrument in _instruments:
+        match = instrument['match'].search(instrument_str)
+        if match:
+            return (instrument['name'].format(**match.groupdict()), _serial(instrument_str, instrument['serial']),
+                    _fov(instrument_str, instrument['fov']))
+
+    return None
+
+
+def parse_instrument(instrument_str):
+    """
+    Gets an instrument's information from its instrument string.
+
+    Parameters:
+        instrument_str - String. Instrument field of a CDAP file.
+
+    Returns:
+        info - (name, serial number, FOV) strings, or None if the instrument isn't in the table. Unrecognized strings
+            are added to unrecognized, and warned about the first time they're seen.
+    """
+    if instrument_str in _memo:
+        info = _memo.pop(instrument_str)
+    else:
+        info = _parse(instrument_str)
+        if len(_memo) >= MEMO_SIZE:
+            _memo.popitem(last=False)
+    _memo[instrument_str] = info
+
+    if info is None:
+        if instrument_str not in unrecognized:
+            warn_str = 'Unrecognized instrument {0!r}. Add it to {1}.'.format(instrument_str, INSTRUMENTS_FILE)
+            logging.warning(warn_str)
+            warnings.warn(warn_str)
+        unrecognized[instrument_str] = unrecognized.get(instrument_str, 0) + 1
+
+    return info
+
+
+def write_unrecognized_report(path, instrument_dirs):
+    """
+    Writes the unrecognized instrument strings of a run and the data directories they were found in.
+
+    Parameters:
+        path - String. Path to the report.
+        instrument_dirs - Dictionary. Instrument string -> list of data directories.
+    """
+    with open(path, 'w') as f:
+        for instrument_str in sorted(instrument_dirs.keys()):
+            f.write('{0!r}\n'.format(instrument_str))
+            for data_dir in instrument_dirs[instrument_str]:
+                f.write('    {0}\n'.format(data_dir))
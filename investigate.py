@@ -10,6 +10,8 @@ execfile('/home/trey/CODE/createTables.py')
 
 execfile('/home/trey/CODE/mySqlite.py')
 
+from utility import read_header
+
 import pdb
 import logging
 import itertools
@@ -59,8 +61,9 @@ def process_cdap(path, filename, subdirs):
         db = mySqlite('/home/trey/CODE/investigate.db')
 
         # Search for files in the current dir that match Upwelling/Outgoing name, open & extract from them.
-        with open(path + '/' + filename, 'r') as f:
-            datas = f.readlines()
+        #   Only the header rows are needed, so reading stops at the first scan row.
+        data, _, keys, _ = read_header(path + '/' + filename, find_keys=False)
+        cdap2 = keys[0].startswith('PROCESSED')
 
         odirs = []
         records = []
@@ -70,28 +73,20 @@ def process_cdap(path, filename, subdirs):
         instrument = None
         datalogger = None
 
-        # Split each line of data by tab. (this is true for all types)
-        data = []
-        for row in datas:
-            row = row[0:-2]
-            data.append(row.split('\t'))
-        del datas
+        if cdap2:
+            # CDAP2 entries are found by row position, so read the whole file.
+            with open(path + '/' + filename, 'r') as f:
+                datas = f.readlines()
 
-        # Check if not cdap 2 (cdap 2 has to be uniquely handled...
-        if not data[0][0].startswith('PROCESSED'):
+            # Split each line of data by tab.
+            data = []
+            for row in datas:
+                row = row[0:-2]
+                data.append(row.split('\t'))
+            del datas
 
-            # Now create a data dict
-            dat = {}
-            keys = []  # Keep track of unique keys
-            for row in data:
-                try:
-                    float(row[0])
-                except:
-                    keys.append(row[0])
-                    dat[row[0]] = row[1:-1]
-
-            data = dat
-            del dat
+        # Check if not cdap 2 (cdap 2 has to be uniquely handled...
+        if not cdap2:
 
             # Extract relevant data
             try:
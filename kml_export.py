@@ -0,0 +1,190 @@
+"""
+Batch KML export of scan locations.
+
+Exports the scan points of many CDAP data directories at once for QA in Google Earth. Only the header rows of the
+upwelling files are read, locations are classified for a whole file at once (determine_locs), directories are read in
+parallel, and the KML is written as it goes rather than built in memory.
+"""
+
+import os
+import re
+import zipfile
+import tempfile
+import logging
+import multiprocessing
+from xml.sax.saxutils import escape
+from utility import iter_multipart_rows, split_header, create_key_dict, determine_locs
+
+
+def read_manifest(path):
+    """Reads a list of data directories, one per line (e.g., a master_list.txt from find_datafiles)."""
+    with open(path, 'r') as manifest:
+        return [line.strip('\r\n') for line in manifest if line.strip('\r\n')]
+
+
+def read_points(data_dir):
+    """
+    Reads the scan points of a CDAP data directory from the header rows of its upwelling files.
+
+    Parameters:
+        data_dir - String. Path to CDAP data directory.
+
+    Returns:
+        points - List of (name, description, lon, lat, location, date) for each scan with a lat/lon.
+    """
+    upwelling_files = sorted([f for f in os.listdir(data_dir) if re.search(r'^(Upwelling|Outgoing).*\.txt', f)])
+    if not upwelling_files:
+        return []
+
+    # Join the header rows of every part. iter_multipart_rows pads each part to its number of scans, so later parts'
+    #   values stay with their own scans.
+    rows = iter_multipart_rows([os.path.join(data_dir, f) for f in upwelling_files])
+    try:
+        header, _ = split_header(rows)
+    finally:
+        rows.close()
+
+    num_scans = max([len(row) - 1 for row in header] or [0])
+    headerdata = dict((row[0], row[1:] + [''] * (num_scans - len(row) + 1)) for row in header)
+    key_dict = create_key_dict([row[0] for row in header])
+
+    lats = headerdata[key_dict['Latitude']]
+    lons = headerdata[key_dict['Longitude']]
+    projects = headerdata[key_dict['Project']]
+    reps = headerdata[key_dict['Replication']]
+    dates = headerdata[key_dict['Date']]
+    locations = determine_locs(lats, lons, projects)
+
+    points = []
+    for lat, lon, project, rep, date, loc in zip(lats, lons, projects, reps, dates, locations):
+        try:
+            lat = float(lat)
+            lon = float(lon)
+        except ValueError:
+            continue
+        name = '{0}: {1}'.format(project, rep)
+        description = 'Detected Location: {0}\nProject: {1}\nRep: {2}\n'.format(loc, project, rep)
+        points.append((name, description, lon, lat, loc, date))
+
+    return points
+
+
+def _read_points(data_dir):
+    """read_points for a worker process. Errors are logged and the directory skipped."""
+    try:
+        return data_dir, read_points(data_dir)
+    except Exception, e:
+        logging.error('KML export of {0} failed: {1}'.format(data_dir, e))
+        return data_dir, []
+
+
+class KmlWriter(object):
+    """Writes a KML document one placemark at a time."""
+
+    def __init__(self, path, name=None):
+        self.file = open(path, 'w')
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n')
+        if name is not None:
+            self.file.write('<name>{0}</name>\n'.format(escape(name)))
+        self.folder = None
+
+    def start_folder(self, name):
+        """Starts a folder (e.g., one per data directory). Placemarks go into the current folder."""
+        self.end_folder()
+        self.file.write('<Folder>\n<name>{0}</name>\n'.format(escape(name)))
+        self.folder = name
+
+    def end_folder(self):
+        if self.folder is not None:
+            self.file.write('</Folder>\n')
+            self.folder = None
+
+    def placemark(self, name, description, lon, lat):
+        self.file.write('<Placemark><name>{0}</name><description>{1}</description>'
+                        '<Point><coordinates>{2!r},{3!r},0.0</coordinates></Point></Placemark>\n'
+                        .format(escape(name), escape(description), lon, lat))
+
+    def close(self):
+        self.end_folder()
+        self.file.write('</Document>\n</kml>\n')
+        self.file.close()
+
+
+def _open_writer(path, name):
+    """Opens a KmlWriter for a .kml path. For a .kmz path the KML is written to a temporary file first."""
+    if path.lower().endswith('.kmz'):
+        handle, kml_path = tempfile.mkstemp(suffix='.kml')
+        os.close(handle)
+    else:
+        kml_path = path
+    return KmlWriter(kml_path, name), kml_path
+
+
+def _close_writer(writer, kml_path, path):
+    writer.close()
+    if kml_path != path:
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as kmz:
+            kmz.write(kml_path, 'doc.kml')
+        os.remove(kml_path)
+
+
+def export_kml(data_dirs, out_path, per_site_date=False, processes=None):
+    """
+    Exports the scan points of many CDAP data directories to KML.
+
+    Parameters:
+        data_dirs - List of CDAP data directories, or the path to a manifest listing them (see read_manifest).
+        out_path - String. Path of the combined .kml or .kmz file. If per_site_date, a directory to write one file per
+            location and date to (named <location>_<date>.kml).
+        per_site_date=False - Boolean. Write one file per location and date instead of one combined file.
+        processes=None - Int. Number of worker processes reading directories. Defaults to the number of CPUs.
+
+    Returns:
+        paths - List of the KML/KMZ files written.
+    """
+    if isinstance(data_dirs, basestring):
+        data_dirs = read_manifest(data_dirs)
+
+    if per_site_date and not os.path.exists(out_path):
+        os.makedirs(out_path)
+
+    writers = dict()  # (location, date) or None -> (writer, kml_path, path)
+    if not per_site_date:
+        writer, kml_path = _open_writer(out_path, os.path.basename(out_path))
+        writers[None] = (writer, kml_path, out_path)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Directories are written in the order they finish; each is its own folder.
+        for data_dir, points in pool.imap_unordered(_read_points, data_dirs):
+            folders = set()
+            for name, description, lon, lat, loc, date in points:
+                if per_site_date:
+                    key = (loc or 'Unknown', date)
+                    # Dates may contain path separators (e.g., 8/9/2007).
+                    filename = '{0}_{1}.kml'.format(key[0], re.sub(r'[\\/:]', '-', date))
+                    path = os.path.join(out_path, filename)
+                else:
+                    key = None
+                    path = out_path
+
+                if key not in writers:
+                    writer, kml_path = _open_writer(path, os.path.basename(path))
+                    writers[key] = (writer, kml_path, path)
+                writer = writers[key][0]
+
+                if key not in folders:
+                    writer.start_folder(data_dir)
+                    folders.add(key)
+                writer.placemark(name, description, lon, lat)
+
+            for key in folders:
+                writers[key][0].end_folder()
+    finally:
+        pool.close()
+        pool.join()
+        for writer, kml_path, path in writers.values():
+            _close_writer(writer, kml_path, path)
+
+    return [path for _, _, path in writers.values()]
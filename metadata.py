@@ -5,16 +5,17 @@ from utility import *
 import re
 
 
-def create_metadata_file(metadata, path):
-    """Creates a metadata file"""
+def metadata_rows(metadata):
+    """Returns the rows of a metadata file for a metadata dictionary, in file order"""
     elements = ['Dataset ID', 'Project', 'Date', 'Start Time', 'Stop Time', 'Upwelling Instrument Name',
                 'Upwelling Instrument Serial Number',
                 'Upwelling Instrument FOV', 'Upwelling Instrument Channels', 'Upwelling Instrument Max Wavelength',
-                'Upwelling Instrument Min Wavelength',
+                'Upwelling Instrument Min Wavelength', 'Upwelling Wavelength Grid',
                 'Downwelling Instrument Name', 'Downwelling Instrument Serial Number',
                 'Downwelling Instrument FOV', 'Downwelling Instrument Channgels',
                 'Downwelling Instrument Max Wavelength',
-                'Downwelling Instrument Min Wavelength', 'Calibration Panel', 'Calibration Mode', 'Location',
+                'Downwelling Instrument Min Wavelength', 'Downwelling Wavelength Grid', 'Calibration Panel',
+                'Calibration Mode', 'Location',
                 'Country', 'State', 'County', 'Target',
                 'Acquisition Software', 'Software Version', 'Min Solar Elevation', 'Max Solar Elevation',
                 'Min Solar Azimuth', 'Max Solar Azimuth', 'Min Solar Zenith', 'Max Solar Zenith', 'Min Latitude',
@@ -23,16 +24,25 @@ def create_metadata_file(metadata, path):
                 'Max Temperature 2', 'Min Temperature 2', 'Max Pyronometer', 'Min Pyronometer', 'Max Quantum Sensor',
                 'Min Quantum Sensor','Illumination Source', 'Scans Count', 'Legacy Path']
 
+    rows = []
+    for element in elements:
+        if element in metadata.keys():
+            if element == 'Target' or element == 'Calibration Panel':
+                row = [element]
+                row.extend(metadata[element])
+                rows.append(row)
+            else:
+                rows.append([element, metadata[element]])
+
+    return rows
+
+
+def create_metadata_file(metadata, path):
+    """Creates a metadata file"""
     with open(path, 'w') as f:
         write = csv.writer(f, delimiter=',')
-        for element in elements:
-            if element in metadata.keys():
-                if element == 'Target' or element == 'Calibration Panel':
-                    row = [element]
-                    row.extend(metadata[element])
-                    write.writerow(row)
-                else:
-                    write.writerow([element, metadata[element]])
+        for row in metadata_rows(metadata):
+            write.writerow(row)
 
 
 def create_metadata_dict(data_dict, key_dict, data_dir):
@@ -2,13 +2,531 @@ from mySqlite import mySqlite
 import os
 import csv
 import uuid
+import sqlite3
 from utility import *
+from aux import read_aux_rows
 import warnings
 import traceback
 import glob
+import logging
+import threading
+from datetime import datetime
+import Queue
+from metadata import metadata_rows
+from grids import registry
 
 
-def load_metadata(restruct_dir, dbpath, user_uuid ='7367a141-eaf0-4aee-8f9a-ca059150acca', calc_avg_latlon=False):
+def insert_metadata(db, restruct_dir, meta_dict, other_files, user_uuid='7367a141-eaf0-4aee-8f9a-ca059150acca',
+                    calc_avg_latlon=False, index_scans=False, grids=None):
+    """
+    Inserts one restructured dataset's metadata into the database. Does not commit, so several datasets can be
+    inserted in one transaction.
+
+    Parameters:
+        db - mySqlite database connection.
+        restruct_dir - String. Path to the restructured dataset directory.
+        meta_dict - Dictionary of metadata values as read from the dataset's Metadata.csv (see read_metadata)
+        other_files - List of the dataset's other filenames (inserted as records).
+        user_uuid - String. ID of the user the entries belong to.
+        calc_avg_latlon=False - Boolean. Calculate avg. lat/lon from the aux file if not found in meta_dict.
+        index_scans=False - Boolean. Also index each scan's location from the aux file (see update_dataset_bounds).
+        grids=None - GridRegistry the dataset's wavelength grids were registered with. If given, grids the database
+            doesn't have yet are added to wavelength_grids.
+
+    Returns:
+        dataset_uuid - String. ID of the new dataset entry.
+    """
+    # Insert the meta values into the database.
+    # Check if the project exists. if not, insert.
+    project_id = db.query('SELECT id from projects where name = ?', meta_dict['Project'])
+    if not project_id:
+        project_id = str(uuid.uuid4())
+        db.query('INSERT INTO projects (id, user_id, name, created_date, organization) VALUES (?, ?, ?,datetime(), ?)',
+                 project_id, user_uuid, meta_dict['Project'], 'CALMIT')
+
+    else:
+        project_id = project_id[0][0]
+
+    # Now create the dataset.
+    dataset_uuid = str(uuid.uuid4())
+    include_latlon = False
+    if 'Average Latitude' in meta_dict.keys() and 'Average Longitude' in meta_dict.keys():
+        # Averages were computed during restructuring (create_metadata_dict), so use those.
+        avg_lat = meta_dict['Average Latitude']
+        avg_lon = meta_dict['Average Longitude']
+        include_latlon = True
+    elif calc_avg_latlon:
+        aux_path = glob.glob(os.path.join(restruct_dir, 'Auxiliary*.csv'))
+        if not aux_path:
+            warnings.warn('NO AUX FILE FOUND IN {0}'.format(restruct_dir))
+        else:
+            # Only read as far as the Latitude and Longitude rows of the aux file.
+            aux_rows = read_aux_rows(aux_path[0], {'Latitude', 'Longitude'})
+            lats = aux_rows.get('Latitude', [])
+            lons = aux_rows.get('Longitude', [])
+            if not all(val == '-9999' or val == '' for val in lats) and \
+                    not all(val == '-9999' or val == '' for val in lons):
+                avg_lat = mean(filter_floats(lats))
+                avg_lon = mean(filter_floats(lons))
+                include_latlon = True
+                print('including caclulated lat/lon for {0}'.format(restruct_dir))
+
+    # Check if other location-information is present. 
+    if 'County' in meta_dict.keys():
+        county = meta_dict['County']
+    else:
+        county = None
+    if 'State' in meta_dict.keys():
+        state = meta_dict['State']
+    else:
+        state = None
+    if 'Country' in meta_dict.keys():
+        country = meta_dict['Country']
+    else:
+        country = None
+    if 'Location' in meta_dict.keys():
+        location = meta_dict['Location']
+    else:
+        location = None
+
+    if include_latlon:
+        lat = avg_lat
+        lon = avg_lon
+    else:
+        lat = None
+        lon = None
+
+    # insert the dataset info 
+    db.query('INSERT INTO datasets (id, user_id, project_id, date, start_time, stop_time, created_date, '
+             'lat, lon, country, location, State, county)'
+             'VALUES (?, ?,?, ?, ?, ?, datetime(), ?, ?, ?, ?, ?, ?);',
+             dataset_uuid, user_uuid, project_id, meta_dict['Date'],
+              meta_dict['Start Time'], meta_dict['Stop Time'],
+              lat, lon, country, location, state, county)
+
+    # Insert records
+    for other_file in other_files:
+        db.query('INSERT INTO records (id, dataset_id, path, filename, user_id, last_updated) '
+                 'VALUES (?,?, ?, ?, ?, datetime())',
+                 str(uuid.uuid4()), dataset_uuid, restruct_dir, other_file, user_uuid)
+
+    # Meta values
+    for key in meta_dict.keys():
+        metadata_id = db.query('SELECT id FROM metadata where name = ?', key)
+
+        if metadata_id:
+            metadata_id = metadata_id[0][0]
+            db.query('INSERT INTO meta_values (id, metadata_id, dataset_id, value, user_id, last_updated) VALUES '
+                     '(?,?, ?, ?, ?,datetime())',
+                     str(uuid.uuid4()), metadata_id, dataset_uuid, meta_dict[key], user_uuid)
+
+    summary_id = update_dataset_summary(db, dataset_uuid, meta_dict)
+    update_dataset_bounds(db, summary_id, meta_dict, restruct_dir if index_scans else None)
+
+    if grids is not None:
+        for key in GRID_ELEMENTS:
+            if key in meta_dict:
+                insert_wavelength_grid(db, grids, meta_dict[key])
+
+    return dataset_uuid
+
+
+# Metadata elements holding wavelength grid IDs (see grids.py).
+GRID_ELEMENTS = ['Upwelling Wavelength Grid', 'Downwelling Wavelength Grid']
+
+
+def create_wavelength_grids(db):
+    """
+    Creates the wavelength_grids table, and the metadata entries of the grid ID elements, if the database doesn't
+    have them yet (see initDb.py).
+    """
+    db.query('CREATE TABLE IF NOT EXISTS wavelength_grids (id text NOT NULL PRIMARY KEY, channels integer, '
+             'min_wavelength real, max_wavelength real, wavelengths text, last_updated datetime);')
+    for name in GRID_ELEMENTS:
+        if not db.query('SELECT id FROM metadata WHERE name = ?', name):
+            db.query("INSERT INTO metadata (id, keyword_id, name, version, user_id, last_updated) VALUES "
+                     "(?, (SELECT id FROM keywords WHERE name = 'Other'), ?, 'Restructured Data', "
+                     "'7367a141-eaf0-4aee-8f9a-ca059150acca', datetime());",
+                     str(uuid.uuid4()), name)
+
+
+def insert_wavelength_grid(db, grids, grid_id):
+    """
+    Adds a wavelength grid to the wavelength_grids table, unless it's already there. Does not commit.
+
+    Parameters:
+        db - mySqlite database connection.
+        grids - GridRegistry the grid was registered with.
+        grid_id - String. The grid's ID.
+
+    Returns:
+        found - Boolean. False if the registry doesn't know the grid.
+    """
+    wavelengths = grids.get(grid_id)
+    if wavelengths is None:
+        warnings.warn('Unknown wavelength grid {0}'.format(grid_id))
+        return False
+
+    db.query('INSERT OR IGNORE INTO wavelength_grids (id, channels, min_wavelength, max_wavelength, wavelengths, '
+             'last_updated) VALUES (?, ?, ?, ?, ?, datetime())',
+             grid_id, len(wavelengths), float(wavelengths.min()), float(wavelengths.max()),
+             ','.join(repr(float(wavelength)) for wavelength in wavelengths))
+    return True
+
+
+# dataset_summary columns and the metadata elements they are filled from. The summary is a typed, indexed copy of the
+# most queried meta_values, one row per dataset, so catalog queries don't need a self-join per element.
+SUMMARY_TEXT_COLUMNS = [('name', 'Dataset ID'), ('project', 'Project'), ('location', 'Location'), ('date', 'Date'),
+                        ('start_time', 'Start Time'), ('stop_time', 'Stop Time')]
+SUMMARY_REAL_COLUMNS = [('min_solar_elevation', 'Min Solar Elevation'), ('max_solar_elevation', 'Max Solar Elevation'),
+                        ('min_solar_azimuth', 'Min Solar Azimuth'), ('max_solar_azimuth', 'Max Solar Azimuth'),
+                        ('min_solar_zenith', 'Min Solar Zenith'), ('max_solar_zenith', 'Max Solar Zenith'),
+                        ('min_latitude', 'Min Latitude'), ('max_latitude', 'Max Latitude'),
+                        ('avg_latitude', 'Average Latitude'), ('min_longitude', 'Min Longitude'),
+                        ('max_longitude', 'Max Longitude'), ('avg_longitude', 'Average Longitude'),
+                        ('min_temperature_1', 'Min Temperature 1'), ('max_temperature_1', 'Max Temperature 1'),
+                        ('min_temperature_2', 'Min Temperature 2'), ('max_temperature_2', 'Max Temperature 2'),
+                        ('min_pyronometer', 'Min Pyronometer'), ('max_pyronometer', 'Max Pyronometer'),
+                        ('min_quantum_sensor', 'Min Quantum Sensor'), ('max_quantum_sensor', 'Max Quantum Sensor')]
+
+
+# dataset_summary indexes: name -> indexed columns.
+SUMMARY_INDEXES = [('dataset_summary_location_date', 'location, date'), ('dataset_summary_date', 'date'),
+                   ('dataset_summary_month', 'month'), ('dataset_summary_project', 'project'),
+                   ('dataset_summary_solar_elevation', 'max_solar_elevation')]
+
+
+def dataset_summary_ddl():
+    """Returns the statements creating the dataset_summary table and its indexes, generated from SUMMARY_*."""
+    columns = ['id INTEGER PRIMARY KEY',
+               'dataset_id char(16) NOT NULL UNIQUE REFERENCES datasets(id)']
+    columns.extend(['{0} text'.format(column) for column, _ in SUMMARY_TEXT_COLUMNS])
+    columns.append('month integer')
+    columns.extend(['{0} real'.format(column) for column, _ in SUMMARY_REAL_COLUMNS])
+    columns.append('last_updated datetime')
+
+    statements = ['CREATE TABLE IF NOT EXISTS dataset_summary ({0});'.format(', '.join(columns))]
+    for name, index_columns in SUMMARY_INDEXES:
+        statements.append('CREATE INDEX IF NOT EXISTS {0} ON dataset_summary ({1});'.format(name, index_columns))
+    return statements
+
+
+def create_dataset_summary(db):
+    """Creates the dataset_summary table and its indexes if the database doesn't have them yet (see initDb.py)."""
+    for statement in dataset_summary_ddl():
+        db.query(statement)
+
+
+# Formats of the Date element in the archive.
+DATE_FORMATS = ['%Y%m%d', '%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y']
+
+
+def parse_month(date):
+    """Returns the month of a Date value (see DATE_FORMATS), or None if it can't be parsed."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(date.strip(), date_format).month
+        except (AttributeError, ValueError):
+            continue
+    return None
+
+
+def summary_values(meta_dict):
+    """
+    Converts a dataset's metadata to dataset_summary values.
+
+    Returns:
+        values - Dictionary of dataset_summary column -> value. Missing elements and numbers that don't convert (e.g.,
+            -9999) are None.
+    """
+    values = dict()
+    for column, element in SUMMARY_TEXT_COLUMNS:
+        values[column] = meta_dict.get(element)
+
+    values['month'] = parse_month(values['date'])
+
+    for column, element in SUMMARY_REAL_COLUMNS:
+        try:
+            value = float(meta_dict[element])
+        except (KeyError, TypeError, ValueError):
+            value = None
+        if value == -9999:
+            value = None
+        values[column] = value
+
+    return values
+
+
+def update_dataset_summary(db, dataset_uuid, meta_dict):
+    """
+    Inserts or updates a dataset's dataset_summary row. The row keeps its id, so tables keyed by it stay valid.
+
+    Parameters:
+        db - mySqlite database connection.
+        dataset_uuid - String. ID of the dataset's datasets entry.
+        meta_dict - Dictionary of the dataset's metadata values (see insert_metadata).
+
+    Returns:
+        summary_id - Int. id of the dataset's dataset_summary row.
+    """
+    values = summary_values(meta_dict)
+    columns = sorted(values.keys())
+    summary_id = db.query('SELECT id FROM dataset_summary WHERE dataset_id = ?', dataset_uuid)
+    if summary_id:
+        summary_id = summary_id[0][0]
+        db.query('UPDATE dataset_summary SET {0}, last_updated = datetime() WHERE id = ?'.format(
+                 ', '.join(['{0} = ?'.format(column) for column in columns])),
+                 [values[column] for column in columns] + [summary_id])
+    else:
+        db.query('INSERT INTO dataset_summary (dataset_id, {0}, last_updated) VALUES (?, {1}, datetime())'.format(
+                 ', '.join(columns), ', '.join(['?'] * len(columns))),
+                 [dataset_uuid] + [values[column] for column in columns])
+        summary_id = db.get_last_id()
+
+    return summary_id
+
+
+def create_dataset_bounds(db):
+    """
+    Creates the R*Tree spatial indexes if the database doesn't have them yet (see initDb.py):
+        dataset_bounds - Bounding box of each dataset, keyed by dataset_summary.id.
+        scan_point_bounds - Location of each scan, keyed by scan_points.id (only filled if scans are indexed).
+
+    Returns:
+        available - Boolean. False if SQLite was built without the rtree module; the indexes are then left out and
+            spatial queries fall back on dataset_summary.
+    """
+    try:
+        db.query('CREATE VIRTUAL TABLE IF NOT EXISTS dataset_bounds USING '
+                 'rtree(id, min_lat, max_lat, min_lon, max_lon);')
+        db.query('CREATE VIRTUAL TABLE IF NOT EXISTS scan_point_bounds USING '
+                 'rtree(id, min_lat, max_lat, min_lon, max_lon);')
+    except sqlite3.OperationalError, e:
+        warnings.warn('No spatial index, SQLite rtree module not available: {0}'.format(e))
+        return False
+
+    db.query('CREATE TABLE IF NOT EXISTS scan_points (id INTEGER PRIMARY KEY, '
+             'summary_id INTEGER REFERENCES dataset_summary(id), scan_number text);')
+    db.query('CREATE INDEX IF NOT EXISTS scan_points_summary_id ON scan_points (summary_id);')
+    return True
+
+
+def has_dataset_bounds(db):
+    """Returns True if the database has the R*Tree spatial indexes (see create_dataset_bounds)."""
+    return bool(db.query("SELECT name FROM sqlite_master WHERE name = 'dataset_bounds'"))
+
+
+def update_dataset_bounds(db, summary_id, meta_dict, restruct_dir=None):
+    """
+    Sets a dataset's bounding box in dataset_bounds from its Min/Max Latitude/Longitude. Does nothing if the database
+    has no spatial index.
+
+    Parameters:
+        db - mySqlite database connection.
+        summary_id - Int. id of the dataset's dataset_summary row.
+        meta_dict - Dictionary of the dataset's metadata values.
+        restruct_dir=None - String. Path to the restructured dataset directory. If given, each scan's location is read
+            from the dataset's aux file and indexed in scan_point_bounds.
+    """
+    if not has_dataset_bounds(db):
+        return
+
+    values = summary_values(meta_dict)
+    box = [values['min_latitude'], values['max_latitude'], values['min_longitude'], values['max_longitude']]
+    db.query('DELETE FROM dataset_bounds WHERE id = ?', summary_id)
+    if None not in box:
+        db.query('INSERT INTO dataset_bounds (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)',
+                 [summary_id] + box)
+
+    if restruct_dir is None:
+        return
+
+    db.query('DELETE FROM scan_point_bounds WHERE id IN (SELECT id FROM scan_points WHERE summary_id = ?)', summary_id)
+    db.query('DELETE FROM scan_points WHERE summary_id = ?', summary_id)
+    aux_path = glob.glob(os.path.join(restruct_dir, 'Auxiliary*.csv'))
+    if not aux_path:
+        return
+
+    aux_rows = read_aux_rows(aux_path[0], {'Scan Number', 'Latitude', 'Longitude'})
+    lats, lat_mask = parse_floats(aux_rows.get('Latitude', []))
+    lons, lon_mask = parse_floats(aux_rows.get('Longitude', []))
+    scan_numbers = aux_rows.get('Scan Number', [])
+    for idx in np.flatnonzero(lat_mask[:len(lon_mask)] & lon_mask[:len(lat_mask)]):
+        scan_number = scan_numbers[idx] if idx < len(scan_numbers) else None
+        db.query('INSERT INTO scan_points (summary_id, scan_number) VALUES (?, ?)', summary_id, scan_number)
+        lat = float(lats[idx])
+        lon = float(lons[idx])
+        db.query('INSERT INTO scan_point_bounds (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)',
+                 db.get_last_id(), lat, lat, lon, lon)
+
+
+def datasets_in_box(db, min_lat, max_lat, min_lon, max_lon):
+    """
+    Finds the datasets whose bounding box intersects a lat/lon box.
+
+    Parameters:
+        db - mySqlite database connection.
+        min_lat, max_lat, min_lon, max_lon - Floats. The box, in decimal degrees.
+
+    Returns:
+        datasets - List of (dataset ID (datasets.id), Dataset ID, min_lat, max_lat, min_lon, max_lon).
+    """
+    if has_dataset_bounds(db):
+        return db.query('SELECT s.dataset_id, s.name, b.min_lat, b.max_lat, b.min_lon, b.max_lon '
+                        'FROM dataset_bounds b JOIN dataset_summary s ON s.id = b.id '
+                        'WHERE b.max_lat >= ? AND b.min_lat <= ? AND b.max_lon >= ? AND b.min_lon <= ?',
+                        min_lat, max_lat, min_lon, max_lon)
+
+    return db.query('SELECT dataset_id, name, min_latitude, max_latitude, min_longitude, max_longitude '
+                    'FROM dataset_summary '
+                    'WHERE max_latitude >= ? AND min_latitude <= ? AND max_longitude >= ? AND min_longitude <= ?',
+                    min_lat, max_lat, min_lon, max_lon)
+
+
+def scans_in_box(db, min_lat, max_lat, min_lon, max_lon):
+    """
+    Finds the indexed scans (see update_dataset_bounds) within a lat/lon box. Scan locations are only stored in the
+    spatial index, so unlike datasets_in_box there is nothing to fall back to without it.
+
+    Returns:
+        scans - List of (dataset ID (datasets.id), Dataset ID, scan number, lat, lon).
+    """
+    if not has_dataset_bounds(db):
+        raise ValueError('The database has no spatial index (SQLite rtree module not available), so scans '
+                         'can\'t be looked up by location')
+
+    return db.query('SELECT s.dataset_id, s.name, p.scan_number, b.min_lat, b.min_lon '
+                    'FROM scan_point_bounds b JOIN scan_points p ON p.id = b.id '
+                    'JOIN dataset_summary s ON s.id = p.summary_id '
+                    'WHERE b.min_lat >= ? AND b.max_lat <= ? AND b.min_lon >= ? AND b.max_lon <= ?',
+                    min_lat, max_lat, min_lon, max_lon)
+
+
+def point_in_polygon(lat, lon, polygon):
+    """Returns True if a point is within a polygon (list of (lat, lon) vertices), by ray casting."""
+    inside = False
+    for (lat1, lon1), (lat2, lon2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (lat1 > lat) != (lat2 > lat):
+            if lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+                inside = not inside
+    return inside
+
+
+def _segments_cross(p1, p2, q1, q2):
+    """Returns True if segments p1-p2 and q1-q2 intersect."""
+    def orientation(a, b, c):
+        value = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+        return (value > 0) - (value < 0)
+
+    def on_segment(a, b, c):
+        return min(a[0], b[0]) <= c[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= c[1] <= max(a[1], b[1])
+
+    o1 = orientation(p1, p2, q1)
+    o2 = orientation(p1, p2, q2)
+    o3 = orientation(q1, q2, p1)
+    o4 = orientation(q1, q2, p2)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and on_segment(p1, p2, q1)) or (o2 == 0 and on_segment(p1, p2, q2)) or
+            (o3 == 0 and on_segment(q1, q2, p1)) or (o4 == 0 and on_segment(q1, q2, p2)))
+
+
+def box_intersects_polygon(min_lat, max_lat, min_lon, max_lon, polygon):
+    """Returns True if a lat/lon box and a polygon (list of (lat, lon) vertices) intersect."""
+    corners = [(min_lat, min_lon), (min_lat, max_lon), (max_lat, max_lon), (max_lat, min_lon)]
+    if any(min_lat <= lat <= max_lat and min_lon <= lon <= max_lon for lat, lon in polygon):
+        return True
+    if any(point_in_polygon(lat, lon, polygon) for lat, lon in corners):
+        return True
+
+    box_edges = zip(corners, corners[1:] + corners[:1])
+    polygon_edges = zip(polygon, polygon[1:] + polygon[:1])
+    return any(_segments_cross(p1, p2, q1, q2) for p1, p2 in box_edges for q1, q2 in polygon_edges)
+
+
+def datasets_in_polygon(db, polygon):
+    """
+    Finds the datasets whose bounding box intersects a polygon. Candidates come from the spatial index (see
+    datasets_in_box) and only those are tested against the polygon itself.
+
+    Parameters:
+        db - mySqlite database connection.
+        polygon - List of (lat, lon) vertices.
+
+    Returns:
+        datasets - List of (dataset ID (datasets.id), Dataset ID, min_lat, max_lat, min_lon, max_lon).
+    """
+    lats = [lat for lat, _ in polygon]
+    lons = [lon for _, lon in polygon]
+    candidates = datasets_in_box(db, min(lats), max(lats), min(lons), max(lons))
+    return [dataset for dataset in candidates if box_intersects_polygon(*(list(dataset[2:]) + [polygon]))]
+
+
+def datasets_at_site(db, location):
+    """
+    Finds the datasets whose bounding box intersects a site's bounds (see SITE_BOUNDS).
+
+    Parameters:
+        db - mySqlite database connection.
+        location - String. The site's location name (e.g., 'CSP01').
+    """
+    for site, lat_min, lat_max, lon_min, lon_max in SITE_BOUNDS:
+        if site == location:
+            return datasets_in_box(db, lat_min, lat_max, lon_min, lon_max)
+
+    raise ValueError('No bounds for location {0}'.format(location))
+
+
+def refresh_dataset_summary(db, dataset_ids=None):
+    """
+    Rebuilds dataset_summary rows from the datasets and meta_values tables, e.g. after meta_values were edited or for
+    datasets loaded before the summary existed. Does not commit.
+
+    Parameters:
+        db - mySqlite database connection.
+        dataset_ids=None - List of dataset IDs (datasets.id) to refresh. Defaults to the datasets without a summary row
+            and those whose meta_values changed after their row was written.
+
+    Returns:
+        refreshed - Int. Number of datasets refreshed.
+    """
+    create_dataset_summary(db)
+    if dataset_ids is None:
+        dataset_ids = [row[0] for row in db.query(
+            'SELECT d.id FROM datasets d LEFT JOIN dataset_summary s ON s.dataset_id = d.id '
+            'WHERE s.id IS NULL OR s.last_updated < '
+            '(SELECT max(v.last_updated) FROM meta_values v WHERE v.dataset_id = d.id)')]
+
+    for dataset_id in dataset_ids:
+        dataset = db.query('SELECT d.date, d.start_time, d.stop_time, d.location, p.name FROM datasets d '
+                           'LEFT JOIN projects p ON p.id = d.project_id WHERE d.id = ?', dataset_id)
+        if not dataset:
+            continue
+
+        meta_dict = dict(zip(['Date', 'Start Time', 'Stop Time', 'Location', 'Project'], dataset[0]))
+        for name, value in db.query('SELECT m.name, v.value FROM meta_values v JOIN metadata m ON m.id = v.metadata_id '
+                                    'WHERE v.dataset_id = ?', dataset_id):
+            meta_dict[name] = value
+
+        summary_id = update_dataset_summary(db, dataset_id, meta_dict)
+        update_dataset_bounds(db, summary_id, meta_dict)
+
+    return len(dataset_ids)
+
+
+def dataset_files(restruct_dir, files=None):
+    """
+    Lists the files of a restructured dataset other than Metadata.csv. Sub-directories that are datasets of their own
+    (separate collections with the same date and location, see plan_dataset_dir) are left out.
+    """
+    if files is None:
+        files = os.listdir(restruct_dir)
+    return [f for f in files if f != 'Metadata.csv' and
+            not os.path.exists(os.path.join(restruct_dir, f, 'Metadata.csv'))]
+
+
+def load_metadata(restruct_dir, dbpath, user_uuid ='7367a141-eaf0-4aee-8f9a-ca059150acca', calc_avg_latlon=False,
+                  index_scans=False, grid_dir=None):
 
     # Find the metadata file associated with the directory.
     files = os.listdir(restruct_dir)
@@ -21,13 +539,16 @@ def load_metadata(restruct_dir, dbpath, user_uuid ='7367a141-eaf0-4aee-8f9a-ca05
         raise IOError("SOMEHOW, MORE THAN ONE METADATA FILE FOUND IN DIRECTORY!")
 
     # Get a list of other files
-    other_files = [f for f in files if f != 'Metadata.csv']
+    other_files = dataset_files(restruct_dir, files)
     # We don't need files anymore.
     del files
 
     # Connect to the database.
     try:
         db = mySqlite(dbpath)
+        create_dataset_summary(db)
+        create_dataset_bounds(db)
+        create_wavelength_grids(db)
         # Open the CSV file and read its contents
         with open(os.path.join(restruct_dir, meta_file[0])) as mfile:
             reader = csv.reader(mfile, delimiter=',')
@@ -38,88 +559,9 @@ def load_metadata(restruct_dir, dbpath, user_uuid ='7367a141-eaf0-4aee-8f9a-ca05
                 except IndexError:
                     pass
 
-        # Insert the meta values into the database.
-        # Check if the project exists. if not, insert.
-        project_id = db.query('SELECT id from projects where name = ?', meta_dict['Project'])
-        if not project_id:
-            project_id = str(uuid.uuid4())
-            db.query('INSERT INTO projects (id, user_id, name, created_date, organization) VALUES (?, ?, ?,datetime(), ?)',
-                     project_id, user_uuid, meta_dict['Project'], 'CALMIT')
-
-        else:
-            project_id = project_id[0][0]
-
-        # Now create the dataset.
-        dataset_uuid = str(uuid.uuid4())
-        include_latlon = False
-        if calc_avg_latlon:
-            aux_path = glob.glob(os.path.join(restruct_dir, 'Auxiliary*.csv'))
-            if not aux_path:
-                warnings.warn('NO AUX FILE FOUND IN {0}'.format(restruct_dir))
-            else:
-                aux_path = aux_path[0]
-                # Read data from the aux file and calculate avg. lat/lon 
-                data = readData(aux_path) 
-                for entry in data: 
-                    entry = entry[0].split(',')
-                    if entry[0] == 'Latitude' and not all(val == '-9999' or val == '' for val in entry[1:]): 
-                        avg_lat = mean(filter_floats(entry[1:])) 
-                        include_latlon = True 
-                        print('including caclulated lat/lon for {0}'.format(restruct_dir)) 
-                    if entry[0] == 'Longitude' and not all(val == '-9999' or val == '' for val in entry[1:]): 
-                        avg_lon = mean(filter_floats(entry[1:]))
-        else: 
-            if 'Average Latitude' in meta_dict.keys(): 
-                avg_lat = meta_dict['Average Latitude']
-
-                avg_lon = meta_dict['Average Longitude']
-                include_latlon = True
-
-        # Check if other location-information is present. 
-        if 'County' in meta_dict.keys():
-            county = meta_dict['County']
-        else:
-            county = None
-        if 'State' in meta_dict.keys():
-            state = meta_dict['State']
-        else:
-            state = None
-        if 'Country' in meta_dict.keys():
-            country = meta_dict['Country']
-        else:
-            country = None
-        if 'Location' in meta_dict.keys():
-            location = meta_dict['Location']
-        else:
-            location = None
-
-        if not include_latlon:
-            lat = None
-            lon = None
-
-        # insert the dataset info 
-        db.query('INSERT INTO datasets (id, user_id, project_id, date, start_time, stop_time, created_date, '
-                 'country, location, State, county)'
-                 'VALUES (?, ?,?, ?, ?, ?, datetime(), ?, ?, ?, ?);',
-                 dataset_uuid, user_uuid, project_id, meta_dict['Date'],
-                  meta_dict['Start Time'], meta_dict['Stop Time'],
-                  country, location, state, county)
-
-        # Insert records
-        for other_file in other_files:
-            db.query('INSERT INTO records (id, dataset_id, path, filename, user_id, last_updated) '
-                     'VALUES (?,?, ?, ?, ?, datetime())',
-                     str(uuid.uuid4()), dataset_uuid, restruct_dir, other_file, user_uuid)
-
-        # Meta values
-        for key in meta_dict.keys():
-            metadata_id = db.query('SELECT id FROM metadata where name = ?', key)
-
-            if metadata_id:
-                metadata_id = metadata_id[0][0]
-                db.query('INSERT INTO meta_values (id, metadata_id, dataset_id, value, user_id, last_updated) VALUES '
-                         '(?,?, ?, ?, ?,datetime())',
-                         str(uuid.uuid4()), metadata_id, dataset_uuid, meta_dict[key], user_uuid)
+        dataset_uuid = insert_metadata(db, restruct_dir, meta_dict, other_files, user_uuid=user_uuid,
+                                       calc_avg_latlon=calc_avg_latlon, index_scans=index_scans,
+                                       grids=registry(grid_dir) if grid_dir is not None else None)
 
         # Commit all changes.
         db.commit()
@@ -132,11 +574,117 @@ def load_metadata(restruct_dir, dbpath, user_uuid ='7367a141-eaf0-4aee-8f9a-ca05
     finally:
         db.close()
 
+class MetadataWriter(threading.Thread):
+    """
+    Loads restructured datasets' metadata into the database as they are produced.
+
+    Datasets are put on a queue (e.g., by process_years once a directory's outputs are complete) and a single writer
+    thread drains the queue, inserting whatever is waiting (up to batch_size datasets) in one transaction. Only this
+    thread touches the database, which suits SQLite's single writer.
+
+    If a batch fails, it is rolled back and its datasets are retried one at a time so only the offending dataset is
+    skipped. Failures are logged and counted in failed.
+
+    With grid_dir (the GridRegistry directory the restructuring wrote to), the datasets' wavelength grids are added to
+    the wavelength_grids table.
+    """
+    def __init__(self, dbpath, user_uuid='7367a141-eaf0-4aee-8f9a-ca059150acca', calc_avg_latlon=False,
+                 batch_size=50, index_scans=False, grid_dir=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dbpath = dbpath
+        self.user_uuid = user_uuid
+        self.calc_avg_latlon = calc_avg_latlon
+        self.batch_size = batch_size
+        self.index_scans = index_scans
+        self.grids = registry(grid_dir) if grid_dir is not None else None
+        self.queue = Queue.Queue()
+        self.loaded = 0
+        self.failed = 0
+
+    def put(self, metadata):
+        """
+        Queues a dataset for loading.
+
+        Parameters:
+            metadata - Dict. In-memory metadata of a dataset whose files are complete (cal_meta or a loc_meta entry).
+                Values are converted to what the dataset's Metadata.csv contains.
+        """
+        restruct_dir = metadata['out_dir']
+        meta_dict = dict()
+        for row in metadata_rows(metadata):
+            # Same as reading back Metadata.csv (see read_metadata)
+            if len(row) > 1:
+                meta_dict[row[0]] = repr(row[1]) if isinstance(row[1], float) else str(row[1])
+
+        other_files = dataset_files(restruct_dir)
+        self.queue.put((restruct_dir, meta_dict, other_files))
+
+    def close(self):
+        """Waits for the queue to be drained and stops the writer thread."""
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        db = mySqlite(self.dbpath)
+        try:
+            create_dataset_summary(db)
+            create_dataset_bounds(db)
+            create_wavelength_grids(db)
+            db.commit()
+            done = False
+            while not done:
+                # Wait for a dataset, then take whatever else is already waiting.
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Queue.Empty:
+                        break
+
+                if None in batch:
+                    done = True
+                    batch = [item for item in batch if item is not None]
+
+                if batch:
+                    self._load_batch(db, batch)
+        finally:
+            db.close()
+
+    def _load_batch(self, db, batch):
+        """Inserts a batch of datasets in one transaction, falling back to one transaction per dataset on error."""
+        try:
+            for restruct_dir, meta_dict, other_files in batch:
+                insert_metadata(db, restruct_dir, meta_dict, other_files, user_uuid=self.user_uuid,
+                                calc_avg_latlon=self.calc_avg_latlon, index_scans=self.index_scans,
+                                grids=self.grids)
+            db.commit()
+            self.loaded += len(batch)
+            return
+        except Exception:
+            db.rollback()
+
+        for restruct_dir, meta_dict, other_files in batch:
+            try:
+                insert_metadata(db, restruct_dir, meta_dict, other_files, user_uuid=self.user_uuid,
+                                calc_avg_latlon=self.calc_avg_latlon, index_scans=self.index_scans,
+                                grids=self.grids)
+                db.commit()
+                self.loaded += 1
+            except Exception:
+                db.rollback()
+                self.failed += 1
+                err_str = 'METADATA FROM {0} FAILED TO LOAD\n{1}'.format(restruct_dir, traceback.format_exc())
+                logging.error(err_str)
+                warnings.warn(err_str)
+
+
 if __name__ == '__main__':
     execfile('/code/spectral_metadata_tools/initDb.py')
     for root, subdirs, files in os.walk('/media/sf_tmp/restruct2/'):
         if 'Metadata.csv' in files:
-            load_metadata(root, '/tmp/MetaDataDb.db', calc_avg_latlon=True)
+            load_metadata(root, '/tmp/MetaDataDb.db', calc_avg_latlon=True,
+                          grid_dir='/media/sf_tmp/restruct2/wavelength_grids')
 
 
     #load_metadata('/media/sf_tmp/restruct_test/CSP02/20070809/', '/tmp/MetaDatadb.db')
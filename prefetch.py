@@ -0,0 +1,135 @@
+"""
+Prefetching of data directories to local disk.
+
+The source data directories are on a slow network share. While one directory is being restructured, a
+DirectoryPrefetcher copies the next ones to a local cache, so reading the share overlaps with processing instead of
+adding to it. Images are only copied if asked for (they are only copied into the outputs once, see copy_otherfiles);
+anything not prefetched is read from the share (see local_path).
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import threading
+
+IMAGE_SUFFIXES = ('.jpg', '.png', '.tif', '.bmp', '.tiff')
+
+
+def local_path(in_dir, source_dir, filename):
+    """
+    Returns the path to read a data directory's file from: its copy in in_dir (a prefetched copy of source_dir) if
+    there is one, else the original in source_dir.
+    """
+    path = os.path.join(in_dir, filename)
+    if source_dir is not None and in_dir != source_dir and not os.path.exists(path):
+        return os.path.join(source_dir, filename)
+    return path
+
+
+class DirectoryPrefetcher(threading.Thread):
+    """
+    Copies a list of data directories, in order, to a local cache ahead of their processing.
+
+    At most depth directories are copied ahead of the ones in use (taken with get and not yet released), so the cache
+    holds depth + 1 directories at a time with the default depth of 1 (double buffering). Directories larger than
+    max_bytes, or that fail to copy, are not cached; get then returns None and the directory is read from the share.
+    """
+    def __init__(self, data_dirs, cache_root=None, depth=1, max_bytes=None, images=False):
+        """
+        Parameters:
+            data_dirs - List of data directory paths, in processing order.
+            cache_root=None - String. Local directory to create the cache in. Defaults to the system's temporary
+                directory.
+            depth=1 - Int. Number of directories to copy ahead.
+            max_bytes=None - Int. Directories with more than this many bytes to copy are not cached.
+            images=False - Boolean. Also copy the directories' images.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.data_dirs = list(data_dirs)
+        self.cache_root = cache_root
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.images = images
+        self.cache_dir = None
+        self.fetched = dict()  # data dir -> local copy (None if not cached)
+        self.in_use = set()
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def start(self):
+        if self.cache_root is not None and not os.path.exists(self.cache_root):
+            os.makedirs(self.cache_root)
+        self.cache_dir = tempfile.mkdtemp(prefix='prefetch_', dir=self.cache_root)
+        threading.Thread.start(self)
+
+    def run(self):
+        for data_dir in self.data_dirs:
+            with self.condition:
+                # Wait until fewer than depth directories are waiting to be used.
+                while not self.stopped and len(set(self.fetched) - self.in_use) >= self.depth:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+
+            local_dir = self._fetch(data_dir)
+            with self.condition:
+                self.fetched[data_dir] = local_dir
+                self.condition.notify_all()
+
+    def _fetch(self, data_dir):
+        """Copies a data directory's files into the cache. Returns the copy's path, or None if it isn't cached."""
+        try:
+            filenames = [f for f in os.listdir(data_dir) if os.path.isfile(os.path.join(data_dir, f))]
+            if not self.images:
+                filenames = [f for f in filenames if not f.lower().endswith(IMAGE_SUFFIXES)]
+
+            if self.max_bytes is not None and \
+                    sum([os.path.getsize(os.path.join(data_dir, f)) for f in filenames]) > self.max_bytes:
+                logging.info('Not prefetching {0}, larger than {1} bytes'.format(data_dir, self.max_bytes))
+                return None
+
+            local_dir = tempfile.mkdtemp(dir=self.cache_dir)
+            for filename in filenames:
+                shutil.copy2(os.path.join(data_dir, filename), local_dir)
+        except (IOError, OSError), e:
+            logging.warning('Prefetching {0} failed, reading it from the source: {1}'.format(data_dir, e))
+            return None
+
+        return local_dir
+
+    def get(self, data_dir):
+        """
+        Waits for a data directory to be prefetched.
+
+        Returns:
+            local_dir - String. Path to the local copy of data_dir, or None if it isn't cached (including directories
+                that aren't in data_dirs).
+        """
+        with self.condition:
+            if data_dir not in self.data_dirs:
+                return None
+            while data_dir not in self.fetched and self.is_alive():
+                # Time out now and then, so a dead thread is noticed.
+                self.condition.wait(1)
+            self.in_use.add(data_dir)
+            return self.fetched.get(data_dir)
+
+    def release(self, data_dir):
+        """Removes a data directory's local copy once it has been processed, making room for the next one."""
+        with self.condition:
+            local_dir = self.fetched.pop(data_dir, None)
+            self.in_use.discard(data_dir)
+            self.condition.notify_all()
+        if local_dir is not None:
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+    def close(self):
+        """Stops prefetching and removes the cache."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.join()
+        if self.cache_dir is not None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -0,0 +1,100 @@
+"""
+Quick-look plots of restructured datasets.
+
+Renders a PNG of the scans of each scan data file (e.g., Upwelling_data.csv -> Upwelling_data.png) next to it, for QA
+of a whole season. Rendering is headless (Agg canvas, no pyplot state), each worker process reuses a single figure and
+all scans of a file are drawn as one LineCollection.
+"""
+
+import os
+import re
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from utility import read_scan_file, wavelength_rows, draw_scans
+from dataset_index import DatasetIndex, map_datasets
+
+# Figure reused by render_dataset() within a worker process.
+_figure = None
+
+
+def create_figure():
+    """Creates a headless figure for render_scan_file()."""
+    fig = Figure(figsize=(6.5, 8.5))
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def render_scan_file(path, saveto, fig=None, max_lines=None, dpi=100):
+    """
+    Renders the scans of a scan data file to an image.
+
+    Parameters:
+        path - String. Path to the scan data file.
+        saveto - String. Path to save the image to.
+        fig=None - Figure to draw on (see create_figure). It is cleared first. Defaults to a new figure.
+        max_lines=None - Int. Maximum number of scans drawn (see draw_scans).
+        dpi=100 - Int. Resolution of the image.
+    """
+    if fig is None:
+        fig = create_figure()
+    fig.clear()
+
+    dataset_id, _, _, labels, block = read_scan_file(path)
+    wavelengths, rows = wavelength_rows(labels)
+
+    ax = fig.add_subplot(111)
+    draw_scans(ax, wavelengths, block[rows], max_lines)
+    ax.tick_params(direction='out')
+    ax.set_title('{0}\n{1}'.format(dataset_id, os.path.basename(path)))
+    ax.set_xlabel('Wavelength')
+    fig.savefig(saveto, dpi=dpi)
+
+
+def render_dataset(dataset_dir, max_lines=None, overwrite=False):
+    """
+    Renders a PNG next to each scan data file of a restructured dataset.
+
+    Parameters:
+        dataset_dir - String. Path to the dataset's directory.
+        max_lines=None - Int. Maximum number of scans drawn per plot (see draw_scans).
+        overwrite=False - Boolean. If False, existing PNGs are kept.
+
+    Returns:
+        rendered - List of the PNGs written.
+    """
+    global _figure
+    if _figure is None:
+        _figure = create_figure()
+
+    rendered = []
+    for filename in sorted(os.listdir(dataset_dir)):
+        if not re.search(r'_data\.csv$', filename):
+            continue
+        path = os.path.join(dataset_dir, filename)
+        saveto = os.path.splitext(path)[0] + '.png'
+        if not overwrite and os.path.exists(saveto):
+            continue
+        render_scan_file(path, saveto, _figure, max_lines)
+        rendered.append(saveto)
+
+    return rendered
+
+
+def render_archive(restruct_dir, max_lines=2000, overwrite=False, processes=None):
+    """
+    Renders quick-look PNGs for every dataset in a restructured data directory, in parallel.
+
+    Parameters:
+        restruct_dir - String. Path to the restructured data directory.
+        max_lines=2000 - Int. Maximum number of scans drawn per plot (see draw_scans).
+        overwrite=False - Boolean. If False, existing PNGs are kept.
+        processes=None - Int. Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        rendered - List of the PNGs written.
+    """
+    args = [(dataset_dir, max_lines, overwrite) for dataset_dir in DatasetIndex.load(restruct_dir).dataset_dirs()]
+    rendered = []
+    for pngs in map_datasets(render_dataset, args, 'Quick-look', processes):
+        rendered.extend(pngs)
+    return rendered
@@ -20,22 +20,46 @@ from aux import *
 import logging
 import time
 import traceback
-import copy
-
-
-def process_upwelling(data_dir, out_dir):
+import multiprocessing
+import resource
+import threading
+from metadata_to_db import MetadataWriter
+from dataview import DataView
+from staging import create_staging_dir, discard_staging_dir, publish
+from prefetch import DirectoryPrefetcher
+from dataset_index import DatasetIndex
+import spectra
+from grids import default_registry, registry
+import instruments
+
+
+def process_upwelling(data_dir, out_dir, streaming=False, publish_dir=None, index=None, dark_correct=False,
+                      grids=None, source_dir=None):
     """
     Processes the upwelling file(s) in a CDAP data directory.
 
     Parameters:
         data_dir - String. Path to CDAP data directory.
         out_dir - String. Path to store reorganized data.
+        streaming=False - Boolean. Only hold the header rows in memory and stream the scan rows (and the raw files)
+            straight to the output files, for directories too large to load.
+        publish_dir=None - String. If out_dir is a staging directory (see staging.py), the directory it will be
+            published to. Dataset directories already taken there are avoided (see plan_dataset_dir).
+        index=None - DatasetIndex of publish_dir, used to find the datasets already there.
+        dark_correct=False - Boolean. Also write dark-current corrected scan files (see spectra.dark_correct), e.g.
+            Upwelling_DC_corrected_data.csv.
+        grids=None - GridRegistry to register the wavelength grid with. Defaults to grids.default_registry.
+        source_dir=None - String. If data_dir is a local copy (see prefetch.py), the original data directory. It is
+            recorded as the datasets' Legacy Path.
 
     Returns:
         - A dictionary (?) mapping CDAP file fields to their locations and standardized names (so other files don't have
             to do the same work twice)
         - A dictionary containing metadata to be saved at end of restructuring process.
     """
+    if source_dir is None:
+        source_dir = data_dir
+
     # Find CDAP upwelling files in the data directory
     up_pattern = r'^Upwelling.*\.txt'
     upwelling_files = [f for f in os.listdir(data_dir) if re.search(up_pattern, f)]
@@ -48,11 +72,11 @@ def process_upwelling(data_dir, out_dir):
     # If not upwelling files found, return None.
     # TODO: Handle missing data files better. Probably should log this, along with other errors.
     if not upwelling_files:
-        return None, None, None, None
+        return None, None, None, None, None, None
 
     # Log that we are processing this directory. Note this is a stopgap for a better solution in the future....:
     logging.info('-------------------------------------------------------------\n'
-                 'Processing {0}. Started {1} \n'.format(data_dir, time.strftime('%d/%m/%Y at %H:%M:%S')))
+                 'Processing {0}. Started {1} \n'.format(source_dir, time.strftime('%d/%m/%Y at %H:%M:%S')))
 
     upwelling_files.sort()  # Sort the files so *Data01.txt is first
 
@@ -63,35 +87,20 @@ def process_upwelling(data_dir, out_dir):
         raw_upwelling_files = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if re.search(raw_pattern, f)]
 
     # Load the file(s). If more than one, join into one data structure for easy access.
-    first = True
-    for upwelling_file in upwelling_files:
-        if first:
-            data = readData(os.path.join(data_dir, upwelling_file))
-            first = False
-        else:
-            odata = readData(os.path.join(data_dir, upwelling_file))
-            for idx, row in enumerate(odata):
-                data[idx].extend(row[1:])
+    #   In streaming mode only the header rows are read now. The scan rows are read once every output file is known,
+    #   and their labels (the wavelengths) are collected into scan_keys as they are written.
+    upwelling_paths = [os.path.join(data_dir, f) for f in upwelling_files]
+    view, rows, scan_keys = load_cdap_view(upwelling_paths, streaming)
 
-            del odata
+    # Create a list of just the header keys
+    hkeys = view.hkeys
 
-    if data[0][0].startswith('PROCESSED'):
+    if hkeys[0].startswith('PROCESSED'):
         raise NotImplementedError('CDAP 2 NOT IMPLEMENTED YET!')
         cdap2 = True
     else:
         cdap2 = False
 
-    # Get the fields of the data
-    fields = getFields(data)
-    # Find the scan starting idx
-    scanidx = findScanIdx(fields)
-    # Create a list of just the wavelengths
-    scan_keys = fields[scanidx:]
-    # Get only those that are actual wavelength numbers
-    wavelengths = filter_floats(scan_keys)
-    # Create a list of just the header keys
-    hkeys = fields[0:scanidx]
-
     # Find the desired fields (aux & metadata fields)
     #   Maintain a dict of official name -> file key name
     key_dict = create_key_dict(hkeys)
@@ -109,41 +118,17 @@ def process_upwelling(data_dir, out_dir):
                   key.lower() not in {'reserved', 'additional data', 'lamp', 'shutter status',
                                       'battery voltage', 'scan begin & end', 'solar angles', 'unispec dc'}]
 
-    # So that each scan can be processed, we get the index position of key fields needed to determine
-    #   a scan's status (cal or not), location, and project.
-    # Get lats and lons idx position
-    lat_idx = fields.index(key_dict['Latitude'])
-    lon_idx = fields.index(key_dict['Longitude'])
-    # Get the idx of the project names
-    project_idx = fields.index(key_dict['Project'])
-    # Get the index position of rep names and filenames
-    rep_idx = fields.index(key_dict['Replication'])
-    filename_idx = fields.index('File Name')
-
     # Create data structures that will contain relevant info
-    loc_dict = dict()  # Location-based non-calibration data.
     loc_idxs = dict()  # Dictionary containing idxs of columns belonging to non-cal data scans indexed by location
     cal_idxs = []  # List containing idxs of columns that have cal-data in them.
     standard_project_names = [] # List containing the standardized project name for each scan.
 
-    # Create a list for holding subsets of cdap data. First element of each row is a field name
-    empty_data = []   # Just call it 'empty_data' for now bc it doesn't have any data in it...
-    for row in data:
-        empty_data.append([row[0]])
-
-    # Prepare the cal data structure
-    cal_data = copy.deepcopy(empty_data)  # Just make a copy of the empty_data
-
-    # TODO can also have this separate cal scans & standardize projects & issue warning
-    # TODO just iterate over every col, instead of separating later. That way everything for a scan is available immediately.
-    num_scans = len(data[filename_idx][1:])
+    num_scans = len(view.headerdata['File Name'])
     for col_idx in range(1, num_scans + 1):
-        col_data = extract_col(col_idx, data)
-
         # Find the location of each rep
-        lat = col_data[lat_idx]
-        lon = col_data[lon_idx]
-        project = col_data[project_idx]
+        lat = view.value(key_dict['Latitude'], col_idx)
+        lon = view.value(key_dict['Longitude'], col_idx)
+        project = view.value(key_dict['Project'], col_idx)
         location, country, state, county = determine_loc(lat, lon, project)
         if location is None:
             location = 'Unknown'
@@ -152,61 +137,42 @@ def process_upwelling(data_dir, out_dir):
             county = 'Unknown'
 
         # Once we have the location, we can standardize this scan's project name.
-        col_data[project_idx] = standardize_project_name(project, location)
-        standard_project_names.append(col_data[project_idx])
+        project = standardize_project_name(project, location)
+        view.set_value(key_dict['Project'], col_idx, project)
+        standard_project_names.append(project)
 
         # Figure out if this is a cal scan
-        rep = col_data[rep_idx]
-        filename = col_data[filename_idx]
+        rep = view.value(key_dict['Replication'], col_idx)
+        filename = view.value('File Name', col_idx)
 
         if is_cal_rep(rep, filename):
             cal_idxs.append(col_idx)
 
             # Ensure the cal rep is appropriately named
-            col_data[rep_idx] = 'CAL'
-
-            # Add the column to the cal_data
-            for row_idx, row in enumerate(col_data):
-                cal_data[row_idx].append(row)
+            view.set_value(key_dict['Replication'], col_idx, 'CAL')
 
         else:
             # Current col is not a cal scan
-            if location in loc_idxs.keys():
+            if location in loc_idxs:
                 loc_idxs[location].append(col_idx)
-
-                # Extend the existing data list
-                for row_idx, row in enumerate(col_data):
-                    loc_dict[location][row_idx].append(row)
             else:
                 loc_idxs[location] = [col_idx]
 
-                # Create a new entry.
-                loc_list = copy.deepcopy(empty_data)
-                for row_idx, row in enumerate(col_data):
-                            loc_list[row_idx].append(row)
-
-                loc_dict[location] = loc_list
-                del loc_list
-
 
     # Now that every scan has been processed, deal with cal data first:
     # -----------------------------------------------------------------
     # -------------------------cal processing--------------------------
     # -----------------------------------------------------------------
     # Convert to dicts for ease of access
-    cal_dict, cal_scans, _ = data2dict(cal_data)
+    cal_view = view.select(cal_idxs)
+    cal_dict, _, _ = cal_view.data2dict()
 
     # Modify the datalogger entry: split datalogger values into respective fields
     if cal_dict[key_dict['Data Logger']]:
-        cal_dict = datalogger_to_dict(cal_dict, key_dict, data_dir)
+        cal_dict = datalogger_to_dict(cal_dict, key_dict, source_dir)
 
     # Create the calibration metadata dict
-    cal_meta = create_metadata_dict(cal_dict, key_dict, data_dir)
-
-    # Add instrument-specific meta to cal_meta.
-    cal_meta['Upwelling Instrument Max Wavelength'] = max(wavelengths)
-    cal_meta['Upwelling Instrument Min Wavelength'] = min(wavelengths)
-    cal_meta['Upwelling Instrument Channels'] = len(wavelengths)
+    cal_meta = create_metadata_dict(cal_dict, key_dict, source_dir)
 
     # Have the Target of cal data be the calibration panel
     cal_meta['Target'] = cal_meta['Calibration Panel']
@@ -217,52 +183,50 @@ def process_upwelling(data_dir, out_dir):
         cal_meta['Acquisition Software'] = 'CALMIT Data Acquisition Program (CDAP) 2'
 
     # Create the directory cal info will be stored in
-    cal_dir = os.path.join(out_dir, cal_meta['Date'], 'cal_data')
-    if not os.path.exists(cal_dir):
-        os.makedirs(cal_dir)
-    else:
+    cal_dir, conflict = plan_dataset_dir(out_dir, cal_meta['Date'], 'cal_data', cal_meta['Dataset ID'], publish_dir,
+                                         index)
+    if conflict:
         # We have an issue...There appears to already be cal data here.
         # For now, we will place cal data from each dataset into separate directories.
         # TODO possibly combine caldata into one file. Need to investigate this first.
-        cal_dir = create_dataset_dirs(cal_dir, cal_meta['Dataset ID'])
         warn_str = 'Another Calibration dataset with the same date was found. Placing data in {0}'.format(cal_dir)
         warnings.warn(warn_str)
         logging.warning(warn_str)
 
     cal_meta['out_dir'] = cal_dir
 
-    # Create the cal aux and scan files
+    # Create the cal aux file. Scan files are written together once every dataset's directory is known.
+    scan_files = []
     if cal_dict[key_dict['Replication']]:
         dataset_id = cal_meta['Dataset ID']
         create_aux_file(cal_dict, key_dict, other_keys, dataset_id, os.path.join(cal_dir, 'Auxiliary_Cal.csv'))
-        create_scan_file(cal_dict, key_dict, cal_scans, dataset_id, os.path.join(cal_dir, 'Upwelling_Cal_data.csv'))
+        scan_files.append((cal_dict, dataset_id, os.path.join(cal_dir, 'Upwelling_Cal_data.csv'), cal_view.idxs))
 
     # Now process each location-specific non-cal data
     # -----------------------------------------------------------------
     # -----------------------non-cal processing------------------------
     # -----------------------------------------------------------------
     loc_meta = dict()
-    for loc in loc_dict.keys():
-        # Load the data for the location, and convert to a dictionary for easy-access.
-        data = loc_dict[loc]
+    for loc in loc_idxs.keys():
+        # Select the location's scans.
+        loc_view = view.select(loc_idxs[loc])
 
-        # Put the caldata in a separate list
-        reps = data[fields.index(key_dict['Replication'])][1:]
-        raw_filenames = data[fields.index('File Name')][1:]
+        # Put the caldata in a separate view
+        reps = loc_view.row(key_dict['Replication'])
+        raw_filenames = loc_view.row('File Name')
         loc_cal_idxs = find_cal_reps(reps, raw_filenames)
 
-        #cal_data, scan_data = split_cal_scans(data, cal_idxs[loc])
-        _, scan_data = split_cal_scans(data, loc_cal_idxs)
+        _, scan_view = loc_view.split(loc_cal_idxs)
 
         # Convert to dicts for ease of access
-        data_dict, data_scans, _ = data2dict(scan_data)
+        data_dict, _, _ = scan_view.data2dict()
 
         # Modify the datalogger entry: split datalogger values into respective fields
         if data_dict[key_dict['Data Logger']]:
-            data_dict = datalogger_to_dict(data_dict, key_dict, data_dir)
+            data_dict = datalogger_to_dict(data_dict, key_dict, source_dir)
 
         # Construct the metadata for this location.
-        loc_meta[loc] = create_metadata_dict(data_dict, key_dict, data_dir)
+        loc_meta[loc] = create_metadata_dict(data_dict, key_dict, source_dir)
         loc_meta[loc]['Location'] = loc
         loc_meta[loc]['County'] = county
         loc_meta[loc]['State'] = state
@@ -271,23 +235,16 @@ def process_upwelling(data_dir, out_dir):
             # We know it's outside.
             loc_meta[loc]['Illumination Source'] = 'Sun'
 
-        # Add instrument-specific entries to loc_meta
-        loc_meta[loc]['Upwelling Instrument Max Wavelength'] = max(wavelengths)
-        loc_meta[loc]['Upwelling Instrument Min Wavelength'] = min(wavelengths)
-        loc_meta[loc]['Upwelling Instrument Channels'] = len(wavelengths)
-
         if cdap2 is False:
             loc_meta[loc]['Acquisition Software'] = 'CALMIT Data Acquisition Program (CDAP)'
         else:
             loc_meta[loc]['Acquisition Software'] = 'CALMIT Data Acquisition Program (CDAP) 2'
 
         # Construct a directory to put the restructured data in. (ou_dir/location/date/)
-        loc_dir = os.path.join(out_dir, data_dict[key_dict['Date']][0], loc)
-        if not os.path.exists(loc_dir):
-            os.makedirs(loc_dir)
-        else:
+        loc_dir, conflict = plan_dataset_dir(out_dir, data_dict[key_dict['Date']][0], loc, loc_meta[loc]['Dataset ID'],
+                                             publish_dir, index)
+        if conflict:
             # We have a problem. This probably means there is more than one project per loc/date combo.
-            loc_dir = create_dataset_dirs(loc_dir, loc_meta[loc]['Dataset ID'])
             warn_str = 'Another dataset with the same location/date was found. Placing data in {0}'.format(loc_dir)
             warnings.warn(warn_str)
             logging.warning(warn_str)
@@ -298,11 +255,30 @@ def process_upwelling(data_dir, out_dir):
         dataset_id = loc_meta[loc]['Dataset ID']
         if data_dict[key_dict['Replication']]:
             create_aux_file(data_dict, key_dict, other_keys, dataset_id, os.path.join(loc_dir, 'Auxiliary.csv'))
-            create_scan_file(data_dict, key_dict, data_scans, dataset_id, os.path.join(loc_dir, 'Upwelling_data.csv'))
+            scan_files.append((data_dict, dataset_id, os.path.join(loc_dir, 'Upwelling_data.csv'), scan_view.idxs))
+
+    # Write the scan rows to the cal and location scan files in one pass.
+    create_scan_files(scan_files, key_dict, rows)
+
+    if dark_correct:
+        dc_files = [(data_dict, dataset_id, re.sub(r'_data\.csv$', '_DC_corrected_data.csv', path), idxs)
+                    for data_dict, dataset_id, path, idxs in scan_files]
+        create_scan_files(dc_files, key_dict, dark_corrected_scan_rows(view, upwelling_paths, streaming))
+
+    # Add instrument-specific meta. In streaming mode the wavelengths are known once the scan rows have been read.
+    if grids is None:
+        grids = default_registry
+    grid, min_wavelength, max_wavelength, channels = grids.grid_info(scan_keys)
+    for meta_dict in [cal_meta] + loc_meta.values():
+        meta_dict['Upwelling Instrument Max Wavelength'] = max_wavelength
+        meta_dict['Upwelling Instrument Min Wavelength'] = min_wavelength
+        meta_dict['Upwelling Instrument Channels'] = channels
+        meta_dict['Upwelling Wavelength Grid'] = grid
 
     # Create raw scandata files if raw data files exist
     if raw_upwelling_files:
-        create_raw_scans_files(raw_upwelling_files, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, 'Upwelling')
+        create_raw_scans_files(raw_upwelling_files, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, 'Upwelling',
+                               streaming=streaming)
 
     # Return the metadata dict and key_dict
     return cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, standard_project_names
@@ -310,7 +286,60 @@ def process_upwelling(data_dir, out_dir):
     # TODO Also return info on location directory paths w/ loc & reps so other files can be moved.
 
 
-def process_downwelling(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, standardized_project_names):
+def load_cdap_view(file_paths, streaming=False):
+    """
+    Loads CDAP file(s) for processing.
+
+    Parameters:
+        file_paths - List of paths to the file's parts, in order.
+        streaming=False - Boolean. Only read the header rows now (see process_upwelling).
+
+    Returns:
+        view - DataView of every scan. In streaming mode it only holds the header rows.
+        rows - Iterator over the scan rows, e.g., for create_scan_files().
+        scan_keys - List of the scan row labels. In streaming mode it is filled in as rows is consumed.
+    """
+    if streaming:
+        header, rows = split_header(iter_multipart_rows(file_paths))
+        view = DataView.from_data(header, fix_dc_scans=False)
+        scan_keys = []
+        rows = stream_scan_rows(rows, fields=scan_keys)
+    else:
+        data = read_multipart(file_paths)
+        fields = getFields(data)
+        scan_keys = fields[findScanIdx(fields):]
+
+        # Parse the data once. Cal and location subsets are views over the same data, so nothing is copied until the
+        #   output files are written.
+        view = DataView.from_data(data)
+        rows = scan_rows(view.labels, view.spectra)
+
+    return view, rows, scan_keys
+
+
+def dark_corrected_scan_rows(view, file_paths, streaming=False):
+    """
+    Dark-corrects the scan rows of CDAP file(s) loaded with load_cdap_view (see spectra.dark_correct).
+
+    Parameters:
+        view - DataView of the file(s). Unless streaming, its parsed scan block is corrected in one array operation.
+        file_paths - List of paths to the file's parts, in order.
+        streaming=False - Boolean. The view only holds the header rows, so the scan rows are streamed from the files
+            again and corrected as they are read.
+
+    Returns:
+        rows - Iterator over the corrected spectral rows (wavelength label followed by the values of every scan).
+    """
+    if streaming:
+        _, rows = split_header(iter_multipart_rows(file_paths))
+        return spectra.dark_corrected_rows(stream_scan_rows(rows))
+
+    labels, corrected, _ = spectra.dark_correct(view.labels, view.spectra)
+    return ([label] + spectra.format_values(values) for label, values in zip(labels, corrected))
+
+
+def process_downwelling(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, standardized_project_names,
+                        streaming=False, grids=None, dark_correct=False):
     """
     Processes the upwelling file(s) in a CDAP data directory.
 
@@ -322,6 +351,11 @@ def process_downwelling(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_di
         loc_meta - Dict. From process_upwelling
         cal_meta - Dict. From process_upwelling
         key_dict - Dict. From process_upwelling
+        standardized_project_names - List. From process_upwelling
+        streaming=False - Boolean. Stream the scan rows to the output files (see process_upwelling).
+        grids=None - GridRegistry (see process_upwelling).
+        dark_correct=False - Boolean. Also write dark-current corrected scan files, e.g.
+            Downwelling_DC_corrected_data.csv (see process_upwelling).
 
     Returns:
         - A dictionary (?) mapping CDAP file fields to their locations and standardized names (so other files don't have
@@ -346,7 +380,8 @@ def process_downwelling(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_di
         raw_pattern = r'Raw Incoming.*\.txt'
         raw_downwelling_files = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if re.search(raw_pattern, f)]
     if raw_downwelling_files:
-        create_raw_scans_files(raw_downwelling_files, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, 'Downwelling')
+        create_raw_scans_files(raw_downwelling_files, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, 'Downwelling',
+                               streaming=streaming)
 
     if not downwelling_files:
         if raw_downwelling_files:
@@ -362,35 +397,22 @@ def process_downwelling(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_di
             return
 
     # Load the file(s). If more than one, join into one data structure for easy access.
-    first = True
-    for downwelling_file in downwelling_files:
-        if first:
-            data = readData(os.path.join(data_dir, downwelling_file))
-            first = False
-        else:
-            odata = readData(os.path.join(data_dir, downwelling_file))
-            for idx, row in enumerate(odata):
-                data[idx].extend(row[1:])
-
-            del odata
-
-    # Get the fields of the data
-    fields = getFields(data)
-    scanidx = findScanIdx(fields)
+    downwelling_paths = [os.path.join(data_dir, f) for f in downwelling_files]
+    view, rows, scan_keys = load_cdap_view(downwelling_paths, streaming)
 
     # Standardize the project names
-    data[fields.index(key_dict['Project'])][1:] = standardized_project_names
+    view.set_row(key_dict['Project'], standardized_project_names)
 
     # Deal with cal data first
-    cal_data, _ = split_cal_scans(data, cal_idxs)
-    cal_dict, cal_scans, _ = data2dict(cal_data)
+    cal_view, _ = view.split(cal_idxs)
+    cal_dict, _, _ = cal_view.data2dict()
 
     cal_dir = cal_meta['out_dir']
     dataset_id = cal_meta['Dataset ID']
 
+    scan_files = []
     if cal_dict[key_dict['Replication']]:
-            create_scan_file(cal_dict, key_dict, cal_scans, dataset_id,
-                             os.path.join(cal_dir, 'Downwelling_Cal_data.csv'))
+        scan_files.append((cal_dict, dataset_id, os.path.join(cal_dir, 'Downwelling_Cal_data.csv'), cal_view.idxs))
 
     # Update the metadata
     instrument_str = cal_dict[key_dict['Instrument']][0]
@@ -398,39 +420,27 @@ def process_downwelling(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_di
     cal_meta['Downwelling Instrument Name'] = instrument_name
     cal_meta['Downwelling Instrument Serial Number'] = snumber
     cal_meta['Downwelling Instrument FOV'] = fov
-    # Add instrument-specific entries to loc_meta.
-    # Create a list of just the wavelengths
-    scan_keys = fields[scanidx:]
-    # Get only those that are actual wavelength numbers
-    wavelengths = filter_floats(scan_keys)
-    cal_meta['Downwelling Instrument Max Wavelength'] = max(wavelengths)
-    cal_meta['Downwelling Instrument Min Wavelength'] = min(wavelengths)
-    cal_meta['Downwelling Instrument Channels'] = len(wavelengths)
-
-    # Write the new metadata entry
-    create_metadata_file(cal_meta, os.path.join(cal_dir, 'Metadata.csv'))
 
     # Split the data into locations
     for loc in loc_idxs.keys():
-        loc_data = split_by_idxs(data, loc_idxs[loc])
+        loc_view = view.select(loc_idxs[loc])
 
-        reps = loc_data[fields.index(key_dict['Replication'])][1:]
-        raw_filenames = loc_data[fields.index('File Name')][1:]
+        reps = loc_view.row(key_dict['Replication'])
+        raw_filenames = loc_view.row('File Name')
         loc_cal_idxs = find_cal_reps(reps, raw_filenames)
 
         # Now split each location's data into scan and cal data.
-        _, scan_data = split_cal_scans(loc_data, loc_cal_idxs)
+        _, scan_view = loc_view.split(loc_cal_idxs)
 
         # Create the data dicts
-        data_dict, data_scans, _ = data2dict(scan_data)
+        data_dict, _, _ = scan_view.data2dict()
 
         # Save the scandata files
         loc_dir = loc_meta[loc]['out_dir']
         dataset_id = loc_meta[loc]['Dataset ID']
 
         if data_dict[key_dict['Replication']]:
-            create_scan_file(data_dict, key_dict, data_scans, dataset_id,
-                             os.path.join(loc_dir, 'Downwelling_data.csv'))
+            scan_files.append((data_dict, dataset_id, os.path.join(loc_dir, 'Downwelling_data.csv'), scan_view.idxs))
 
         # Update the metadata
         instrument_str = data_dict[key_dict['Instrument']][0]
@@ -438,16 +448,34 @@ def process_downwelling(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_di
         loc_meta[loc]['Downwelling Instrument Name'] = instrument_name
         loc_meta[loc]['Downwelling Instrument Serial Number'] = snumber
         loc_meta[loc]['Downwelling Instrument FOV'] = fov
-        # Add instrument-specific entries to loc_meta.
-        loc_meta[loc]['Downwelling Instrument Max Wavelength'] = max(wavelengths)
-        loc_meta[loc]['Downwelling Instrument Min Wavelength'] = min(wavelengths)
-        loc_meta[loc]['Downwelling Instrument Channels'] = len(wavelengths)
 
-        # Write the new metadata entry
-        create_metadata_file(loc_meta[loc], os.path.join(loc_dir, 'Metadata.csv'))
+    # Write the scan rows to the cal and location scan files in one pass.
+    create_scan_files(scan_files, key_dict, rows)
+
+    if dark_correct:
+        dc_files = [(data_dict, dataset_id, re.sub(r'_data\.csv$', '_DC_corrected_data.csv', path), idxs)
+                    for data_dict, dataset_id, path, idxs in scan_files]
+        create_scan_files(dc_files, key_dict, dark_corrected_scan_rows(view, downwelling_paths, streaming))
+
+    # Add instrument-specific entries to the metadata. In streaming mode the wavelengths are known once the scan rows
+    #   have been read.
+    if grids is None:
+        grids = default_registry
+    grid, min_wavelength, max_wavelength, channels = grids.grid_info(scan_keys)
+    for meta_dict in [cal_meta] + loc_meta.values():
+        meta_dict['Downwelling Instrument Max Wavelength'] = max_wavelength
+        meta_dict['Downwelling Instrument Min Wavelength'] = min_wavelength
+        meta_dict['Downwelling Instrument Channels'] = channels
+        meta_dict['Downwelling Wavelength Grid'] = grid
+
+    # Write the new metadata entries
+    create_metadata_file(cal_meta, os.path.join(cal_dir, 'Metadata.csv'))
+    for loc in loc_idxs.keys():
+        create_metadata_file(loc_meta[loc], os.path.join(loc_meta[loc]['out_dir'], 'Metadata.csv'))
 
 
-def process_reflectance(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, standardized_project_names):
+def process_reflectance(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, standardized_project_names,
+                        streaming=False):
     # Find CDAP downwelling files in the data directory
     ref_pattern = r'^Reflectance.*\.txt'
     ref_files = [f for f in os.listdir(data_dir) if re.search(ref_pattern, f)]
@@ -455,53 +483,45 @@ def process_reflectance(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_di
         ref_files.sort()  # Sort the files so *Data01.txt is first
 
         # Load the file(s). If more than one, join into one data structure for easy access.
-        first = True
-        for ref_file in ref_files:
-            if first:
-                data = readData(os.path.join(data_dir, ref_file))
-                first = False
-            else:
-                odata = readData(os.path.join(data_dir, ref_file))
-                for idx, row in enumerate(odata):
-                    data[idx].extend(row[1:])
-
-                del odata
+        view, rows, _ = load_cdap_view([os.path.join(data_dir, f) for f in ref_files], streaming)
 
-        fields = getFields(data)
         # Standardize the project names
-        data[fields.index(key_dict['Project'])][1:] = standardized_project_names
+        view.set_row(key_dict['Project'], standardized_project_names)
 
         # Deal with cal data first.
-        cal_data, _ = split_cal_scans(data, cal_idxs)
-        cal_dict, cal_scans, _ = data2dict(cal_data)
+        cal_view, _ = view.split(cal_idxs)
+        cal_dict, _, _ = cal_view.data2dict()
 
         dataset_id = cal_meta['Dataset ID']
         cal_dir = cal_meta['out_dir']
+        scan_files = []
         if cal_dict[key_dict['Replication']]:
-            create_scan_file(cal_dict, key_dict, cal_scans, dataset_id,
-                             os.path.join(cal_dir, 'Reflectance_Cal_data.csv'))
+            scan_files.append((cal_dict, dataset_id, os.path.join(cal_dir, 'Reflectance_Cal_data.csv'),
+                               cal_view.idxs))
 
         # Split the data into locations
         for loc in loc_idxs.keys():
-            loc_data = split_by_idxs(data, loc_idxs[loc])
+            loc_view = view.select(loc_idxs[loc])
 
             # Now split each location's data into scan and cal data.
-            reps = loc_data[fields.index(key_dict['Replication'])][1:]
-            raw_filenames = loc_data[fields.index('File Name')][1:]
+            reps = loc_view.row(key_dict['Replication'])
+            raw_filenames = loc_view.row('File Name')
             loc_cal_idxs = find_cal_reps(reps, raw_filenames)
 
-            _, scan_data = split_cal_scans(loc_data, loc_cal_idxs)
+            _, scan_view = loc_view.split(loc_cal_idxs)
 
             # Create the data dicts
-            data_dict, data_scans, _ = data2dict(scan_data)
+            data_dict, _, _ = scan_view.data2dict()
 
             # Save the scandata files
             loc_dir = loc_meta[loc]['out_dir']
             dataset_id = loc_meta[loc]['Dataset ID']
 
             if data_dict[key_dict['Replication']]:
-                create_scan_file(data_dict, key_dict, data_scans, dataset_id,
-                                 os.path.join(loc_dir, 'Reflectance_data.csv'))
+                scan_files.append((data_dict, dataset_id, os.path.join(loc_dir, 'Reflectance_data.csv'),
+                                   scan_view.idxs))
+
+        create_scan_files(scan_files, key_dict, rows)
 
 
 def test_split():
@@ -576,7 +596,191 @@ def find_datafiles(years, processing_dir='/media/sf_tmp/processing_lists/'):
                         savefile.write(root + '\n')
 
 
-def process_years(years, processing_dir='/media/sf_tmp/processing_lists/', process_errors=False):
+def queue_metadata(metadata_writer, cal_meta, loc_meta):
+    """
+    Queues the metadata of a processed directory's datasets for loading into the database.
+
+    Parameters:
+        metadata_writer - MetadataWriter (from metadata_to_db)
+        cal_meta - Dict. From process_upwelling.
+        loc_meta - Dict. From process_upwelling.
+    """
+    for meta_dict in [cal_meta] + loc_meta.values():
+        # Datasets without a metadata file wouldn't be loaded by a separate pass either.
+        if os.path.exists(os.path.join(meta_dict['out_dir'], 'Metadata.csv')):
+            metadata_writer.put(meta_dict)
+
+
+def process_directory(data_dir, out_dir, streaming=False, publish_dir=None, index=None, xls_cache_dir=None,
+                      dark_correct=False, grid_dir=None, source_dir=None):
+    """
+    Restructures one CDAP data directory.
+
+    Parameters:
+        data_dir - String. Path to CDAP data directory.
+        out_dir - String. Path to store reorganized data.
+        streaming=False - Boolean. See process_upwelling.
+        publish_dir=None - String. See process_upwelling.
+        index=None - DatasetIndex. See process_upwelling.
+        xls_cache_dir=None - String. See process_otherfiles.
+        dark_correct=False - Boolean. See process_upwelling and process_downwelling.
+        grid_dir=None - String. Directory of the GridRegistry the wavelength grids are registered with (see
+            grids.registry). None keeps them in memory only.
+        source_dir=None - String. If data_dir is a local copy of the data directory (see prefetch.py), the original
+            directory.
+
+    Returns:
+        cal_meta, loc_meta - Metadata of the directory's cal and location datasets. None if the directory has no
+            upwelling files.
+    """
+    grids = registry(grid_dir)
+    cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, standard_project_names = process_upwelling(
+        data_dir, out_dir, streaming, publish_dir, index, dark_correct, grids, source_dir)
+    if cal_idxs is None:
+        return None, None
+
+    process_otherfiles(data_dir, cal_meta, loc_meta, xls_cache_dir, source_dir)
+    process_downwelling(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, standard_project_names,
+                        streaming, grids, dark_correct)
+    process_reflectance(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, standard_project_names,
+                        streaming)
+
+    return cal_meta, loc_meta
+
+
+def _reset_logging_locks():
+    """
+    Replaces the logging module's locks with new ones. Called in forked workers: another thread of the parent (e.g., the
+    MetadataWriter or the DirectoryPrefetcher) may have held one while forking, and it would never be released in the
+    child. Python 2 has no spawn or forkserver start method to avoid this.
+    """
+    logging._lock = threading.RLock()
+    handlers = list(logging.getLogger().handlers)
+    for logger in logging.Logger.manager.loggerDict.values():
+        handlers.extend(getattr(logger, 'handlers', []))
+    for handler in handlers:
+        handler.createLock()
+
+
+def _directory_worker(results, data_dir, out_dir, streaming, publish_dir, index, xls_cache_dir, dark_correct,
+                      grid_dir, source_dir, max_memory):
+    """
+    Runs process_directory in a worker process (see run_directory) and sends the outcome, and the instrument strings
+    the worker didn't recognize, through results.
+    """
+    _reset_logging_locks()
+    if max_memory is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+    try:
+        results.send(('ok', process_directory(data_dir, out_dir, streaming, publish_dir, index, xls_cache_dir,
+                                              dark_correct, grid_dir, source_dir), instruments.unrecognized.keys()))
+    except MemoryError:
+        results.send(('memory', traceback.format_exc(), instruments.unrecognized.keys()))
+    except Exception:
+        results.send(('error', traceback.format_exc(), instruments.unrecognized.keys()))
+
+
+def run_directory(data_dir, out_dir, streaming=False, publish_dir=None, index=None, xls_cache_dir=None,
+                  dark_correct=False, grid_dir=None, max_memory=None, timeout=None, unrecognized=None,
+                  source_dir=None):
+    """
+    Runs process_directory in a separate process, so that a directory that runs out of memory or hangs cannot take the
+    whole run down with it.
+
+    Parameters:
+        data_dir, out_dir, streaming, publish_dir, index, xls_cache_dir, dark_correct, grid_dir - See
+            process_directory.
+        max_memory=None - Int. Address space limit of the worker process, in bytes.
+        timeout=None - Number. Seconds after which the worker is stopped.
+        unrecognized=None - Set. The instrument strings the worker didn't recognize are added to it (see
+            instruments.py).
+        source_dir=None - String. See process_directory.
+
+    Returns:
+        status - String. 'ok', 'error' (an exception was raised), 'memory' (the memory limit was reached, or the worker
+            was killed) or 'timeout'.
+        result - (cal_meta, loc_meta) if status is 'ok'. Otherwise the traceback of the error, if there is one.
+    """
+    # A pipe rather than a Queue: a Queue needs a feeder thread, which can't be started near the memory limit.
+    results, worker_results = multiprocessing.Pipe(duplex=False)
+    worker = multiprocessing.Process(target=_directory_worker,
+                                     args=(worker_results, data_dir, out_dir, streaming, publish_dir, index,
+                                           xls_cache_dir, dark_correct, grid_dir, source_dir, max_memory))
+    start = time.time()
+    status = None
+    worker.start()
+    try:
+        while True:
+            # Get the outcome before joining, so a large result can't block the worker on exit.
+            if results.poll(1):
+                status, result, worker_unrecognized = results.recv()
+                if unrecognized is not None:
+                    unrecognized.update(worker_unrecognized)
+                break
+            if not worker.is_alive():
+                # The worker may have sent its outcome and exited since the last poll.
+                if results.poll(0):
+                    continue
+                # The worker died without reporting, e.g., killed by the OOM killer.
+                status, result = 'memory', 'Worker exited with code {0}'.format(worker.exitcode)
+                break
+            if timeout is not None and time.time() - start > timeout:
+                status, result = 'timeout', None
+                break
+    finally:
+        if worker.is_alive() and status in {None, 'timeout'}:
+            worker.terminate()
+        worker.join()
+
+    return status, result
+
+
+def cdap_files_size(data_dir):
+    """Returns the total size, in bytes, of the CDAP data files (*.txt) in a data directory."""
+    return sum([os.path.getsize(os.path.join(data_dir, f)) for f in os.listdir(data_dir) if f.endswith('.txt')])
+
+
+def process_years(years, processing_dir='/media/sf_tmp/processing_lists/', process_errors=False, dbpath=None,
+                  max_memory=None, timeout=None, streaming_size=None, staging_root=None,
+                  xls_cache_dir='/media/sf_tmp/xls_log_cache/', dark_correct=False, prefetch=True,
+                  prefetch_images=False, prefetch_max_bytes=2 ** 30):
+    """
+    Restructures the data directories listed for each year (see find_datafiles).
+
+    Each directory is processed in its own worker process (see run_directory). A directory that runs out of memory is
+    retried in streaming mode; if that fails too, or the directory times out, it is quarantined and listed in the
+    year's quarantine_list.txt. Directories that raise an error are listed in error_list.txt.
+
+    Each directory is restructured into its own staging directory (see staging.py). Its datasets are published to the
+    output directory only once the directory succeeds; otherwise the staging directory is simply discarded. Published
+    datasets are recorded in the output directory's DatasetIndex, which places later datasets with the same date and
+    location.
+
+    Parameters:
+        years - List of years to process.
+        processing_dir - String. Directory containing the per-year directory lists.
+        process_errors=False - Boolean. Process each year's error_list.txt instead of its master_list.txt.
+        dbpath=None - String. Path to an initialized metadata database (see initDb.py). If given, each directory's
+            datasets are loaded into it by a MetadataWriter as soon as the directory is done, so the database is ready
+            when restructuring finishes.
+        max_memory=None - Int. Memory (address space) limit for each directory, in bytes.
+        timeout=None - Number. Time limit for each directory, in seconds.
+        streaming_size=None - Int. Directories whose CDAP files total more than this many bytes are processed in
+            streaming mode from the start.
+        staging_root=None - String. Local directory to stage outputs in. Defaults to the system's temporary directory.
+        xls_cache_dir - String. Cache directory for parsed .xls logs (see read_xls_log). None disables the cache.
+        dark_correct=False - Boolean. Also write dark-current corrected upwelling and downwelling scan files (see
+            process_upwelling).
+        prefetch=True - Boolean. Copy the next data directory to staging_root while one is processed (see
+            prefetch.py), so reading the network share overlaps with processing.
+        prefetch_images=False - Boolean. Also prefetch images. Otherwise they are copied from the share.
+        prefetch_max_bytes=2 ** 30 - Int. Directories with more bytes to copy than this are read from the share, so the
+            local copies never take more than about twice this. None prefetches every directory.
+
+    Instrument strings that aren't in instruments.json don't stop a directory. They are collected over the whole run
+    and listed, with the directories they were found in, in processing_dir/unrecognized_instruments.txt.
+    """
     out_dir = '/media/sf_tmp/restruct2/'
     if not os.path.exists(processing_dir):
         raise RuntimeError('Processing directory {0} not found!'.format(processing_dir))
@@ -588,77 +792,148 @@ def process_years(years, processing_dir='/media/sf_tmp/processing_lists/', proce
     logging.basicConfig(filename=os.path.join(out_dir,'error_log.txt'),
                         format='%(levelname)s: %(message)s',level=logging.ERROR)
 
-    for year in years:
-        year = str(year)
-        logging.info('Processing year {0}. Started {1}'.format(year, time.strftime('%d/%m/%Y at %H:%M:%S')))
+    # Existing datasets by date and location, for placing new ones.
+    index = DatasetIndex.load(out_dir)
 
-        if process_errors:
-            master_list_file = os.path.join(processing_dir, year, 'error_list.txt')
-        else:
-            master_list_file = os.path.join(processing_dir, year, 'master_list.txt')
-        if not os.path.exists(master_list_file):
-            warnings.warn('A filepaths file was not found for {0}'.format(year))
-            continue
-        with open(master_list_file, 'r') as datadirs_file:
-            # Process each dir for that year.
-            data_dirs = datadirs_file.readlines()
-
-        err_list = []  # maintain a list of directories that failed processing.
-        for data_dir in data_dirs:
-            data_dir = data_dir.strip('\n')
-            # Now process the data
-            try:
-                cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, standard_project_names = process_upwelling(
-                    data_dir, out_dir)
-                process_otherfiles(data_dir, cal_meta, loc_meta)
-                if cal_idxs is None:
-                    print('Problem with {0} !'.format(data_dir))
-                else:
-                    process_downwelling(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict,
-                                        standard_project_names)
-                    process_reflectance(data_dir, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict,
-                                        standard_project_names)
-
-                # Save completed files to a 'completed files list'
-                with open(os.path.join(processing_dir, year, 'completed.txt'), 'a') as completed_file:
-                    completed_file.write(data_dir + '\n')
-
-            except Exception, e:
-                # Log that the error occured
-                problem_str = 'PROBLEM PROCESSING {0}! Exception:\n {1} \n'\
-                              '-------------------------------------------------------------'\
-                              '\n'.format(data_dir, traceback.format_exc())
-
-                logging.error(problem_str)
-                warnings.warn(problem_str)
-
-                err_list.append(data_dir)
-
-                # Cleanup
-                # Remove all the location directories
-                for loc in loc_meta.keys():
-                    del_out_dir = loc_meta[loc]['out_dir']
-                    print('Cleaning up {0}'.format(del_out_dir))
-                    shutil.rmtree(del_out_dir)
-
-                # Remove the cal dir
-                del_cal_dir = cal_meta['out_dir']
-                shutil.rmtree(del_cal_dir)
-
-                # Now back up to the 'base' directory.
-                cal_dir_list = split_path(del_cal_dir)
-                del_dir = '/'
-                for i in range(len(cal_dir_list) - 1):
-                    del_dir = os.path.join(del_dir, cal_dir_list[i])
-
-                # If there's nothing left in the 'base' directory, remove it.
-                if os.path.isdir(del_dir) and not os.listdir(del_dir):
-                    shutil.rmtree(del_dir)
-
-        # Save the offending directory to a file
-        if err_list:
-            # We'll re-write this file each time, to ensure that it contains the most recent errors.
-            with open(os.path.join(processing_dir, year, 'error_list.txt'), 'w') as error_file:
-                error_file.write(data_dir + '\n')
+    # Each distinct wavelength grid is stored once, in the output directory.
+    grid_dir = os.path.join(out_dir, 'wavelength_grids')
+
+    if dbpath is not None:
+        metadata_writer = MetadataWriter(dbpath, grid_dir=grid_dir)
+        metadata_writer.start()
+    else:
+        metadata_writer = None
+
+    # Unrecognized instrument string -> data directories it was found in.
+    instrument_dirs = dict()
+
+    prefetcher = None
+    try:
+        for year in years:
+            year = str(year)
+            logging.info('Processing year {0}. Started {1}'.format(year, time.strftime('%d/%m/%Y at %H:%M:%S')))
+
+            if process_errors:
+                master_list_file = os.path.join(processing_dir, year, 'error_list.txt')
+            else:
+                master_list_file = os.path.join(processing_dir, year, 'master_list.txt')
+            if not os.path.exists(master_list_file):
+                warnings.warn('A filepaths file was not found for {0}'.format(year))
+                continue
+            with open(master_list_file, 'r') as datadirs_file:
+                # Process each dir for that year.
+                data_dirs = datadirs_file.readlines()
+
+            data_dirs = [data_dir.strip('\n') for data_dir in data_dirs]
+            if prefetch:
+                prefetcher = DirectoryPrefetcher(data_dirs, staging_root, max_bytes=prefetch_max_bytes,
+                                                 images=prefetch_images)
+                prefetcher.start()
+
+            err_list = []  # maintain a list of directories that failed processing.
+            quarantine_list = []  # Directories that exceeded the memory or time limits.
+            for data_dir in data_dirs:
+                try:
+                    # Read the directory's local copy, if it was prefetched.
+                    read_dir = prefetcher.get(data_dir) if prefetcher is not None else None
+                    if read_dir is None:
+                        read_dir = data_dir
+
+                    # Now process the data
+                    streaming = streaming_size is not None and cdap_files_size(read_dir) > streaming_size
+                    staging_dir = create_staging_dir(staging_root)
+                    dir_instruments = set()
+                    status, result = run_directory(read_dir, staging_dir, streaming, out_dir, index, xls_cache_dir,
+                                                   dark_correct, grid_dir, max_memory, timeout, dir_instruments,
+                                                   data_dir)
+                    if status == 'memory' and not streaming:
+                        # Discard the partial outputs and retry with only the header rows in memory.
+                        logging.warning('Out of memory processing {0}. Retrying in streaming mode.'.format(data_dir))
+                        discard_staging_dir(staging_dir)
+                        staging_dir = create_staging_dir(staging_root)
+                        status, result = run_directory(read_dir, staging_dir, True, out_dir, index, xls_cache_dir,
+                                                       dark_correct, grid_dir, max_memory, timeout, dir_instruments,
+                                                       data_dir)
+
+                    for instrument_str in dir_instruments:
+                        instrument_dirs.setdefault(instrument_str, []).append(data_dir)
+
+                    if status == 'ok':
+                        cal_meta, loc_meta = result
+                        if cal_meta is None:
+                            print('Problem with {0} !'.format(data_dir))
+                            discard_staging_dir(staging_dir)
+                        else:
+                            # The directory's datasets are complete. Publish them, then load their metadata.
+                            try:
+                                publish(staging_dir, out_dir, [cal_meta] + loc_meta.values())
+                            except Exception:
+                                status, result = 'error', traceback.format_exc()
+                            else:
+                                for meta_dict in [cal_meta] + loc_meta.values():
+                                    index.add_published(meta_dict)
+
+                                if metadata_writer is not None:
+                                    queue_metadata(metadata_writer, cal_meta, loc_meta)
+
+                    if status == 'ok':
+
+                        # Save completed files to a 'completed files list'
+                        with open(os.path.join(processing_dir, year, 'completed.txt'), 'a') as completed_file:
+                            completed_file.write(data_dir + '\n')
+                    else:
+                        # Log that the error occured
+                        if status == 'error':
+                            problem_str = 'PROBLEM PROCESSING {0}! Exception:\n {1} \n'\
+                                          '-------------------------------------------------------------'\
+                                          '\n'.format(data_dir, result)
+                            err_list.append(data_dir)
+                        else:
+                            problem_str = 'QUARANTINED {0}! Exceeded the {1} limit. {2}\n'\
+                                          '-------------------------------------------------------------'\
+                                          '\n'.format(data_dir, status, result or '')
+                            quarantine_list.append(data_dir)
+
+                        logging.error(problem_str)
+                        warnings.warn(problem_str)
+
+                        # Cleanup
+                        discard_staging_dir(staging_dir)
+                finally:
+                    # Remove the local copy, even if the directory stopped the run.
+                    if prefetcher is not None:
+                        prefetcher.release(data_dir)
+
+            if prefetcher is not None:
+                prefetcher.close()
+                prefetcher = None
+
+            # Datasets published during the year are in the index's journal until then.
+            index.save()
+
+            # Save the offending directories to a file
+            # We'll re-write these files each time, to ensure that they contain the most recent errors.
+            if err_list:
+                with open(os.path.join(processing_dir, year, 'error_list.txt'), 'w') as error_file:
+                    for err_dir in err_list:
+                        error_file.write(err_dir + '\n')
+            if quarantine_list:
+                with open(os.path.join(processing_dir, year, 'quarantine_list.txt'), 'w') as quarantine_file:
+                    for quarantine_dir in quarantine_list:
+                        quarantine_file.write(quarantine_dir + '\n')
+    finally:
+        # Stop prefetching and remove the local copies.
+        if prefetcher is not None:
+            prefetcher.close()
+        # Load everything queued so far, even if the run stopped on an error.
+        if metadata_writer is not None:
+            metadata_writer.close()
+
+    if instrument_dirs:
+        report_path = os.path.join(processing_dir, 'unrecognized_instruments.txt')
+        instruments.write_unrecognized_report(report_path, instrument_dirs)
+        warn_str = '{0} unrecognized instrument strings, see {1}'.format(len(instrument_dirs), report_path)
+        logging.warning(warn_str)
+        warnings.warn(warn_str)
 
     logging.shutdown()
@@ -0,0 +1,182 @@
+"""
+Simulation of multispectral sensor bands from restructured hyperspectral scans.
+
+Each target sensor's bands are described by a response table. A response matrix (bands x wavelengths) is built once
+per (wavelength grid, sensor) pair, cached in memory and optionally on disk keyed by the grid's ID (see grids.py), and
+applied to every scan of a dataset as one matrix multiply.
+"""
+
+import os
+import tempfile
+import numpy as np
+from utility import create_scan_file
+from grids import grid_id
+from spectra import read_spectra, format_values
+from dataset_index import DatasetIndex, map_datasets
+
+# Band passes (name, lower edge, upper edge in nm) of each sensor, treated as boxcar responses. Edges are from the
+# sensors' published band specifications.
+SENSOR_BANDS = {
+    'Landsat8_OLI': [('B1', 433., 453.), ('B2', 450., 515.), ('B3', 525., 600.), ('B4', 630., 680.),
+                     ('B5', 845., 885.), ('B6', 1560., 1660.), ('B7', 2100., 2300.), ('B8', 500., 680.),
+                     ('B9', 1360., 1390.)],
+    'MODIS': [('B1', 620., 670.), ('B2', 841., 876.), ('B3', 459., 479.), ('B4', 545., 565.), ('B5', 1230., 1250.),
+              ('B6', 1628., 1652.), ('B7', 2105., 2155.)],
+    'Sentinel2_MSI': [('B1', 433., 453.), ('B2', 457.5, 522.5), ('B3', 542.5, 577.5), ('B4', 650., 680.),
+                      ('B5', 697.5, 712.5), ('B6', 732.5, 747.5), ('B7', 773., 793.), ('B8', 784.5, 899.5),
+                      ('B8A', 855., 875.), ('B9', 935., 955.), ('B10', 1360., 1390.), ('B11', 1565., 1655.),
+                      ('B12', 2100., 2280.)],
+}
+
+# Bump when the response tables or the matrix construction change, so cached matrices are rebuilt.
+RESPONSE_VERSION = 1
+
+# Response matrices built by this process, by cache key.
+_matrices = dict()
+
+
+def build_response_matrix(wavelengths, bands, min_coverage=0.5):
+    """
+    Builds the response matrix of a set of boxcar bands on a wavelength grid.
+
+    Each channel is taken to cover the interval between the midpoints to its neighbours. A band's weights are the
+    overlap of each channel with the band pass, normalized to sum to 1.
+
+    Parameters:
+        wavelengths - numpy float array of the grid's wavelengths (increasing).
+        bands - List of (name, lower edge, upper edge) (see SENSOR_BANDS).
+        min_coverage=0.5 - Float. Bands whose pass is covered by the grid less than this fraction get a row of NaN.
+
+    Returns:
+        matrix - 2D numpy float array, one row per band and one column per wavelength.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    mids = (wavelengths[1:] + wavelengths[:-1]) / 2
+    lower = np.concatenate([[wavelengths[0] - (mids[0] - wavelengths[0]) if len(mids) else wavelengths[0]], mids])
+    upper = np.concatenate([mids, [wavelengths[-1] + (wavelengths[-1] - mids[-1]) if len(mids) else wavelengths[-1]]])
+
+    matrix = np.zeros((len(bands), len(wavelengths)))
+    for row, (_, low, high) in enumerate(bands):
+        overlap = np.clip(np.minimum(upper, high) - np.maximum(lower, low), 0, None)
+        if overlap.sum() < min_coverage * (high - low):
+            matrix[row] = np.nan
+        else:
+            matrix[row] = overlap / overlap.sum()
+
+    return matrix
+
+
+def response_matrix(wavelengths, sensor, cache_dir=None):
+    """
+    Gets the response matrix of a sensor on a wavelength grid, building it only if it isn't cached.
+
+    Parameters:
+        wavelengths - numpy float array of the grid's wavelengths.
+        sensor - String. A key of SENSOR_BANDS.
+        cache_dir=None - String. Directory to cache matrices in across runs. None only caches in memory.
+
+    Returns:
+        matrix - 2D numpy float array, one row per band (see build_response_matrix).
+    """
+    key = '{0}_v{1}_{2}'.format(sensor, RESPONSE_VERSION, grid_id(wavelengths))
+    if key in _matrices:
+        return _matrices[key]
+
+    path = os.path.join(cache_dir, key + '.npy') if cache_dir is not None else None
+    if path is not None and os.path.exists(path):
+        matrix = np.load(path)
+    else:
+        matrix = build_response_matrix(wavelengths, SENSOR_BANDS[sensor])
+        if path is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # Write then rename, so concurrent workers never read a partial file.
+            handle, tmp_path = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, matrix)
+            os.rename(tmp_path, path)
+
+    _matrices[key] = matrix
+    return matrix
+
+
+def simulate_bands(wavelengths, spectra, sensor, cache_dir=None):
+    """
+    Simulates a sensor's bands for every scan at once.
+
+    Missing values (NaN) are left out of the bands they fall in, with the band's weights renormalized over the
+    remaining channels; a band is only NaN if all of its channels are missing (or the grid doesn't cover it).
+
+    Parameters:
+        wavelengths - numpy float array of the spectra's wavelengths.
+        spectra - 2D numpy float array, one row per wavelength and one column per scan.
+        sensor - String. A key of SENSOR_BANDS.
+        cache_dir=None - String. See response_matrix.
+
+    Returns:
+        band_names - List of the sensor's band names.
+        bands - 2D numpy float array, one row per band and one column per scan.
+    """
+    matrix = response_matrix(wavelengths, sensor, cache_dir)
+    uncovered = np.isnan(matrix).any(axis=1)
+    weights = np.nan_to_num(matrix)
+
+    finite = np.isfinite(spectra)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bands = weights.dot(np.where(finite, spectra, 0)) / weights.dot(finite.astype(float))
+    bands[uncovered] = np.nan
+
+    return [name for name, _, _ in SENSOR_BANDS[sensor]], bands
+
+
+def simulate_dataset(dataset_dir, sensors=None, filename='Reflectance_data.csv', cache_dir=None):
+    """
+    Simulates sensor bands from a scan data file of a restructured dataset and writes them next to it, one file per
+    sensor (e.g., Reflectance_data.csv -> Reflectance_Landsat8_OLI_bands.csv).
+
+    Parameters:
+        dataset_dir - String. Path to the restructured dataset.
+        sensors=None - List of keys of SENSOR_BANDS. Defaults to every sensor.
+        filename='Reflectance_data.csv' - Name of the scan data file.
+        cache_dir=None - String. See response_matrix.
+
+    Returns:
+        paths - List of the files written.
+    """
+    if sensors is None:
+        sensors = sorted(SENSOR_BANDS.keys())
+
+    dataset_id, headerdata, hkeys, wavelengths, spectra = read_spectra(os.path.join(dataset_dir, filename))
+    key_dict = dict((key, key) for key in hkeys)
+
+    paths = []
+    for sensor in sensors:
+        band_names, bands = simulate_bands(wavelengths, spectra, sensor, cache_dir)
+        rows = [[name] + format_values(values) for name, values in zip(band_names, bands)]
+        path = os.path.join(dataset_dir, '{0}_{1}_bands.csv'.format(filename.replace('_data.csv', ''), sensor))
+        create_scan_file(headerdata, key_dict, rows, dataset_id, path)
+        paths.append(path)
+
+    return paths
+
+
+def simulate_archive(restruct_dir, sensors=None, filename='Reflectance_data.csv', cache_dir=None, processes=None):
+    """
+    Simulates sensor bands for every dataset in a restructured data directory that has the scan data file, in
+    parallel. Each worker builds a response matrix once per wavelength grid; with cache_dir they are shared between
+    workers and runs.
+
+    Parameters:
+        restruct_dir - String. Path to the restructured data directory.
+        sensors, filename, cache_dir - See simulate_dataset.
+        processes=None - Int. Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        paths - List of the files written.
+    """
+    args = [(dataset_dir, sensors, filename, cache_dir)
+            for dataset_dir in DatasetIndex.load(restruct_dir).dataset_dirs(filename)]
+    paths = []
+    for dataset_paths in map_datasets(simulate_dataset, args, 'Band simulation', processes):
+        paths.extend(dataset_paths)
+    return paths
@@ -0,0 +1,462 @@
+"""
+Spectral processing of restructured datasets.
+
+Reflectance is computed from a dataset's upwelling and downwelling scans and the day's cal panel scans:
+
+    reflectance = (upwelling / downwelling) / (cal upwelling / cal downwelling) * panel reflectance
+
+where each scan is paired with the cal scan nearest in time. All scans of a dataset are computed at once with array
+operations, so a whole archive can be regenerated without reprocessing the CDAP files.
+"""
+
+import os
+import logging
+import warnings
+import numpy as np
+import metadata as meta
+from utility import read_scan_file, wavelength_rows, create_scan_file, parse_floats
+from grids import grid_id
+from dataset_index import DatasetIndex, map_datasets
+
+
+def parse_times(times):
+    """
+    Converts time strings (HH:MM:SS, as in the Start Time row) to seconds since midnight.
+
+    Returns:
+        seconds - numpy float array. NaN where a time can't be parsed.
+    """
+    seconds = np.empty(len(times))
+    for idx, time in enumerate(times):
+        try:
+            hours, minutes, secs = time.split(':')
+            seconds[idx] = int(hours) * 3600 + int(minutes) * 60 + float(secs)
+        except (AttributeError, ValueError):
+            seconds[idx] = np.nan
+    return seconds
+
+
+def nearest_idxs(times, ref_times):
+    """
+    Finds the reference time nearest each time.
+
+    Parameters:
+        times - numpy float array of times (e.g., from parse_times).
+        ref_times - numpy float array of reference times (e.g., of the cal scans). Need not be sorted.
+
+    Returns:
+        idxs - numpy int array of idxs into ref_times, one per time. Times that are NaN get the earliest reference
+            time.
+    """
+    ref_times = np.asarray(ref_times, dtype=float)
+    valid = np.flatnonzero(~np.isnan(ref_times))
+    if not len(valid):
+        raise ValueError('No valid reference times')
+
+    order = valid[np.argsort(ref_times[valid])]
+    sorted_times = ref_times[order]
+
+    # Compare each time with its neighbours on either side of the insertion point.
+    times = np.asarray(times, dtype=float)
+    right = np.clip(np.searchsorted(sorted_times, times), 0, len(sorted_times) - 1)
+    left = np.clip(right - 1, 0, len(sorted_times) - 1)
+    with np.errstate(invalid='ignore'):
+        use_left = np.abs(times - sorted_times[left]) <= np.abs(sorted_times[right] - times)
+    nearest = np.where(use_left, left, right)
+
+    missing = np.isnan(times)
+    if missing.any():
+        warnings.warn('{0} scans without a time are paired with the earliest cal scan'.format(missing.sum()))
+        nearest[missing] = 0
+
+    return order[nearest]
+
+
+# Default common wavelength grid (start, stop, step in nm) for harmonize_spectra. Every instrument in the archive
+# covers it.
+COMMON_GRID = (400., 900., 1.)
+
+# Interpolation weights built by this process, by (source grid hash, target grid hash).
+_interpolation_weights = dict()
+
+
+def common_grid(start=None, stop=None, step=None):
+    """Returns the wavelengths of a common grid, from start to stop inclusive. Defaults to COMMON_GRID."""
+    default_start, default_stop, default_step = COMMON_GRID
+    start = default_start if start is None else start
+    stop = default_stop if stop is None else stop
+    step = default_step if step is None else step
+    return np.arange(start, stop + step / 2., step)
+
+
+def interpolation_weights(wavelengths, target_wavelengths):
+    """
+    Gets the linear interpolation weights from one wavelength grid to another. The weight matrix (target x source) has
+    at most two non-zero entries per row, so it is kept in sparse form. Weights are built once per pair of grids.
+
+    Parameters:
+        wavelengths - numpy float array of the source wavelengths (increasing).
+        target_wavelengths - numpy float array of the wavelengths to interpolate to.
+
+    Returns:
+        lo, hi - numpy int arrays. The source rows on either side of each target wavelength.
+        lo_weights, hi_weights - numpy float arrays. Their weights. Both are NaN for target wavelengths outside the
+            source range.
+    """
+    key = (grid_id(wavelengths), grid_id(target_wavelengths))
+    if key in _interpolation_weights:
+        return _interpolation_weights[key]
+
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    target_wavelengths = np.asarray(target_wavelengths, dtype=float)
+    hi = np.clip(np.searchsorted(wavelengths, target_wavelengths), 1, len(wavelengths) - 1)
+    lo = hi - 1
+    hi_weights = (target_wavelengths - wavelengths[lo]) / (wavelengths[hi] - wavelengths[lo])
+    lo_weights = 1 - hi_weights
+
+    outside = (target_wavelengths < wavelengths[0]) | (target_wavelengths > wavelengths[-1])
+    lo_weights[outside] = np.nan
+    hi_weights[outside] = np.nan
+
+    weights = (lo, hi, lo_weights, hi_weights)
+    _interpolation_weights[key] = weights
+    return weights
+
+
+def interpolate_spectra(wavelengths, spectra, target_wavelengths):
+    """
+    Linearly interpolates spectra to other wavelengths, all scans at once (see interpolation_weights). Wavelengths
+    outside the source range are NaN.
+
+    Parameters:
+        wavelengths - numpy float array of the spectra's wavelengths (increasing).
+        spectra - 2D numpy float array, one row per wavelength and one column per scan.
+        target_wavelengths - numpy float array of the wavelengths to interpolate to.
+
+    Returns:
+        interpolated - 2D numpy float array, one row per target wavelength.
+    """
+    if len(wavelengths) == len(target_wavelengths) and np.array_equal(wavelengths, target_wavelengths):
+        return spectra
+
+    lo, hi, lo_weights, hi_weights = interpolation_weights(wavelengths, target_wavelengths)
+    return spectra[lo] * lo_weights[:, np.newaxis] + spectra[hi] * hi_weights[:, np.newaxis]
+
+
+def panel_factor(panel, wavelengths, panel_reflectance=None):
+    """
+    Gets the reflectance of a calibration panel at each wavelength.
+
+    Parameters:
+        panel - String. The panel's name (Calibration Panel in the cal data's metadata).
+        wavelengths - numpy float array of wavelengths.
+        panel_reflectance=None - Dictionary of panel name (lower case) -> reflectance, either a number or a
+            (wavelengths, reflectances) tuple that is interpolated. Panels that aren't listed are treated as perfect
+            reflectors (1.0).
+
+    Returns:
+        factor - numpy float array, one value per wavelength.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    reflectance = (panel_reflectance or {}).get((panel or '').strip().lower(), 1.0)
+    if isinstance(reflectance, tuple):
+        panel_wavelengths, values = reflectance
+        return np.interp(wavelengths, panel_wavelengths, values)
+    return np.repeat(float(reflectance), len(wavelengths))
+
+
+def compute_reflectance(upwelling, downwelling, cal_upwelling, cal_downwelling, times, cal_times, factor=1.0):
+    """
+    Computes the reflectance of every scan at once.
+
+    Parameters:
+        upwelling, downwelling - 2D numpy float arrays of the scans, one row per wavelength and one column per scan.
+        cal_upwelling, cal_downwelling - 2D numpy float arrays of the cal panel scans, on the same wavelengths.
+        times - numpy float array of the scans' times (see parse_times).
+        cal_times - numpy float array of the cal scans' times.
+        factor=1.0 - Panel reflectance, a number or a numpy array with one value per wavelength (see panel_factor).
+
+    Returns:
+        reflectance - 2D numpy float array shaped like upwelling. NaN where a division by zero occurred.
+        pairs - numpy int array of the cal scan (column of cal_upwelling) used for each scan.
+    """
+    pairs = nearest_idxs(times, cal_times)
+    factor = np.asarray(factor, dtype=float)
+    if factor.ndim == 1:
+        factor = factor[:, np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cal_ratio = cal_upwelling / cal_downwelling
+        reflectance = (upwelling / downwelling) / cal_ratio[:, pairs] * factor
+
+    reflectance[~np.isfinite(reflectance)] = np.nan
+    return reflectance, pairs
+
+
+def float_block(values):
+    """Converts a block of scan values as strings (e.g., DataView.spectra) to floats. Empty values are NaN."""
+    values = np.asarray(values)
+    if not values.size:
+        return np.empty(values.shape)
+    return parse_floats(values.ravel().astype(str), remove_val=None)[0].reshape(values.shape)
+
+
+def is_dark_label(label):
+    """Returns True for the label of a dark current row (DC01 - DC25)"""
+    return str(label).lower().startswith('dc')
+
+
+def dark_correct(labels, block):
+    """
+    Subtracts each scan's dark current, the mean of its DC rows, from its spectral rows. Every scan is corrected in
+    one array operation.
+
+    Parameters:
+        labels - Sequence of scan row labels (DC rows followed by wavelengths, as from data2array).
+        block - 2D array of scan values, one row per label and one column per scan. Strings are converted (see
+            float_block).
+
+    Returns:
+        wavelength_labels - List of the labels of the spectral rows.
+        corrected - 2D numpy float array of the corrected spectral rows.
+        dark - numpy float array of each scan's dark current. NaN for scans without DC values.
+    """
+    block = np.asarray(block)
+    if block.dtype.kind not in 'fiu':
+        block = float_block(block)
+
+    dark_mask = np.array([is_dark_label(label) for label in labels], dtype=bool)
+    with warnings.catch_warnings():
+        # Scans without any DC value give an all-NaN column.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        dark = np.nanmean(block[dark_mask], axis=0) if dark_mask.any() else np.full(block.shape[1], np.nan)
+
+    corrected = block[~dark_mask] - np.nan_to_num(dark)[np.newaxis, :]
+    wavelength_labels = [label for label, is_dark in zip(labels, dark_mask) if not is_dark]
+    return wavelength_labels, corrected, dark
+
+
+def dark_corrected_rows(rows):
+    """
+    Dark-corrects a stream of scan rows (label followed by values, e.g., from stream_scan_rows). The DC rows at the
+    start of the scan block are buffered to get each scan's dark current; the spectral rows are corrected as they
+    stream.
+
+    Yields:
+        row - List. Wavelength label followed by the corrected values (see format_values).
+    """
+    rows = iter(rows)
+    dc_rows = []
+    dark = None
+    for row in rows:
+        if dark is None and is_dark_label(row[0]):
+            dc_rows.append(row)
+            continue
+
+        if dark is None:
+            num_values = max([len(dc_row) - 1 for dc_row in dc_rows] + [0])
+            block = np.array([dc_row[1:] + [''] * (num_values - len(dc_row) + 1) for dc_row in dc_rows], dtype=object)
+            _, _, dark = dark_correct([dc_row[0] for dc_row in dc_rows], block.reshape(len(dc_rows), num_values))
+            dark = np.nan_to_num(dark)
+
+        values = parse_floats(row[1:], remove_val=None)[0]
+        if len(values) > len(dark):
+            # Scans without DC values aren't corrected.
+            dark = np.concatenate([dark, np.zeros(len(values) - len(dark))])
+        out_row = [row[0]]
+        out_row.extend(format_values(values - dark[:len(values)]))
+        yield out_row
+
+
+def format_values(values):
+    """Formats floats for a scan data file: repr, and '' for NaN."""
+    return ['' if np.isnan(value) else repr(value) for value in values]
+
+
+def read_spectra(path):
+    """
+    Reads the spectral rows of a scan data file.
+
+    Returns:
+        dataset_id - String. The dataset's ID.
+        headerdata - Dictionary of header rows indexed by element name.
+        hkeys - List of header element names, in file order.
+        wavelengths - numpy float array of the wavelengths.
+        spectra - 2D numpy float array, one row per wavelength and one column per scan (DC rows are left out).
+    """
+    dataset_id, headerdata, hkeys, labels, block = read_scan_file(path)
+    wavelengths, rows = wavelength_rows(labels)
+    return dataset_id, headerdata, hkeys, wavelengths, block[rows]
+
+
+def find_cal_dir(restruct_dir, dataset_dir, index=None):
+    """
+    Finds the cal dataset recorded with a restructured dataset: the cal_data dataset of the same date with the same
+    Legacy Path (the CDAP data directory both came from). Second collections with the same date are in sub-directories
+    of date/cal_data (see plan_dataset_dir), so the cal data can't be assumed to be next to the dataset.
+
+    Parameters:
+        restruct_dir - String. Path to the restructured data directory.
+        dataset_dir - String. Path to the restructured dataset, in restruct_dir.
+        index=None - DatasetIndex of restruct_dir. Loaded if not given.
+
+    Returns:
+        cal_dir - String. Path to the cal dataset.
+    """
+    if index is None:
+        index = DatasetIndex.load(restruct_dir)
+
+    # The date is read rather than parsed from the path: it may contain path separators (e.g., 8/9/2007).
+    metadata = meta.read_metadata(os.path.join(dataset_dir, 'Metadata.csv'))
+    date, legacy_path = metadata.get('Date'), metadata.get('Legacy Path')
+    for _, path in index.find(date, 'cal_data'):
+        cal_dir = os.path.join(restruct_dir, path)
+        cal_meta_path = os.path.join(cal_dir, 'Metadata.csv')
+        if os.path.exists(cal_meta_path) and meta.read_metadata(cal_meta_path).get('Legacy Path') == legacy_path:
+            return cal_dir
+
+    raise IOError('No cal data found for {0}'.format(dataset_dir))
+
+
+def reflectance_dataset(dataset_dir, cal_dir=None, panel_reflectance=None, filename='Computed_Reflectance_data.csv',
+                        restruct_dir=None):
+    """
+    Computes the reflectance of a restructured dataset from its upwelling and downwelling scans and the cal scans, and
+    writes it next to them. Downwelling and cal scans are interpolated to the upwelling wavelengths if they differ.
+
+    Parameters:
+        dataset_dir - String. Path to the restructured dataset (with Upwelling_data.csv and Downwelling_data.csv).
+        cal_dir=None - String. Path to the cal data. Defaults to the dataset's cal data in restruct_dir (see
+            find_cal_dir).
+        panel_reflectance=None - Reflectance of the calibration panels (see panel_factor).
+        filename='Computed_Reflectance_data.csv' - Name of the file written.
+        restruct_dir=None - String. Path to the restructured data directory the dataset is in. Required without
+            cal_dir.
+
+    Returns:
+        path - String. Path of the file written.
+    """
+    if cal_dir is None:
+        if restruct_dir is None:
+            raise ValueError('Either cal_dir or restruct_dir is needed')
+        cal_dir = find_cal_dir(restruct_dir, dataset_dir)
+
+    up_path = os.path.join(dataset_dir, 'Upwelling_data.csv')
+    dataset_id, headerdata, hkeys, wavelengths, upwelling = read_spectra(up_path)
+    _, _, _, down_wavelengths, downwelling = read_spectra(os.path.join(dataset_dir, 'Downwelling_data.csv'))
+    _, cal_header, _, cal_wavelengths, cal_upwelling = read_spectra(os.path.join(cal_dir, 'Upwelling_Cal_data.csv'))
+    _, _, _, cal_down_wavelengths, cal_downwelling = read_spectra(os.path.join(cal_dir, 'Downwelling_Cal_data.csv'))
+
+    if upwelling.shape[1] != downwelling.shape[1] or cal_upwelling.shape[1] != cal_downwelling.shape[1]:
+        raise ValueError('Upwelling and downwelling scans of {0} do not match'.format(dataset_dir))
+
+    downwelling = interpolate_spectra(down_wavelengths, downwelling, wavelengths)
+    cal_upwelling = interpolate_spectra(cal_wavelengths, cal_upwelling, wavelengths)
+    cal_downwelling = interpolate_spectra(cal_down_wavelengths, cal_downwelling, wavelengths)
+
+    cal_meta = meta.read_metadata(os.path.join(cal_dir, 'Metadata.csv'))
+    factor = panel_factor(cal_meta.get('Calibration Panel'), wavelengths, panel_reflectance)
+
+    reflectance, _ = compute_reflectance(upwelling, downwelling, cal_upwelling, cal_downwelling,
+                                         parse_times(headerdata.get('Start Time', [])),
+                                         parse_times(cal_header.get('Start Time', [])), factor)
+
+    rows = []
+    for wavelength_label, values in zip(wavelengths, reflectance):
+        row = [repr(wavelength_label)]
+        row.extend(format_values(values))
+        rows.append(row)
+
+    path = os.path.join(dataset_dir, filename)
+    create_scan_file(headerdata, dict((key, key) for key in hkeys), rows, dataset_id, path)
+    return path
+
+
+def reflectance_archive(restruct_dir, panel_reflectance=None, processes=None):
+    """
+    Computes the reflectance of every dataset in a restructured data directory that has upwelling and downwelling
+    scans, in parallel.
+
+    Parameters:
+        restruct_dir - String. Path to the restructured data directory.
+        panel_reflectance=None - Reflectance of the calibration panels (see panel_factor).
+        processes=None - Int. Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        paths - List of the files written.
+    """
+    index = DatasetIndex.load(restruct_dir)
+    args = []
+    for dataset_dir in index.dataset_dirs('Downwelling_data.csv', cal=False):
+        try:
+            cal_dir = find_cal_dir(restruct_dir, dataset_dir, index)
+        except IOError, e:
+            logging.error('Reflectance of {0} failed: {1}'.format(dataset_dir, e))
+            continue
+        args.append((dataset_dir, cal_dir, panel_reflectance))
+
+    return map_datasets(reflectance_dataset, args, 'Reflectance', processes)
+
+
+def harmonize_spectra(wavelengths, spectra, grid=None):
+    """
+    Resamples spectra onto a common wavelength grid, so spectra from different instruments can be stacked.
+
+    Parameters:
+        wavelengths - numpy float array of the spectra's wavelengths.
+        spectra - 2D numpy float array, one row per wavelength and one column per scan.
+        grid=None - numpy float array of the common grid's wavelengths. Defaults to common_grid().
+
+    Returns:
+        harmonized - 2D numpy float array, one row per grid wavelength.
+    """
+    if grid is None:
+        grid = common_grid()
+    return interpolate_spectra(wavelengths, spectra, grid)
+
+
+def harmonize_dataset(dataset_dir, filename='Reflectance_data.csv', grid=None):
+    """
+    Reads a scan data file of a restructured dataset and resamples it onto a common grid.
+
+    Returns:
+        dataset_id - String. The dataset's ID.
+        harmonized - 2D numpy float array, one row per grid wavelength and one column per scan.
+    """
+    dataset_id, _, _, wavelengths, spectra = read_spectra(os.path.join(dataset_dir, filename))
+    return dataset_id, harmonize_spectra(wavelengths, spectra, grid)
+
+
+def harmonize_archive(restruct_dir, filename='Reflectance_data.csv', grid=None, saveto=None, processes=None):
+    """
+    Resamples a scan data file of every dataset in a restructured data directory onto a common grid and stacks the
+    results, in parallel. Each worker builds the interpolation weights once per instrument grid.
+
+    Parameters:
+        restruct_dir - String. Path to the restructured data directory.
+        filename='Reflectance_data.csv' - Name of the scan data file.
+        grid=None - numpy float array of the common grid's wavelengths. Defaults to common_grid().
+        saveto=None - String. Path to save the result to, as a .npz with arrays grid, spectra, dataset_ids and counts.
+        processes=None - Int. Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        grid - numpy float array of the grid's wavelengths.
+        stacked - 2D numpy float array, one row per grid wavelength and one column per scan of every dataset.
+        datasets - List of (Dataset ID, number of scans), in column order.
+    """
+    if grid is None:
+        grid = common_grid()
+
+    args = [(dataset_dir, filename, grid) for dataset_dir in DatasetIndex.load(restruct_dir).dataset_dirs(filename)]
+    blocks = []
+    datasets = []
+    for dataset_id, harmonized in map_datasets(harmonize_dataset, args, 'Harmonization', processes, ordered=True):
+        blocks.append(harmonized)
+        datasets.append((dataset_id, harmonized.shape[1]))
+
+    stacked = np.hstack(blocks) if blocks else np.empty((len(grid), 0))
+    if saveto is not None:
+        np.savez(saveto, grid=grid, spectra=stacked, dataset_ids=[dataset_id for dataset_id, _ in datasets],
+                 counts=[count for _, count in datasets])
+
+    return grid, stacked, datasets
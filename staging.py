@@ -0,0 +1,94 @@
+"""
+Staged output directories.
+
+A data directory is restructured into a local staging directory first. Once every output is complete, its datasets
+are published to the restructured data directory with one rename each, so readers never see a half-written dataset and
+a failed directory is removed without touching the shared output directory.
+"""
+
+import os
+import errno
+import shutil
+import tempfile
+import logging
+
+
+def create_staging_dir(staging_root=None):
+    """
+    Creates an empty staging directory.
+
+    Parameters:
+        staging_root=None - String. Directory to create the staging directory in. Defaults to the system's temporary
+            directory; it should be on a local disk.
+
+    Returns:
+        staging_dir - String. Path to the new staging directory.
+    """
+    if staging_root is not None and not os.path.exists(staging_root):
+        os.makedirs(staging_root)
+    return tempfile.mkdtemp(prefix='restruct_', dir=staging_root)
+
+
+def discard_staging_dir(staging_dir):
+    """Removes a staging directory and everything in it."""
+    if os.path.isdir(staging_dir):
+        shutil.rmtree(staging_dir)
+
+
+def publish_dir(src, dst):
+    """
+    Moves a directory to dst, which must not exist. dst appears complete or not at all: within a filesystem this is a
+    rename, and across filesystems the directory is copied next to dst and then renamed into place.
+    """
+    if os.path.exists(dst):
+        # A rename would silently replace an empty directory.
+        raise OSError(errno.EEXIST, 'Dataset directory already exists', dst)
+
+    parent = os.path.dirname(dst)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    try:
+        os.rename(src, dst)
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        partial = dst + '.partial'
+        if os.path.exists(partial):
+            shutil.rmtree(partial)
+        shutil.copytree(src, partial)
+        os.rename(partial, dst)
+        shutil.rmtree(src)
+
+
+def publish(staging_dir, out_dir, metas):
+    """
+    Publishes the datasets of a staging directory to out_dir, keeping their paths relative to the staging directory,
+    and updates each dataset's 'out_dir' to its published path. The staging directory is removed afterwards.
+
+    If a dataset can't be published, the datasets already published are removed again before the error is raised, so
+    a directory's datasets are published together or not at all.
+
+    Parameters:
+        staging_dir - String. Path to the staging directory.
+        out_dir - String. Path to the restructured data directory.
+        metas - List of dataset metadata dicts whose 'out_dir' is within staging_dir (e.g., cal_meta and each loc_meta).
+    """
+    # Publish parents before their nested dataset directories, so a nested dataset moves along with its parent.
+    metas = sorted(metas, key=lambda meta_dict: len(meta_dict['out_dir']))
+    published = []
+    try:
+        for meta_dict in metas:
+            rel_dir = os.path.relpath(meta_dict['out_dir'], staging_dir)
+            dst = os.path.join(out_dir, rel_dir)
+            if os.path.exists(meta_dict['out_dir']):
+                publish_dir(meta_dict['out_dir'], dst)
+                published.append(dst)
+            meta_dict['out_dir'] = dst
+    except Exception:
+        logging.error('Publishing {0} failed. Removing {1}'.format(staging_dir, published))
+        for dst in published:
+            shutil.rmtree(dst, ignore_errors=True)
+        raise
+
+    discard_staging_dir(staging_dir)
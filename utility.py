@@ -2,18 +2,65 @@
 
 from matplotlib import pyplot as plt
 from matplotlib import rcParams
+from matplotlib.collections import LineCollection
 import csv
+import numpy as np
 import simplekml
 import os
 import warnings
 import logging
 import metadata as meta
+from instruments import parse_instrument
 import shutil
+import hashlib
+from itertools import izip_longest, islice, chain
+
+
+def _to_float(value):
+    """Converts a single value to float, returning NaN if it can't be converted."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parse_floats(l, remove_val=-9999):
+    """
+    Converts a whole column of values (e.g., the strings of a CDAP data row) to a float array in one call.
+
+    The column is converted in bulk by numpy. Only if it contains entries that are neither numbers nor empty strings
+    does conversion fall back to converting each element.
+
+    Parameters:
+        l - List (or other iterable, including a string) of values to convert.
+        remove_val=-9999 - Value treated as nodata. Defaults to the nodata value. None keeps every converted value.
+
+    Returns:
+        values - numpy float array the same length as l. Entries that could not be converted are NaN.
+        mask - numpy boolean array. True where an entry converted to a float (not NaN) and is not remove_val.
+    """
+    if not isinstance(l, (list, tuple, np.ndarray)):
+        l = list(l)
+
+    values = np.asarray(l)
+    try:
+        if values.dtype.kind in 'SU':
+            # Empty strings are common (e.g., no GPS). Treat them as NaN rather than leaving the fast path.
+            values = np.where(values == '', 'nan', values)
+        values = values.astype(float)
+    except (TypeError, ValueError):
+        values = np.fromiter((_to_float(element) for element in l), dtype=float, count=len(l))
+
+    mask = ~np.isnan(values)
+    if remove_val is not None:
+        mask &= values != remove_val
+
+    return values, mask
 
 
 def filter_floats(l, convert=True, remove_val=-9999):
     """
-    Given a list, returns a list of elements that can be converted to floats.
+    Given a list, returns a list of elements that can be converted to floats. See parse_floats().
 
     Parameters:
         l - List. List to filter.
@@ -24,65 +71,51 @@ def filter_floats(l, convert=True, remove_val=-9999):
     Returns:
         filtered - List of filtered list elements.
     """
-    filtered = []
-    for element in l:
-        try:
-            converted = float(element)
-            if convert and converted != remove_val:
-                filtered.append(converted)
-            elif converted != remove_val:
-                filtered.append(element)
-        except ValueError:
-            pass
+    if not isinstance(l, (list, tuple, np.ndarray)):
+        l = list(l)
 
-    return filtered
+    values, mask = parse_floats(l, remove_val=remove_val)
+    if convert:
+        return values[mask].tolist()
 
+    return [l[idx] for idx in np.flatnonzero(mask)]
 
-def create_raw_scans_files(file_paths, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, data_type):
+
+def create_raw_scans_files(file_paths, cal_idxs, loc_idxs, loc_meta, cal_meta, key_dict, data_type, streaming=False):
     """
     Creates a raw scans file
+
+    In streaming mode only the header rows are held in memory; the scan rows are read one at a time and written
+    straight to the cal and location files.
     """
     # make sure the filepaths are sorted
     file_paths.sort()
 
-    # Load the file(s)
-    first = True
-    for file_path in file_paths:
-        if first:
-            data = readData(file_path)
-            first = False
-        else:
-            odata = readData(file_path)
-            for idx, row in enumerate(odata):
-                data[idx].extend(row[1:-1])
-
-            del odata
-
-    fields = getFields(data)
-
-    # Deal with the cal data
-    cal_data = split_by_idxs(data, cal_idxs)
-    cal_dict, cal_scans, _ = data2dict(cal_data)
-    cal_dir = cal_meta['out_dir']
-    dataset_id = cal_meta['Dataset ID']
-    if cal_dict[key_dict['Replication']]:
-        create_scan_file(cal_dict, key_dict, cal_scans, dataset_id,
-                        os.path.join(cal_dir, 'Raw_{0}_Cal_data.csv'.format(data_type)))
-
-    # Split the data into locations (for non-cal data)
+    if streaming:
+        header, rows = split_header(iter_multipart_rows(file_paths))
+        headerdata, _, _, _ = data2array(header, fix_dc_scans=False)
+        rows = stream_scan_rows(rows)
+    else:
+        # Load the file(s) and parse the data once. Cal and location subsets are selected from the result.
+        data = read_multipart(file_paths)
+        headerdata, labels, spectra, _ = data2array(data)
+        del data
+        rows = scan_rows(labels, spectra)
+
+    # The cal data, then the data for each location (for non-cal data)
+    outputs = [(cal_idxs, cal_meta, 'Raw_{0}_Cal_data.csv'.format(data_type))]
     for loc in loc_idxs.keys():
-        loc_data = split_by_idxs(data, loc_idxs[loc])
-
-        # Create the data dicts
-        data_dict, data_scans, _ = data2dict(loc_data)
-
-        # Save the scandata files
-        loc_dir = loc_meta[loc]['out_dir']
-        dataset_id = loc_meta[loc]['Dataset ID']
+        outputs.append((loc_idxs[loc], loc_meta[loc], 'Raw_{0}_data.csv'.format(data_type)))
 
+    scan_files = []
+    for idxs, meta_dict, filename in outputs:
+        data_dict = select_header(headerdata, idxs)
         if data_dict[key_dict['Replication']]:
-            create_scan_file(data_dict, key_dict, data_scans, dataset_id,
-                             os.path.join(loc_dir, 'Raw_{0}_data.csv'.format(data_type)))
+            scan_files.append((data_dict, meta_dict['Dataset ID'], os.path.join(meta_dict['out_dir'], filename),
+                               sorted(idxs)))
+
+    # Save the scandata files
+    create_scan_files(scan_files, key_dict, rows)
 
 
 def standardize_project_name(project_name, location_name):
@@ -234,6 +267,7 @@ def split_cal_scans(data, cal_idxs):
         cal_data, scan_data - Lists of calibration and scan data.
     """
 
+    cal_idxs = set(cal_idxs)
     cal_data = []
     scan_data = []
     for idx, row in enumerate(data):
@@ -252,75 +286,138 @@ def create_scan_file(data_dict, key_dict, scan_data, dataset_id, path):
     """
     Creates a scan data file for a dataset.
     """
-    elements = ['File Name','Project', 'Replication', 'X', 'Y', 'Scan Number', 'Start Time', 'Stop Time',
-                'Integration Time', 'Averaged Scans', 'Average Adj']
     # Open the csv file and writ ethe results
     with open(path, 'w') as f:
         write = csv.writer(f, delimiter=',')
+        write_scan_header(write, data_dict, key_dict, dataset_id)
 
-        # First write the dataset ID
-        write.writerow(['Dataset ID', dataset_id])
+        for row in scan_data:
+            write.writerow(row)
 
-        # Now add the other rows.
-        for element in elements:
-            if element in key_dict.keys():
-                row = [element]
-                row.extend(data_dict[key_dict[element]])
-                write.writerow(row)
 
-        for row in scan_data:
+def write_scan_header(write, data_dict, key_dict, dataset_id):
+    """
+    Writes the dataset ID and header rows of a scan data file.
+
+    Parameters:
+        write - csv writer of the scan data file.
+        data_dict - Dictionary of the dataset's header rows.
+        key_dict - Dictionary of official name -> file key name.
+        dataset_id - String. The dataset's ID.
+    """
+    elements = ['File Name','Project', 'Replication', 'X', 'Y', 'Scan Number', 'Start Time', 'Stop Time',
+                'Integration Time', 'Averaged Scans', 'Average Adj']
+
+    # First write the dataset ID
+    write.writerow(['Dataset ID', dataset_id])
+
+    # Now add the other rows.
+    for element in elements:
+        if element in key_dict.keys():
+            row = [element]
+            row.extend(data_dict[key_dict[element]])
             write.writerow(row)
 
 
-def get_instrument_info(instrument_str):
+def create_scan_files(scan_files, key_dict, scan_rows):
     """
-    Gets the instrument's information from the instrument string.
+    Creates several scan data files (e.g., the cal file and each location's file) in one pass over the scan rows of a
+    CDAP file. Only one scan row is held in memory at a time, so scan_rows can stream from the CDAP file(s).
+
+    Parameters:
+        scan_files - List of (data_dict, dataset_id, path, idxs) for each file. data_dict holds the file's header rows
+            (as for create_scan_file) and idxs the column idxs of the file's scans (the first scan is 1).
+        key_dict - Dictionary of official name -> file key name.
+        scan_rows - Iterable of scan rows (label followed by the values of every scan).
+    """
+    files = []
+    try:
+        outputs = []
+        for data_dict, dataset_id, path, idxs in scan_files:
+            f = open(path, 'w')
+            files.append(f)
+            write = csv.writer(f, delimiter=',')
+            write_scan_header(write, data_dict, key_dict, dataset_id)
+            outputs.append((write, [idx - 1 for idx in idxs]))
+
+        for row in scan_rows:
+            label = row[0]
+            values = row[1:]
+            num_values = len(values)
+            for write, cols in outputs:
+                out_row = [label]
+                out_row.extend([values[col] if col < num_values else '' for col in cols])
+                write.writerow(out_row)
+    finally:
+        for f in files:
+            f.close()
+
+
+def read_scan_file(path):
     """
+    Reads a scan data file written by create_scan_file().
 
-    if instrument_str.startswith(('OO', 'Ocean Optics')):
-        # Ocean Optics instrument
-        if instrument_str.find('USB2') < 0:
-            raise IndexError('Ocean Optics Instrument not recognized!')
+    Parameters:
+        path - String. Path to the scan data file (e.g., Upwelling_data.csv of a restructured dataset).
 
-        inst = [s for s in instrument_str.split(' ') if s.startswith('USB')]
-        plus = instrument_str.find('+')
-        if plus > 0:
-            # It's a USB 2000+
-            instrument_name = 'Ocean Optics USB 2000+'
-            # Find the instrument serial number
-            if inst:
-                snumber = inst[0][5:]
-            else:
-                snumber = instrument_str.split(' ')[1]
-        else:
-            # It's just a normal USB
-            instrument_name = 'Ocean Optics USB 2000'
-            if inst:
-                snumber = inst[0][4:]
+    Returns:
+        dataset_id - String. The dataset's ID.
+        headerdata - Dictionary of header rows indexed by element name (e.g., 'Scan Number').
+        hkeys - List of header element names, in file order.
+        labels - List of scan row labels (the DC rows followed by the wavelengths), as strings.
+        block - 2D numpy float array of the scan rows, one row per label and one column per scan. Empty values are NaN.
+    """
+    dataset_id = None
+    headerdata = {}
+    hkeys = []
+    labels = []
+    rows = []
+    with open(path, 'r') as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            if row[0] == 'Dataset ID':
+                dataset_id = row[1]
+            elif not labels and not is_scan_field(row[0]):
+                headerdata[row[0]] = row[1:]
+                hkeys.append(row[0])
             else:
-                snumber = instrument_str.split(' ')[1]
+                labels.append(row[0])
+                rows.append(parse_floats(row[1:], remove_val=None)[0])
 
-        if instrument_str.find('High Sensitivity') > 0:
-            instrument_name += ' High Sensitivity'
+    if rows:
+        block = np.vstack(rows)
+    else:
+        block = np.empty((0, 0))
 
-        # Find the FOV, if it exists.
-        fov_loc = instrument_str.find('Degree')
-        fov = instrument_str[fov_loc-4:fov_loc-1]
+    return dataset_id, headerdata, hkeys, labels, block
 
-    elif 'Spectron' in instrument_str:
-        insrument_loc = instrument_str.find('Spectron')
-        instrument_name = instrument_str[:insrument_loc + 8]
-        # Check that the FOV is included.
-        fov_loc = instrument_str.find('Degree')
-        fov = instrument_str[fov_loc-4:fov_loc-1]
-        # The Spectron instrument names don't seem to have serial numbers associated wtih them.
-        snumber = ''
 
-    else:
-        # Some other instrument
-        raise NotImplementedError('NEED TO INCLUDE SUPPORT FOR UNSUPPORTED INSTRUMENT.')
+def wavelength_rows(labels):
+    """
+    Finds the wavelength rows among scan row labels, skipping the DC rows.
+
+    Returns:
+        wavelengths - numpy float array of the wavelengths.
+        rows - numpy int array of the row idxs of the wavelengths in labels.
+    """
+    values, mask = parse_floats(labels, remove_val=None)
+    rows = np.flatnonzero(mask)
+    return values[rows], rows
+
+
+def get_instrument_info(instrument_str):
+    """
+    Gets the instrument's information from the instrument string (see instruments.py).
 
-    return instrument_name, snumber, fov
+    Returns:
+        instrument_name, snumber, fov - Strings. For an instrument that isn't in instruments.json, the instrument
+            string itself with no serial number or FOV; the string is recorded in instruments.unrecognized.
+    """
+    info = parse_instrument(instrument_str)
+    if info is None:
+        return instrument_str, '', ''
+    return info
 
 
 def find_cal_reps(reps, filenames):
@@ -448,77 +545,106 @@ def find_cdap_key(hkeys_list, match_list):
         return key[0]
 
 
+# Standardized field names and the (lowercase) CDAP header keys each may be found under, in key_dict order.
+CDAP_KEY_MATCHES = [
+    ('Replication', {'rep', 'replication'}),
+    ('X', {'x', 'plot'}),
+    ('Y', {'y', 'plot scan'}),
+    # 'Cumulative scan' or 'count.' The scan number
+    ('Scan Number', {'cumulative scan', 'count'}),
+    ('Solar Azimuth', {'solar azimuth', 'solar aiz', 'solar azimuthal'}),
+    ('Solar Elevation', {'solar elevation', 'solar elev'}),
+    ('Solar Zenith', {'solar zenith'}),
+    ('Altitude', {'altitude'}),
+    ('Longitude', {'longitude'}),
+    ('Latitude', {'latitude'}),
+    ('Comments', {'comments', 'comment'}),
+    ('GPS', {'gps'}),
+    ('Data Logger', {'data logger', 'dl'}),
+    ('Acquisition Software', {'software', 'software version', 'version'}),
+    ('Integration Time', {'integration time', 'int time', 'integration time (ms)'}),
+    ('Instrument', {'instrument', 'instruments'}),
+    ('Date', {'date', 'acquire date'}),
+    ('Start Time', {'start time', 'stime'}),
+    ('Stop Time', {'end time', 'etime'}),
+    ('Calibration Panel', {'processing panel', 'panel'}),
+    ('Project', {'project'}),
+    ('File Name', {'file name'}),
+    ('Averaged Scans', {'averaged scans', 'used scans', 'instrument scans'}),
+]
+
+# Optional fields. These map to '' if not found.
+CDAP_OPTIONAL_KEY_MATCHES = [
+    ('Calibration Mode', {'calibration mode'}),
+]
+
+# Resolved key dictionaries indexed by header layout (tuple of header keys). See create_key_dict.
+_key_dict_cache = {}
+
+
 def create_key_dict(hkeys_list):
     """
     Constructs the dictionary mapping standardized data fieldnames to CDAP file fieldnames
 
+    Files from the same CDAP version share a header layout, so the result is memoized by layout and later files with
+    that layout skip resolution entirely.
+
     Parameters:
         hkeys_list - A list of header keys extracted from a CDAP data file using data2dict() or getFields()
     Returns:
         key_dict - A dictionary mapping standardized data field names to CDAP file fieldnames
     """
-    key_dict = dict()
+    layout = tuple(hkeys_list)
+    if layout not in _key_dict_cache:
+        _key_dict_cache[layout] = resolve_cdap_keys(hkeys_list)
+
+    # Callers add to the key_dict (e.g., datalogger_to_dict), so hand out a copy.
+    return dict(_key_dict_cache[layout])
 
-    # Find the rep row first.
-    key_dict['Replication'] = find_cdap_key(hkeys_list, {'rep', 'replication'})
-    # 'X' or 'Plot'
-    key_dict['X'] = find_cdap_key(hkeys_list, {'x', 'plot'})
-    # 'Y' or 'Plot Scan'
-    key_dict['Y'] = find_cdap_key(hkeys_list, {'y', 'plot scan'})
-    # 'Cumulative scan' or 'count.' The scan number
-    key_dict['Scan Number'] = find_cdap_key(hkeys_list, {'cumulative scan', 'count'})
-    # Solar Azimuth
-    key_dict['Solar Azimuth'] = find_cdap_key(hkeys_list, {'solar azimuth', 'solar aiz', 'solar azimuthal'})
-    # Solar Elevation
-    key_dict['Solar Elevation'] = find_cdap_key(hkeys_list, {'solar elevation', 'solar elev'})
-    # Solar Zenith
-    key_dict['Solar Zenith'] = find_cdap_key(hkeys_list, {'solar zenith'})
-    # Altitude
-    key_dict['Altitude'] = find_cdap_key(hkeys_list, {'altitude'})
-    # Longitude
-    key_dict['Longitude'] = find_cdap_key(hkeys_list, {'longitude'})
-    # Latitude
-    key_dict['Latitude'] = find_cdap_key(hkeys_list, {'latitude'})
-    # Comments
-    key_dict['Comments'] = find_cdap_key(hkeys_list, {'comments', 'comment'})
-    # GPS
-    key_dict['GPS'] = find_cdap_key(hkeys_list, {'gps'})
-    # Data Logger
-    key_dict['Data Logger'] = find_cdap_key(hkeys_list, {'data logger', 'dl'})
-    # Software
-    key_dict['Acquisition Software'] = find_cdap_key(hkeys_list, {'software', 'software version', 'version'})
-    # Integration Time
-    key_dict['Integration Time'] = find_cdap_key(hkeys_list, {'integration time', 'int time', 'integration time (ms)'})
-    # Instrument
-    key_dict['Instrument'] = find_cdap_key(hkeys_list, {'instrument', 'instruments'})
-    # Date
-    key_dict['Date'] = find_cdap_key(hkeys_list, {'date', 'acquire date'})
-    # Start Time
-    key_dict['Start Time'] = find_cdap_key(hkeys_list, {'start time', 'stime'})
-    # Stop Time
-    key_dict['Stop Time'] = find_cdap_key(hkeys_list, {'end time', 'etime'})
-    # Cal panel
-    key_dict['Calibration Panel'] = find_cdap_key(hkeys_list, {'processing panel', 'panel'})
-    # Project
-    key_dict['Project'] = find_cdap_key(hkeys_list, {'project'})
-    # File names
-    key_dict['File Name'] = find_cdap_key(hkeys_list, {'file name'})
-    # Averaged scans
-    key_dict['Averaged Scans'] = find_cdap_key(hkeys_list, {'averaged scans', 'used scans', 'instrument scans'})
-    # Calibration Mode
-    try:
-        key_dict['Calibration Mode'] = find_cdap_key(hkeys_list, {'calibration mode'})
-    except KeyError:
-        key_dict['Calibration Mode'] = ''
+
+def resolve_cdap_keys(hkeys_list):
+    """
+    Resolves every standardized fieldname (CDAP_KEY_MATCHES) against a list of header keys in one pass.
+    Raises the same KeyErrors as find_cdap_key() for missing or ambiguous keys.
+
+    Parameters:
+        hkeys_list - A list of header keys extracted from a CDAP data file using data2dict() or getFields()
+    Returns:
+        key_dict - A dictionary mapping standardized data field names to CDAP file fieldnames
+    """
+    # Lowercase each header key once.
+    lower_keys = {}
+    for hkey in hkeys_list:
+        lower_keys.setdefault(hkey.lower(), []).append(hkey)
+
+    key_dict = dict()
+    for name, match_list in CDAP_KEY_MATCHES + CDAP_OPTIONAL_KEY_MATCHES:
+        key = [hkey for match in match_list for hkey in lower_keys.get(match, [])]
+
+        if len(key) > 1:
+            raise KeyError('More than one header key matches the match list!')
+        elif len(key) == 0:
+            if (name, match_list) in CDAP_OPTIONAL_KEY_MATCHES:
+                key_dict[name] = ''
+            else:
+                raise KeyError('No matching header key found for {0}'.format(match_list))
+        else:
+            key_dict[name] = key[0]
 
     return key_dict
 
 
-def readData(filepath):
+def readData(filepath, offset=0):
     """
     Read a CDAP datafile into a list
+
+    Parameters:
+        filepath - String. Path to the CDAP datafile.
+        offset=0 - Int. Byte offset to start reading from. Use the offset returned by read_header() to read only the
+            scan rows of a file whose header has already been read.
     """
     with open(filepath, 'r') as f:
+            f.seek(offset)
             data = f.readlines()
     datas = []
     for row in data:
@@ -529,6 +655,153 @@ def readData(filepath):
     return datas
 
 
+def iter_multipart_rows(file_paths):
+    """
+    Iterates over the rows of a multi-part CDAP datafile (e.g., *Data01.txt, *Data02.txt, ...) as one logical dataset.
+
+    The parts are read in lockstep, one row at a time. Each row is the first part's row followed by the values of every
+    subsequent part's row (fieldname excluded), so column idxs are the same as if the parts were one file. Rows that
+    are short (trailing empty values) are padded so that later parts' values stay in their own columns.
+
+    Parameters:
+        file_paths - List of paths to the parts, in order.
+
+    Yields:
+        row - List. One combined CDAP data row.
+    """
+    # The number of scans in each part, from its header rows.
+    widths = []
+    for file_path in file_paths:
+        headerdata, _, _, _ = read_header(file_path, find_keys=False)
+        widths.append(max([len(values) for values in headerdata.values()] or [0]))
+
+    files = [open(file_path, 'r') for file_path in file_paths]
+    try:
+        for lines in izip_longest(*files, fillvalue=''):
+            row = None
+            start = 1  # Column the current part's values begin at.
+            for width, line in zip(widths, lines):
+                part_row = line.strip('\t\r\n').split('\t')
+                if row is None:
+                    row = part_row
+                elif len(part_row) > 1:
+                    row.extend([''] * (start - len(row)))
+                    row.extend(part_row[1:])
+                start += width
+
+            yield row
+    finally:
+        for f in files:
+            f.close()
+
+
+def read_multipart(file_paths):
+    """
+    Reads a multi-part CDAP datafile into one list. See iter_multipart_rows().
+
+    Parameters:
+        file_paths - List of paths to the parts, in order.
+
+    Returns:
+        data - CDAP data list with the columns of every part.
+    """
+    return list(iter_multipart_rows(file_paths))
+
+
+def split_header(rows):
+    """
+    Splits an iterator over CDAP data rows (e.g., from iter_multipart_rows) into its header rows and the scan rows.
+    Only the header rows are read; the scan rows are left for the caller to stream.
+
+    Parameters:
+        rows - Iterator over CDAP data rows.
+
+    Returns:
+        header - CDAP data list of the header rows.
+        scan_rows - Iterator over the scan rows (DC rows first).
+    """
+    rows = iter(rows)
+    header = []
+    for row in rows:
+        if is_scan_field(row[0]):
+            return header, chain([row], rows)
+        header.append(row)
+
+    return header, iter([])
+
+
+def stream_scan_rows(rows, fix_dc_scans=True, fields=None):
+    """
+    Yields the scan rows of CDAP data from an iterator, repairing the DC labels as data2array() does. Only the first 25
+    rows are buffered.
+
+    Parameters:
+        rows - Iterator over the scan rows (e.g., from split_header).
+        fix_dc_scans=True - Boolean. Repair the DC row labels.
+        fields=None - Optional list. The original label of each row read is appended to it, so fields holds every scan
+            row label once the rows have been consumed.
+
+    Yields:
+        row - List. Scan row label followed by the values of every scan.
+    """
+    rows = iter(rows)
+    if fix_dc_scans:
+        dc_rows = list(islice(rows, 25))
+        if fields is not None:
+            fields.extend([row[0] for row in dc_rows])
+        labels, keep = repair_dc_labels([row[0] for row in dc_rows])
+        for row, label, keep_row in zip(dc_rows, labels, keep):
+            if keep_row:
+                row[0] = label
+                yield row
+
+    for row in rows:
+        if fields is not None:
+            fields.append(row[0])
+        yield row
+
+
+def read_header(filepath, find_keys=True):
+    """
+    Reads only the header rows of a CDAP datafile. Reading stops at the first scan row (see findScanIdx), so the
+    wavelength block is never loaded.
+
+    Parameters:
+        filepath - String. Path to the CDAP datafile.
+        find_keys=True - Boolean. If True, the key dictionary is constructed via create_key_dict(). Otherwise None is
+            returned in its place (e.g., for files that may be missing standard fields).
+
+    Returns:
+        headerdata - Dictionary of header rows indexed by fieldname (same as the header dict from data2dict())
+        key_dict - A dictionary mapping standardized data field names to CDAP file fieldnames, or None.
+        hkeys - List of header fieldnames, in file order.
+        offset - Int. Byte offset at which the scan rows begin. readData(filepath, offset) reads the remaining rows.
+    """
+    headerdata = {}
+    hkeys = []
+    with open(filepath, 'r') as f:
+        # Use readline() rather than iterating the file so that tell() stays accurate.
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+
+            row = line.strip('\t\r\n').split('\t')
+            if is_scan_field(row[0]):
+                break
+
+            headerdata[row[0]] = row[1:]
+            hkeys.append(row[0])
+
+    if find_keys:
+        key_dict = create_key_dict(hkeys)
+    else:
+        key_dict = None
+
+    return headerdata, key_dict, hkeys, offset
+
+
 def data2dict(data, fix_dc_scans=True):
     """
     Converts CDAP datalist to a dictionary indexed by fieldname.
@@ -563,50 +836,172 @@ def data2dict(data, fix_dc_scans=True):
             scandata.append(row)
 
     # Now, modify the scandata list
-    # Check if the 24th and 25th scan rows are what we expected.
-    remove_rows = []
     if fix_dc_scans:
-        if scandata[24][0] != 'DC25' or scandata[0][0] != 'DC01':
-            if scandata[0][0] != 'DC01':
-                try:
-                    float(scandata[0][0])
-                except ValueError:
-                    err_str = 'UNEXPECTED FIRST SCAN ENTRY {0}'.format(scandata[0][0])
-                    logging.error(err_str)
-                    raise RuntimeError(err_str)
-            # Warn that we had to fix this.
-            warn_str = 'DC SCANS NOT PROPERLY LABELED. DC01 IS {0} and DC25 IS {1}'.format(scandata[0][0], scandata[24][0])
-            warnings.warn(warn_str)
-            logging.warning(warn_str)
-            # The DC scans are either not specified or last few were removed.
-            try:
-                # If the 25th scan can be converted to float, first 25 scans should be DC
-                float(scandata[24][0])
-                for row_idx in range(25):
-                    scandata[row_idx][0] = 'DC{0}'.format(str(row_idx + 1).zfill(2))
-            except ValueError:
-                # Some of the scandata entries have been converted to
-                #   'extra' data (e.g., min/max that were never really used)
-                for row_idx in range(25):
-                    if not scandata[row_idx][0].startswith('DC'):
-                        try:
-                            # If it can be converted to float, its a DC scan
-                            float(scandata[row_idx][0])
-                            scandata[row_idx][0] = 'DC{0}'.format(str(row_idx + 1).zfill(2))
-                        except ValueError:
-                            # Just remove those rows. They aren't needed.
-                            remove_rows.append(row_idx)
-
-    if remove_rows:
-        for idx, row in enumerate(scandata):
-            if idx not in remove_rows:
-                final_scandata.append(row)
+        labels, keep = repair_dc_labels([row[0] for row in scandata])
+        for row_idx in range(25):
+            scandata[row_idx][0] = labels[row_idx]
+
+        if not keep.all():
+            final_scandata = [row for row, keep_row in zip(scandata, keep) if keep_row]
+        else:
+            final_scandata = scandata
     else:
         final_scandata = scandata
 
     return headerdata, final_scandata, hkeys
 
 
+def repair_dc_labels(labels):
+    """
+    Checks that the first 25 scan rows are labeled DC01 - DC25 and repairs the labels if they are not.
+
+    Unlabeled (numeric) DC rows are relabeled. Rows among the first 25 that are neither DC nor numeric (e.g., 'extra'
+    min/max rows that were never really used) are marked for removal.
+
+    Parameters:
+        labels - List of scan row labels (the fieldname of each scan row), starting with the first DC row.
+
+    Returns:
+        labels - numpy object array of repaired labels.
+        keep - numpy boolean array. False for rows that should be removed.
+    """
+    labels = np.array(labels, dtype=object)
+    keep = np.ones(len(labels), dtype=bool)
+
+    # Check if the 24th and 25th scan rows are what we expected.
+    if labels[24] != 'DC25' or labels[0] != 'DC01':
+        if labels[0] != 'DC01':
+            try:
+                float(labels[0])
+            except ValueError:
+                err_str = 'UNEXPECTED FIRST SCAN ENTRY {0}'.format(labels[0])
+                logging.error(err_str)
+                raise RuntimeError(err_str)
+        # Warn that we had to fix this.
+        warn_str = 'DC SCANS NOT PROPERLY LABELED. DC01 IS {0} and DC25 IS {1}'.format(labels[0], labels[24])
+        warnings.warn(warn_str)
+        logging.warning(warn_str)
+
+        # The DC scans are either not specified or last few were removed.
+        dc_labels = labels[:25]  # A view, so assignments modify labels.
+        dc_names = np.array(['DC{0}'.format(str(row_idx + 1).zfill(2)) for row_idx in range(25)], dtype=object)
+        _, numeric = parse_floats(dc_labels, remove_val=None)
+        if numeric[24]:
+            # If the 25th scan can be converted to float, first 25 scans should be DC
+            dc_labels[:] = dc_names
+        else:
+            # Some of the scandata entries have been converted to 'extra' data. Numeric ones are DC scans, the rest
+            #   aren't needed.
+            labeled = np.array([label.startswith('DC') for label in dc_labels])
+            relabel = ~labeled & numeric
+            dc_labels[relabel] = dc_names[relabel]
+            keep[:25] = labeled | numeric
+
+    return labels, keep
+
+
+def data2array(data, fix_dc_scans=True):
+    """
+    Array-backed version of data2dict(). Header rows are returned as a dictionary and the scan rows as one block of
+    (scan rows x scans) values plus a vector of row labels. DC labels are repaired (see repair_dc_labels) and removed
+    rows are dropped with a mask.
+
+    Parse a file once and use select_scans() to take subsets (cal data, locations) of the result rather than parsing
+    each subset again.
+
+    Parameters:
+        data - CDAP data list (e.g., from readData or read_multipart)
+        fix_dc_scans=True - Boolean. Repair the DC row labels.
+
+    Returns:
+        headerdata - Dictionary of header rows indexed by fieldname (as from data2dict)
+        labels - numpy object array of scan row labels (DC01 - DC25, then wavelengths as in the file)
+        spectra - 2D numpy object array of scan values as strings (rows x scans), not numbers; see
+            spectra.float_block to convert it. Short rows are padded with ''.
+        hkeys - List of header fieldnames, in file order.
+    """
+    fields = getFields(data)
+    scan_idx = findScanIdx(fields)
+    if scan_idx is None:
+        scan_idx = len(data)
+
+    headerdata = {}
+    hkeys = fields[:scan_idx]
+    for row in data[:scan_idx]:
+        headerdata[row[0]] = row[1:]
+
+    scan_rows = data[scan_idx:]
+    labels = np.array(fields[scan_idx:], dtype=object)
+    num_scans = max([len(row) - 1 for row in scan_rows] or [0])
+    spectra = np.array([row[1:] + [''] * (num_scans - len(row) + 1) for row in scan_rows], dtype=object)
+    spectra = spectra.reshape(len(scan_rows), num_scans)
+
+    if fix_dc_scans:
+        labels, keep = repair_dc_labels(labels)
+        if not keep.all():
+            labels = labels[keep]
+            spectra = spectra[keep]
+
+    return headerdata, labels, spectra, hkeys
+
+
+def select_scans(headerdata, spectra, idxs):
+    """
+    Selects scans (columns) from the output of data2array() without re-parsing.
+
+    Parameters:
+        headerdata - Dictionary of header rows (from data2array)
+        spectra - 2D array of scan values as strings (from data2array)
+        idxs - Column idxs of the CDAP data list (the first scan is 1, as for split_by_idxs)
+
+    Returns:
+        headerdata - Dictionary of the selected scans' header values. Missing values are ''.
+        spectra - 2D object array of the selected scans' values. Scans past the end of the block are ''.
+    """
+    cols = [idx - 1 for idx in sorted(idxs)]
+    num_values = spectra.shape[1]
+    present = [i for i, col in enumerate(cols) if col < num_values]
+
+    selected = np.full((spectra.shape[0], len(cols)), '', dtype=object)
+    selected[:, present] = spectra[:, [cols[i] for i in present]]
+    return select_header(headerdata, idxs), selected
+
+
+def select_header(headerdata, idxs):
+    """
+    Selects scans (columns) from a dictionary of header rows.
+
+    Parameters:
+        headerdata - Dictionary of header rows (e.g., from data2array)
+        idxs - Column idxs of the CDAP data list (the first scan is 1, as for split_by_idxs)
+
+    Returns:
+        headerdata - Dictionary of the selected scans' header values. Missing values are ''.
+    """
+    cols = [idx - 1 for idx in sorted(idxs)]
+
+    selected = {}
+    for key, values in headerdata.items():
+        # Some rows may be empty
+        if values:
+            selected[key] = [values[col] if col < len(values) else '' for col in cols]
+        else:
+            selected[key] = []
+
+    return selected
+
+
+def scan_rows(labels, spectra):
+    """
+    Yields scan rows (label followed by values) from a labels vector and a block of scan values, e.g., for
+    create_scan_file().
+    """
+    for label, values in zip(labels, spectra):
+        row = [label]
+        row.extend(values)
+        yield row
+
+
 def getFields(data):
     """
     Gets the field names of cdap data list
@@ -651,20 +1046,8 @@ def create_kml_from_file(cdap_file, kml_file):
     Point's name = project: rep
     Point's description = Detected location
     """
-    # Read the data
-    data = readData(cdap_file)
-    # Get the fields of the data
-    fields = getFields(data)
-    # Find the scan starting idx
-    scanidx = findScanIdx(fields)
-
-    # Create a list of just the header keys
-    hkeys = fields[0:scanidx]
-    # Generate the keydict
-    key_dict = create_key_dict(hkeys)
-
-    # Convert to a dict for easy access
-    data_dict, _, _ = data2dict(data)
+    # Only the header rows are needed, so skip reading the scan data.
+    data_dict, key_dict, _, _ = read_header(cdap_file)
 
     # Get desired info from the dict.
     lats = data_dict[key_dict['Latitude']]
@@ -688,8 +1071,56 @@ def create_kml_from_file(cdap_file, kml_file):
 
 
 def mean(l):
-    """Returns the mean of a list"""
-    return sum(map(float, l))/float(len(l))
+    """Returns the mean of a list. Raises ValueError if an element can't be converted to float."""
+    values, mask = parse_floats(l, remove_val=None)
+    if not mask.all():
+        raise ValueError('Could not convert every value to float: {0}'.format(l))
+
+    return float(values.sum())/len(values)
+
+
+# Lat/lon bounding boxes of the sites: (location, min lat, max lat, min lon, max lon). The first match wins.
+SITE_BOUNDS = [
+    ('CSP01', 41.161607, 41.169437, -96.483063, -96.47315),
+    ('CSP02', 41.161405, 41.168761, -96.473668, -96.463818),
+    ('CSP03A', 41.17547, 41.1793, -96.444978, -96.43475),
+    ('CSP03', 41.17937, 41.183, -96.44494, -96.43465),
+]
+
+
+def determine_locs(lats, lons, projects):
+    """
+    Vectorized determine_loc() for the scans of a file: every lat/lon is classified against SITE_BOUNDS at once, and
+    only scans without a usable lat/lon fall back on their project name.
+
+    Parameters:
+        lats - List of latitudes (strings, as in CDAP files)
+        lons - List of longitudes
+        projects - List of project names
+
+    Returns:
+        locations - List of locations, as from determine_loc. None where a location cannot be determined.
+    """
+    lat_values, lat_mask = parse_floats(lats, remove_val=None)
+    lon_values, lon_mask = parse_floats(lons, remove_val=None)
+    valid = lat_mask & lon_mask
+
+    locations = np.empty(len(lat_values), dtype=object)
+    unassigned = np.ones(len(lat_values), dtype=bool)
+    # Compare against NaN-free values so invalid entries never match.
+    lat_values = np.where(valid, lat_values, 0)
+    lon_values = np.where(valid, lon_values, 0)
+    for site, lat_min, lat_max, lon_min, lon_max in SITE_BOUNDS:
+        in_site = (valid & unassigned & (lat_min <= lat_values) & (lat_values <= lat_max) &
+                   (lon_min <= lon_values) & (lon_values <= lon_max))
+        locations[in_site] = site
+        unassigned &= ~in_site
+
+    # Fall back on project name
+    for idx in np.flatnonzero(unassigned):
+        locations[idx] = determine_loc('', '', projects[idx])[0]
+
+    return locations.tolist()
 
 
 def determine_loc(lat, lon, project):
@@ -714,14 +1145,10 @@ def determine_loc(lat, lon, project):
         lat = float(lat)
         lon = float(lon)
 
-        if (41.161607 <= lat <= 41.169437) and (-96.483063 <= lon <= -96.47315):
-            location = 'CSP01'
-        elif (41.161405 <= lat <= 41.168761) and (-96.473668 <= lon <= -96.463818):
-            location = 'CSP02'
-        elif (41.17547 <= lat <= 41.1793) and (-96.444978 <= lon <= -96.43475):
-            location = 'CSP03A'
-        elif (41.17937 <= lat <= 41.183) and (-96.44494 <= lon <= -96.43465):
-            location = 'CSP03'
+        for site, lat_min, lat_max, lon_min, lon_max in SITE_BOUNDS:
+            if (lat_min <= lat <= lat_max) and (lon_min <= lon <= lon_max):
+                location = site
+                break
 
     if location is None:
         # Fall back on project name
@@ -748,94 +1175,155 @@ def determine_loc(lat, lon, project):
     return location, 'United States', 'Nebraska', 'Saunders'
 
 
+def is_scan_field(field):
+    """Returns True if a CDAP row's fieldname marks scan data (a wavelength or a DC row)"""
+    try:
+        float(field)
+        return True
+    except ValueError:
+        return field.lower().startswith('dc')
+
+
 def findScanIdx(fields):
     """Finds the file row number where scandata begins"""
     for idx,field in enumerate(fields):
-        try:
-            float(field)
+        if is_scan_field(field):
             return idx
-        except ValueError:
-            if field.lower().startswith('dc'):
-                return idx
+
+
+def wavelength_hash(wavelengths):
+    """Returns a hex digest identifying a wavelength vector, e.g. to key caches of grid-dependent matrices."""
+    return hashlib.sha1(np.asarray(wavelengths, dtype='<f8').tostring()).hexdigest()
+
+
+def draw_scans(ax, wavelengths, scans, max_lines=None, linewidth=0.2):
+    """
+    Draws scans onto a matplotlib axes as a single LineCollection.
+
+    Parameters:
+        ax - matplotlib Axes to draw on.
+        wavelengths - Sequence of wavelengths (x values), one per row of scans.
+        scans - 2D array-like of scan values, one row per wavelength and one column per scan.
+        max_lines=None - Int. If there are more scans than this, only max_lines evenly spaced scans are drawn.
+        linewidth=0.2 - Float. Width of the lines.
+
+    Returns:
+        lines - The LineCollection added to ax.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    scans = np.asarray(scans, dtype=float)
+    if scans.ndim == 1:
+        scans = scans[:, np.newaxis]
+
+    num_scans = scans.shape[1]
+    if max_lines is not None and num_scans > max_lines:
+        scans = scans[:, np.linspace(0, num_scans - 1, max_lines).astype(int)]
+
+    # One (n_wavelengths, 2) segment per scan.
+    segments = np.empty((scans.shape[1], len(wavelengths), 2))
+    segments[:, :, 0] = wavelengths
+    segments[:, :, 1] = scans.T
+
+    colors = [prop['color'] for prop in rcParams['axes.prop_cycle']]
+    lines = LineCollection(segments, colors=colors, linewidths=linewidth)
+    ax.add_collection(lines)
+    ax.autoscale_view()
+    return lines
 
 
 def plot_scans(prep, prep_data,vheader, scanidx,saveto=None):
     """"Plots prep data and optionally saves to file"""
-    rcParams['xtick.direction'] = 'out'
-    rcParams['ytick.direction'] = 'out'
-
     # Get the data in a desirable format.
     #   Extract wavelengths
-    wavelengths = vheader[scanidx+25:-1]
-    #   Transpose rows to cols
-    scan_data = zip(*prep_data[scanidx+25: -1])
+    wavelengths = parse_floats(vheader[scanidx+25:-1], remove_val=None)[0]
+    #   One row per wavelength, one column per scan
+    scan_data = [parse_floats(row, remove_val=None)[0] for row in prep_data[scanidx+25: -1]]
 
     # Plot
     fig = plt.figure(figsize=(6.5,8.5))
-    for scan in scan_data:
-        plt.plot(wavelengths, scan, linewidth=0.2)
-    plt.title(prep)
-    plt.xlabel('Wavelength')
+    ax = fig.add_subplot(111)
+    draw_scans(ax, wavelengths, scan_data)
+    ax.tick_params(direction='out')
+    ax.set_title(prep)
+    ax.set_xlabel('Wavelength')
 
     # Show or save the plot
     if saveto is not None:
-        plt.savefig(saveto, bbox_inches='tight')
+        fig.savefig(saveto, bbox_inches='tight')
     else:
         plt.show()
 
-    plt.cla()
     plt.close(fig)
 
 
-def create_dataset_dirs(base_dir, current_dataset_id):
+def plan_dataset_dir(out_dir, date, location, dataset_id, publish_dir=None, index=None):
     """
-    Function to facilitate creation of sub-directories for datasets.
-    This function is called when a dataset being processed encounters a restructured dataset with the same date
-    and location. They may be separate collections or duplicates. If separate collections, we want to make sure to
-    save data from each! Otherwise thrown an error or something.
+    Chooses and creates the output directory of a dataset.
+
+    Normally this is out_dir/date/location. If that directory is already taken, by an existing restructured dataset in
+    out_dir or in publish_dir, the dataset goes in a sub-directory of it named by its dataset ID instead. Existing
+    datasets are never moved. This happens when there are separate collections (or duplicates) with the same date and
+    location.
 
     Parameters:
-        base_dir - path to directory containing the already existing dataset that conflicts with the current dataset.
-        current_dataset_id - String. The dataset id of the dataset currently being processed.
+        out_dir - String. Directory the dataset is written to (e.g., a staging directory).
+        date - String. The dataset's date.
+        location - String. The dataset's location ('cal_data' for cal datasets).
+        dataset_id - String. The dataset id of the dataset currently being processed.
+        publish_dir=None - String. Directory out_dir will be published to (see staging.py), if any.
+        index=None - DatasetIndex of publish_dir. If given, existing datasets are looked up in the index instead of
+            on disk.
 
     Returns:
-        new_dir - path to the new directory the dataset currently being processed will reside within.
+        new_dir - path to the directory the dataset currently being processed will reside within.
+        conflict - Boolean. True if date/location was taken.
     """
+    rel_dir = os.path.join(date, location)
+    if index is not None:
+        existing = index.find(date, location)
+        existing_ids = set([existing_id for existing_id, _ in existing])
+        taken_paths = set([path for _, path in existing])
+    else:
+        existing_ids = set()
+        taken_paths = set()
+        if publish_dir is not None and os.path.exists(os.path.join(publish_dir, rel_dir)):
+            taken_paths.add(rel_dir)
+            existing_meta = os.path.join(publish_dir, rel_dir, 'Metadata.csv')
+            if os.path.exists(existing_meta):
+                existing_ids.add(meta.read_metadata(existing_meta)['Dataset ID'])
+
+    def is_taken(path):
+        if path in taken_paths:
+            return True
+        if os.path.exists(os.path.join(out_dir, path)):
+            return True
+        # Without an index, nested datasets are only known from the disk.
+        return index is None and publish_dir is not None and os.path.exists(os.path.join(publish_dir, path))
+
+    if not is_taken(rel_dir):
+        new_dir = os.path.join(out_dir, rel_dir)
+        os.makedirs(new_dir)
+        return new_dir, False
+
+    # Define a directory using the current dataset id.
+    #   For now, also replaece the :'s between timestamp elements with nothing.
+    sub_dir = dataset_id.replace(':', '')
 
-    # Read metadata from existing dataset
-    metadata = meta.read_metadata(os.path.join(base_dir, 'Metadata.csv'))
-    # Get the dataset id from the existing dataset
-    existing_dataset_id = metadata['Dataset ID']
-
-    # Ensure current dataset id != existing dataset id
-    if existing_dataset_id == current_dataset_id:
+    # Check if an existing dataset is the same one.
+    if dataset_id in existing_ids:
         # For now, we will create a copy for further investigation.
-
-        # Warn that this is happening.
-        warn_str = 'DUPLICATE DATASETS DETECTED IN {0}. DATASET ID {1}'.format(base_dir, existing_dataset_id)
+        warn_str = 'DUPLICATE DATASETS DETECTED IN {0}. DATASET ID {1}'.format(rel_dir, dataset_id)
         warnings.warn(warn_str)
         logging.warning(warn_str)
+        sub_dir += '_2'
 
-        # Modify the dataset ids of the two datasets so they are different
-        #   (existing will have _1 appended to end and current will have _2 appended to end).
-        existing_dataset_id += '_1'
-        current_dataset_id += '_2'
+    # Duplicates of duplicates get their own directories too.
+    while is_taken(os.path.join(rel_dir, sub_dir)):
+        sub_dir += '_2'
 
-    # Move the current contents of directory to the new, dataset id based directory.
-    new_existing_dir = os.path.join(base_dir, existing_dataset_id.replace(':', ''))
-    dirlist = os.listdir(base_dir)
-    os.makedirs(new_existing_dir)
-    for element in dirlist:
-        shutil.move(os.path.join(base_dir, element),
-                    os.path.join(new_existing_dir, element))
-
-    # Define a new location directory using the current dataset id.
-    #   For now, also replaece the :'s between timestamp elements with nothing.
-    new_dir = os.path.join(base_dir, current_dataset_id.replace(':', ''))
-    # Make the directory.
+    new_dir = os.path.join(out_dir, rel_dir, sub_dir)
     os.makedirs(new_dir)
-
-    return new_dir
+    return new_dir, True
 
 
 def extract_col(col_idx, data):